@@ -1,30 +1,404 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
-import pandas as pd
-from datetime import datetime
+from flask import Flask, g, render_template, request, jsonify, send_file, send_from_directory
+from flask.json.provider import DefaultJSONProvider
+from datetime import datetime, timedelta
+import bisect
+import codecs
+import csv
+import gzip
+import hashlib
+import importlib
+import io
+import itertools
+import math
 import os
 import re
+import json
+import sqlite3
+import tempfile
+import time
+import threading
+import uuid
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor
+from contextlib import closing, contextmanager
+from urllib.parse import urlsplit
 from werkzeug.utils import secure_filename
-import requests
+from werkzeug.wsgi import ClosingIterator
+
+class LazyModule:
+    """
+    Stand-in for a heavy module that is only imported on first attribute access.
+    Keeps worker boot (and routes like / and /sw.js) free of the pandas/numpy/requests import cost.
+    """
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            print(f"Loading {self._name} on first use")
+            self._module = importlib.import_module(self._name)
+        value = getattr(self._module, attr)
+        # Cache on the proxy so later lookups skip __getattr__
+        setattr(self, attr, value)
+        return value
+
+pd = LazyModule('pandas')
+np = LazyModule('numpy')
+requests = LazyModule('requests')
+# Optional: only needed for the Arrow/Parquet exports
+pa = LazyModule('pyarrow')
+pq = LazyModule('pyarrow.parquet')
+
+# Optional faster JSON serializer
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional brotli compression (gzip is always available)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# POSIX file locks for admission control across workers (without them, e.g. on Windows, it is off)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    JSON provider for the large /calculate and upload responses.
+    Uses orjson when it is installed (and JSON_BACKEND is not 'stdlib'), otherwise
+    the stdlib json module. NumPy scalars and arrays are serialized natively by both.
+    """
+    sort_keys = False  # key order doesn't matter to the frontend and sorting 18-key rows is not free
+    orjson_options = (orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS) if orjson else 0
+
+    def __init__(self, app, backend='auto'):
+        super().__init__(app)
+        self.use_orjson = orjson is not None and backend != 'stdlib'
+        if backend == 'orjson' and orjson is None:
+            print("JSON_BACKEND=orjson but orjson is not installed, using stdlib json")
+
+    @staticmethod
+    def default(o):
+        # NumPy scalars and arrays (tolist() on a scalar returns the plain Python value)
+        if type(o).__module__ == 'numpy' and hasattr(o, 'tolist'):
+            return o.tolist()
+        return DefaultJSONProvider.default(o)
+
+    def dumps(self, obj, **kwargs):
+        if not self.use_orjson:
+            return super().dumps(obj, **kwargs)
+        return self.dump_bytes(obj, indent=bool(kwargs.get('indent'))).decode('utf-8')
+
+    def dump_bytes(self, obj, indent=False):
+        options = self.orjson_options
+        if self.sort_keys:
+            options |= orjson.OPT_SORT_KEYS
+        if indent:
+            options |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=options)
+
+    def loads(self, s, **kwargs):
+        if not self.use_orjson:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if not self.use_orjson:
+            return super().response(*args, **kwargs)
+        if args and kwargs:
+            raise TypeError("app.json.response() takes either args or kwargs, not both")
+        obj = (args[0] if len(args) == 1 else args) if args else (kwargs or None)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(self.dump_bytes(obj, indent) + b'\n', mimetype=self.mimetype)
 
 app = Flask(__name__)
+app.json = FastJSONProvider(app, backend=os.environ.get('JSON_BACKEND', 'auto'))
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', os.urandom(24))
 app.config['UPLOAD_FOLDER'] = 'uploads'
 
-# Ensure upload folder exists
+# Slow/failed upload capture (replay with replay_captures.py). Off unless enabled, since captures
+# keep supplier workbooks on disk; descriptions are masked unless UPLOAD_CAPTURE_SCRUB=0
+app.config['CAPTURE_ENABLED'] = os.environ.get('UPLOAD_CAPTURE_ENABLED', '0') == '1'
+app.config['CAPTURE_FOLDER'] = os.environ.get('UPLOAD_CAPTURE_FOLDER', 'captures')
+app.config['CAPTURE_LATENCY_THRESHOLD'] = float(os.environ.get('UPLOAD_CAPTURE_THRESHOLD', 5.0))  # seconds
+app.config['CAPTURE_MAX_FILES'] = int(os.environ.get('UPLOAD_CAPTURE_MAX_FILES', 50))
+app.config['CAPTURE_MAX_BYTES'] = int(os.environ.get('UPLOAD_CAPTURE_MAX_BYTES', 100 * 1024 * 1024))
+app.config['CAPTURE_SCRUB_DESCRIPTIONS'] = os.environ.get('UPLOAD_CAPTURE_SCRUB', '1') == '1'
+
+# Robust uploads: 'first' parses the first worksheet, 'all' every worksheet (per upload: form field `sheets`)
+app.config['UPLOAD_SHEETS'] = os.environ.get('UPLOAD_SHEETS', 'first')
+# Worker processes for parsing worksheets and batch-upload files in parallel
+# (1 parses them one after another in the request)
+app.config['SHEET_WORKERS'] = int(os.environ.get('SHEET_WORKERS', min(4, os.cpu_count() or 1)))
+# Most files one /upload-batch request may carry
+app.config['BATCH_MAX_FILES'] = int(os.environ.get('UPLOAD_BATCH_MAX_FILES', 20))
+
+# Local SQLite database (exchange-rate history)
+app.config['DATABASE_PATH'] = os.environ.get('DATABASE_PATH', os.path.join('data', 'app.db'))
+
+# How often a worker picks up SKU catalog rows written by other workers
+app.config['SKU_REFRESH_SECONDS'] = float(os.environ.get('SKU_REFRESH_SECONDS', 5))
+# How often a worker checks for a tariff schedule imported by another worker
+app.config['TARIFF_REFRESH_SECONDS'] = float(os.environ.get('TARIFF_REFRESH_SECONDS', 5))
+
+# Exchange-rate API responses are reused for this many seconds
+app.config['RATE_CACHE_TTL'] = int(os.environ.get('RATE_CACHE_TTL', 600))
+# Seconds to wait for one exchange-rate API
+app.config['RATE_TIMEOUT'] = float(os.environ.get('RATE_TIMEOUT', 5))
+# Per-provider circuit breakers (see the Rate provider health section)
+app.config['RATE_BREAKER_FAILURES'] = int(os.environ.get('RATE_BREAKER_FAILURES', 3))
+app.config['RATE_BREAKER_ERROR_RATE'] = float(os.environ.get('RATE_BREAKER_ERROR_RATE', 0.5))
+app.config['RATE_BREAKER_WINDOW'] = int(os.environ.get('RATE_BREAKER_WINDOW', 20))
+app.config['RATE_BREAKER_COOLDOWN'] = float(os.environ.get('RATE_BREAKER_COOLDOWN', 30))
+app.config['RATE_BREAKER_MAX_COOLDOWN'] = float(os.environ.get('RATE_BREAKER_MAX_COOLDOWN', 600))
+# Calls older than this many seconds no longer count against a provider's health
+app.config['RATE_HEALTH_MEMORY'] = float(os.environ.get('RATE_HEALTH_MEMORY', 300))
+# Comma-separated USD-based rate APIs ({"rates": {"ILS": ...}}) used instead of the built-in providers
+app.config['RATE_PROVIDER_URLS'] = [url.strip() for url in os.environ.get('RATE_PROVIDER_URLS', '').split(',') if url.strip()]
+
+# JSON responses at least this large are gzip/brotli compressed when the client accepts it
+app.config['COMPRESS_MIN_SIZE'] = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+app.config['COMPRESS_GZIP_LEVEL'] = int(os.environ.get('COMPRESS_GZIP_LEVEL', 6))
+app.config['COMPRESS_BROTLI_QUALITY'] = int(os.environ.get('COMPRESS_BROTLI_QUALITY', 5))
+
+# Bump whenever ContainerCalculator's output changes, so cached results and ETags are invalidated
+CALCULATOR_VERSION = '3'
+app.config['CALCULATION_CACHE_SIZE'] = int(os.environ.get('CALCULATION_CACHE_SIZE', 256))
+# Most saved calculations one /history/export.parquet (or .arrow) request may export
+app.config['HISTORY_EXPORT_LIMIT'] = int(os.environ.get('HISTORY_EXPORT_LIMIT', 1000))
+
+# /simulate (exchange-rate Monte Carlo) limits; paths x products (or paths x bootstrapped days) per block
+app.config['SIMULATION_MAX_PATHS'] = int(os.environ.get('SIMULATION_MAX_PATHS', 100000))
+app.config['SIMULATION_MAX_HORIZON_DAYS'] = int(os.environ.get('SIMULATION_MAX_HORIZON_DAYS', 730))
+app.config['SIMULATION_MIN_RETURNS'] = int(os.environ.get('SIMULATION_MIN_RETURNS', 20))
+app.config['SIMULATION_BLOCK_SIZE'] = int(os.environ.get('SIMULATION_BLOCK_SIZE', 2000000))
+
+# Admission control for CPU-heavy routes (see the Admission control section). Limits are shared
+# by all workers; a waiting request holds its worker (or thread), so by default a class may use
+# about half the workers and queue a quarter, leaving the rest for light routes
+web_workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+app.config['ADMISSION_ENABLED'] = os.environ.get('ADMISSION_ENABLED', '1') == '1'
+app.config['ADMISSION_FOLDER'] = os.environ.get('ADMISSION_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], '.admission'))
+app.config['ADMISSION_RETRY_AFTER'] = int(os.environ.get('ADMISSION_RETRY_AFTER', 5))  # seconds, until run times are known
+app.config['ADMISSION_CLASSES'] = {
+    'parse': {
+        'endpoints': ['upload_file', 'upload_file_robust', 'upload_batch'],
+        'limit': int(os.environ.get('ADMISSION_PARSE_LIMIT', max(1, web_workers // 2))),
+        'queue': int(os.environ.get('ADMISSION_PARSE_QUEUE', max(1, web_workers // 4))),
+        'wait': float(os.environ.get('ADMISSION_PARSE_WAIT', 5))
+    },
+    'compute': {
+        'endpoints': ['export_xlsx', 'export_calculation_xlsx', 'export_columnar', 'export_history_columnar', 'simulate'],
+        'limit': int(os.environ.get('ADMISSION_COMPUTE_LIMIT', max(1, web_workers // 4))),
+        'queue': int(os.environ.get('ADMISSION_COMPUTE_QUEUE', max(1, web_workers // 4))),
+        'wait': float(os.environ.get('ADMISSION_COMPUTE_WAIT', 5))
+    }
+}
+
+# Ensure upload and database folders exist
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(os.path.dirname(app.config['DATABASE_PATH']) or '.', exist_ok=True)
 
-def extract_numeric_value(text):
-    """Extract numeric value from text, handling various formats."""
-    if pd.isna(text):
-        return 0
-    if isinstance(text, (int, float)):
-        return float(text)
-    # Remove any non-numeric characters except decimal point
-    numeric_str = re.sub(r'[^\d.]', '', str(text))
-    try:
-        return float(numeric_str)
-    except ValueError:
-        return 0
+# --- BEGIN: Numeric coercion ---
+# Currency and unit markers around spreadsheet numbers ("US$ 1,234.50", "¥12", "0.35 cbm", "500pcs"),
+# longest first so "US$" is removed before "$"
+NUMBER_MARKERS = re.compile(
+    r'us\$|hk\$|rmb|cny|usd|eur|hkd|ils|nis|cbm|m³|m3|pcs|pc|sets|set|ctns|ctn|kgs|kg|[$¥￥€₪元]', re.IGNORECASE)
+# Digit-group separators that are never decimal points: spaces (also non-breaking) and apostrophes
+GROUP_SPACES = re.compile(r"[\s  '’]")
+MISSING_TEXT = {'', 'nan', 'none', 'null', 'n/a', '-', '--'}
+# Text made only of digits, separators, signs and markers - anything else (descriptions) is not a number
+NUMBER_TEXT = rf"(?:{NUMBER_MARKERS.pattern}|[\d.,()\-−+:\s  '’])+"
+
+def decimal_separator(numbers, default='.'):
+    """
+    ',' or '.', whichever most of a column's digit strings use as the decimal point.
+    "1.234,56" and "1,234.56" decide by their last separator, "12,5" and "12.5" by a group
+    that is not three digits, repeated separators ("1.234.567") are thousands; "1,234"
+    alone is ambiguous and does not count. Ties (and columns with no evidence) go to `default`.
+    """
+    commas = numbers.str.count(',')
+    dots = numbers.str.count(r'\.')
+    last = numbers.str.extract(r'([.,])\d*$', expand=False)
+    trailing_digits = numbers.str.extract(r'[.,](\d*)$', expand=False).str.len()
+    comma_votes = (((commas > 0) & (dots > 0) & (last == ',')) |
+                   ((commas == 1) & (dots == 0) & (trailing_digits != 3)) |
+                   ((dots > 1) & (commas == 0))).sum()
+    dot_votes = (((commas > 0) & (dots > 0) & (last == '.')) |
+                 ((dots == 1) & (commas == 0) & (trailing_digits != 3)) |
+                 ((commas > 1) & (dots == 0))).sum()
+    if comma_votes == dot_votes:
+        return default
+    return ',' if comma_votes > dot_votes else '.'
+
+def text_cells(values):
+    """The non-empty text cells of a column (Series or list), stripped."""
+    cells = values if isinstance(values, pd.Series) else pd.Series(list(values), dtype=object)
+    if cells.dtype != object:
+        return pd.Series([], dtype=object)
+    text = cells[cells.map(lambda value: isinstance(value, str))].astype(object).str.strip()
+    return text[~text.str.lower().isin(MISSING_TEXT)]
+
+def number_digits(text):
+    """
+    (digits, negative) for the text cells that look like a number: reduced to digits and
+    separators, and whether they carry a sign. The sign is read once currency and unit
+    markers are gone ("¥-5", "US$ -12.50", "(5) pcs").
+    """
+    text = text[text.str.fullmatch(NUMBER_TEXT, flags=re.IGNORECASE)]
+    cleaned = text.str.replace(NUMBER_MARKERS, '', regex=True).str.replace(GROUP_SPACES, '', regex=True)
+    negative = cleaned.str.match(r'^[(\-−]') | cleaned.str.contains(r'[)\-−]$')
+    digits = cleaned.str.strip('()-−+:')
+    numeric = digits.str.fullmatch(r'\d[\d.,]*|[.,]\d+')
+    return digits[numeric], negative[numeric]
+
+def sheet_decimal_separator(columns):
+    """decimal_separator() voted over several columns together, for columns with no evidence of their own."""
+    digits = [number_digits(text_cells(column))[0] for column in columns]
+    return decimal_separator(pd.concat(digits)) if digits else '.'
+
+def coerce_numeric(values, default_decimal='.'):
+    """
+    Parse a column of spreadsheet cells (Series or list) into float64 in one pass.
+    Numbers pass through; text may carry thousands separators in either convention
+    ("1,234.56", "1.234,56", "1 234,56"), currency markers (¥, RMB, US$...), units (cbm, m³,
+    pcs) and a sign ("-5", "(5)", "5-", "¥-5"). The decimal separator is detected once for
+    the column; a column that doesn't show it ("2.500", "12.000") uses `default_decimal`,
+    typically the sheet's (sheet_decimal_separator). Returns (numbers, failed): numbers are
+    NaN for empty and unparseable cells, `failed` marks the non-empty cells that could not
+    be parsed.
+    """
+    cells = values if isinstance(values, pd.Series) else pd.Series(list(values), dtype=object)
+    if pd.api.types.is_numeric_dtype(cells) and not pd.api.types.is_bool_dtype(cells):
+        return cells.astype(float), pd.Series(False, index=cells.index)
+    strings = cells.map(lambda value: isinstance(value, str))
+    # Numeric cells, and text without a separator ("12", "-3"), at C speed
+    numbers = pd.to_numeric(cells.mask(strings), errors='coerce').astype(float)
+    text = text_cells(cells[strings])
+    plain = text[~text.str.contains(r'[.,]')]
+    numbers[plain.index] = pd.to_numeric(plain, errors='coerce')
+    failed = pd.Series(False, index=cells.index)
+    if text.empty:
+        return numbers, failed
+
+    # Everything else goes through the column's separator vote
+    digits, negative = number_digits(text[numbers[text.index].isna()])
+    if not digits.empty:
+        if decimal_separator(digits, default_decimal) == ',':
+            digits = digits.str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
+        else:
+            digits = digits.str.replace(',', '', regex=False)
+        parsed = pd.to_numeric(digits, errors='coerce')
+        numbers[parsed.index] = parsed.where(~negative, -parsed)
+    failed[text.index] = numbers[text.index].isna()
+    return numbers, failed
+
+def parse_number(value):
+    """coerce_numeric() for a single cell: its value, or 0 if it is empty or not a number."""
+    number = coerce_numeric([value])[0].iloc[0]
+    return 0 if pd.isna(number) else number
+# --- END: Numeric coercion ---
+
+# --- BEGIN: Column profiling ---
+# Header-like cell keywords, shared by header detection and the structure report
+HEADER_KEYWORDS = [
+    'ITEM', 'NO', 'NUMBER', 'PRODUCT', 'DESCRIPTION', 'NAME',
+    'QTY', 'QUANTITY', 'PCS', 'PIECES', 'UNITS',
+    'PRICE', 'COST', 'AMOUNT', 'USD', '$', 'UNIT PRICE',
+    'CBM', 'VOLUME', 'SIZE', 'DIMENSION', 'M3', 'CUBIC',
+    'TOTAL', 'SUM', 'GRAND'
+]
+
+class SheetProfile:
+    """
+    Cell facts for one worksheet read with header=None, computed once with whole-column
+    operations so the header, column and row heuristics don't re-scan cells: which cells
+    are present, their numbers (coerce_numeric; NaN where not a number) and, on first use,
+    each column's text and regex matches. Positions are row/column positions.
+    """
+    def __init__(self, df):
+        if not df.shape[1]:
+            # An empty sheet still has an (empty) first column for the heuristics to look at
+            df = pd.DataFrame(index=df.index, columns=[0])
+        self.df = df
+        self.rows, self.width = df.shape
+        self.present = df.notna().to_numpy()
+        self.values = np.full(df.shape, np.nan)
+        self.failed = np.zeros(df.shape, dtype=bool)
+        # Columns that don't show their decimal separator ("2.500") follow the rest of the sheet
+        self.decimal = sheet_decimal_separator([df.iloc[:, col] for col in range(self.width)])
+        for col in range(self.width):
+            numbers, failed = coerce_numeric(df.iloc[:, col], self.decimal)
+            self.values[:, col] = numbers.to_numpy()
+            self.failed[:, col] = failed.to_numpy()
+        self.numeric = ~np.isnan(self.values)
+        self.whole = self.numeric & (self.values == np.floor(self.values))
+        self.row_cells = self.present.sum(axis=1)
+        self.row_numbers = self.numeric.sum(axis=1)
+        self._text = {}
+        self._matches = {}
+
+    def text(self, col):
+        """A column's cells as stripped upper-case text ('' for empty cells)."""
+        if col not in self._text:
+            cells = self.df.iloc[:, col].astype(object)
+            self._text[col] = cells.where(cells.notna(), '').astype(str).str.strip().str.upper()
+        return self._text[col]
+
+    def lengths(self, col):
+        return self.text(col).str.len().to_numpy()
+
+    def matches(self, pattern, col=None):
+        """
+        Present cells containing a match for regex `pattern` (case-insensitive), as a bool
+        array for column `col`, or (rows, columns) for every column.
+        """
+        if col is None:
+            return np.column_stack([self.matches(pattern, col) for col in range(self.width)])
+        if (pattern, col) not in self._matches:
+            found = self.text(col).str.contains(pattern, flags=re.IGNORECASE, regex=True).to_numpy()
+            self._matches[(pattern, col)] = found & self.present[:, col]
+        return self._matches[(pattern, col)]
+
+    def keyword_hits(self, keywords, col=None):
+        """matches() for cells containing any of `keywords`."""
+        return self.matches('|'.join(re.escape(keyword) for keyword in keywords), col)
+
+    def share(self, mask, rows=slice(None)):
+        """Per column, the fraction of present cells in `rows` where `mask` holds (NaN if none)."""
+        cells = self.present[rows].sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (mask[rows] & self.present[rows]).sum(axis=0) / cells
+
+    def columns(self, rows=slice(None)):
+        """
+        Per-column statistics of the cells in `rows`, one DataFrame row per column: cells,
+        numeric_ratio, integer_ratio, min, max, mean_length and keyword_hits (HEADER_KEYWORDS).
+        """
+        lengths = pd.DataFrame({col: self.lengths(col)[rows] for col in range(self.width)}, dtype=float)
+        numbers = pd.DataFrame(self.values[rows])
+        return pd.DataFrame({
+            'cells': self.present[rows].sum(axis=0),
+            'numeric_ratio': self.share(self.numeric, rows),
+            'integer_ratio': self.share(self.whole, rows),
+            'min': numbers.min(),
+            'max': numbers.max(),
+            'mean_length': lengths.where(self.present[rows]).mean(),
+            'keyword_hits': self.keyword_hits(HEADER_KEYWORDS)[rows].sum(axis=0)
+        })
+
+    @staticmethod
+    def first(mask, start=0):
+        """Position of the first True in `mask` at or after `start`, or None."""
+        found = np.flatnonzero(mask[start:])
+        return start + int(found[0]) if len(found) else None
+# --- END: Column profiling ---
 
 def extract_product_info(text):
     """Extract product information from the text field."""
@@ -110,36 +484,6 @@ def extract_product_info(text):
     print(f"Final product info: {result}")
     return result
 
-def extract_volume(text):
-    """Extract volume information from text."""
-    if pd.isna(text):
-        return 0
-    text = str(text).lower()
-    # Look for volume in cbm
-    if 'cbm' in text:
-        try:
-            # Extract the number before 'cbm'
-            volume_str = text.split('cbm')[0].strip()
-            return float(volume_str)
-        except:
-            return 0
-    return 0
-
-def safe_float_convert(value):
-    """Safely convert a value to float, handling empty strings and spaces."""
-    if pd.isna(value):
-        return 0
-    try:
-        # Convert to string, strip whitespace, and handle empty strings
-        value_str = str(value).strip()
-        if not value_str or value_str.isspace() or value_str.lower() == 'nan':
-            return 0
-        # Remove any currency symbols or commas
-        value_str = value_str.replace('$', '').replace(',', '')
-        return float(value_str)
-    except (ValueError, TypeError):
-        return 0
-
 def find_numeric_value(row, search_terms, min_value=0, exclude_cols=None):
     """Search for a numeric value in a row using various search terms."""
     if exclude_cols is None:
@@ -147,6 +491,7 @@ def find_numeric_value(row, search_terms, min_value=0, exclude_cols=None):
         
     best_value = 0
     best_col = None
+    numbers = coerce_numeric(list(row))[0].fillna(0).tolist()
     
     for col_num, value in enumerate(row):
         if col_num in exclude_cols or pd.isna(value):
@@ -162,40 +507,36 @@ def find_numeric_value(row, search_terms, min_value=0, exclude_cols=None):
             for offset in [-1, 1]:
                 check_col = col_num + offset
                 if 0 <= check_col < len(row) and check_col not in exclude_cols and pd.notna(row[check_col]):
-                    try:
-                        num_value = safe_float_convert(row[check_col])
-                        if num_value > min_value and num_value > best_value:
-                            best_value = num_value
-                            best_col = check_col
-                    except:
-                        continue
+                    num_value = numbers[check_col]
+                    if num_value > min_value and num_value > best_value:
+                        best_value = num_value
+                        best_col = check_col
         
         # Also check if this cell itself is a number
-        try:
-            num_value = safe_float_convert(value)
-            if num_value > min_value and num_value > best_value:
-                # Check adjacent cells for our terms
-                for offset in [-1, 1]:
-                    check_col = col_num + offset
-                    if 0 <= check_col < len(row) and pd.notna(row[check_col]):
-                        if any(term in str(row[check_col]).lower() for term in search_terms):
-                            best_value = num_value
-                            best_col = col_num
-                            break
-        except:
-            continue
+        num_value = numbers[col_num]
+        if num_value > min_value and num_value > best_value:
+            # Check adjacent cells for our terms
+            for offset in [-1, 1]:
+                check_col = col_num + offset
+                if 0 <= check_col < len(row) and pd.notna(row[check_col]):
+                    if any(term in str(row[check_col]).lower() for term in search_terms):
+                        best_value = num_value
+                        best_col = col_num
+                        break
     
     return best_value, best_col
 
-def find_column_indices(df):
+def find_column_indices(df, profile=None):
     """
     Find the column indices for item number, quantity, price, and volume.
-    Uses multiple strategies to handle different Excel formats.
+    Uses multiple strategies to handle different Excel formats, all reading the sheet's
+    SheetProfile (built here when not given).
     """
+    if profile is None:
+        profile = SheetProfile(df)
     print("\nSearching for header row...")
     
     # Strategy 1: Look for traditional header patterns
-    header_row_idx = None
     header_patterns = [
         'Item NO.',
         'Item No.',
@@ -205,78 +546,41 @@ def find_column_indices(df):
         'Product',
         'Description'
     ]
-    
-    for idx, row in df.iterrows():
-        if pd.isna(row[0]):
-            continue
-            
-        first_col = str(row[0]).strip()
-        # Only consider this a header if it's a short, clean header (not company info)
-        if (any(pattern.lower() in first_col.lower() for pattern in header_patterns) and 
-            len(first_col) < 50 and  # Avoid long company descriptions
-            not any(word in first_col.lower() for word in ['company', 'ltd', 'co', 'tel', 'email', 'website', 'contact'])):
-            header_row_idx = idx
-            print(f"Found header row at index {idx} (Strategy 1)")
-            print("Header row contents:")
-            for col_idx, value in enumerate(row):
-                if pd.notna(value):
-                    print(f"Column {col_idx}: {value}")
-            break
+    # Only consider this a header if it's a short, clean header (not company info)
+    header_like = (profile.keyword_hits(header_patterns, 0) &
+                   (profile.lengths(0) < 50) &  # Avoid long company descriptions
+                   ~profile.keyword_hits(['company', 'ltd', 'co', 'tel', 'email', 'website', 'contact'], 0))
+    header_row_idx = SheetProfile.first(header_like)
+    if header_row_idx is not None:
+        print(f"Found header row at index {header_row_idx} (Strategy 1)")
+        print("Header row contents:")
+        for col_idx, value in enumerate(df.iloc[header_row_idx]):
+            if pd.notna(value):
+                print(f"Column {col_idx}: {value}")
     
     # Strategy 2: Look for any row with multiple header-like keywords
     if header_row_idx is None:
         print("Strategy 1 failed, trying Strategy 2...")
-        for idx, row in df.iterrows():
-            if pd.isna(row[0]):
-                continue
-                
-            # Check if this row has multiple non-empty cells that look like headers
-            header_like_cells = 0
-            header_content = []
-            
-            for col_idx, value in enumerate(row):
-                if pd.notna(value):
-                    value_str = str(value).strip().upper()
-                    # Look for common header keywords
-                    header_keywords = [
-                        'ITEM', 'NO', 'NUMBER', 'PRODUCT', 'DESCRIPTION', 'NAME',
-                        'QTY', 'QUANTITY', 'PCS', 'PIECES', 'UNITS',
-                        'PRICE', 'COST', 'AMOUNT', 'USD', '$', 'UNIT PRICE',
-                        'CBM', 'VOLUME', 'SIZE', 'DIMENSION', 'M3', 'CUBIC',
-                        'TOTAL', 'SUM', 'GRAND'
-                    ]
-                    
-                    for keyword in header_keywords:
-                        if keyword in value_str:
-                            header_like_cells += 1
-                            header_content.append(f"Col{col_idx}: {value_str}")
-                            break
-            
-            if header_like_cells >= 2:  # At least 2 columns look like headers
-                header_row_idx = idx
-                print(f"Found header row at index {idx} (Strategy 2)")
-                print(f"Header content: {header_content}")
-                break
+        # At least 2 columns look like headers
+        keyword_cells = profile.keyword_hits(HEADER_KEYWORDS)
+        header_row_idx = SheetProfile.first(profile.present[:, 0] & (keyword_cells.sum(axis=1) >= 2))
+        if header_row_idx is not None:
+            header_content = [f"Col{col_idx}: {profile.text(col_idx).iat[header_row_idx]}"
+                              for col_idx in np.flatnonzero(keyword_cells[header_row_idx])]
+            print(f"Found header row at index {header_row_idx} (Strategy 2)")
+            print(f"Header content: {header_content}")
     
     # Strategy 3: Look for the row before the first product-like row
     if header_row_idx is None:
         print("Strategy 2 failed, trying Strategy 3...")
-        for idx in range(1, len(df)):
-            row = df.iloc[idx]
-            if pd.notna(row[0]):
-                first_col = str(row[0]).strip()
-                # Check if this looks like a product row (alphanumeric content)
-                if any(c.isalnum() for c in first_col) and len(first_col) > 2:
-                    # Check if previous row might be a header
-                    prev_row = df.iloc[idx - 1]
-                    if not pd.isna(prev_row[0]):
-                        prev_first_col = str(prev_row[0]).strip()
-                        # If previous row has short text, it might be a header
-                        if len(prev_first_col) < 20 and any(c.isalpha() for c in prev_first_col):
-                            header_row_idx = idx - 1
-                            print(f"Found header row at index {header_row_idx} (Strategy 3)")
-                            print(f"Header: {prev_first_col}")
-                            break
+        # A product-like row (alphanumeric content) below a short text cell that might be a header
+        product_like = profile.matches(r'[^\W_]', 0) & (profile.lengths(0) > 2)
+        short_text = profile.matches(r'[^\W\d_]', 0) & (profile.lengths(0) < 20)
+        product_idx = SheetProfile.first(np.concatenate(([False], product_like[1:] & short_text[:-1])))
+        if product_idx is not None:
+            header_row_idx = product_idx - 1
+            print(f"Found header row at index {header_row_idx} (Strategy 3)")
+            print(f"Header: {profile.text(0).iat[header_row_idx]}")
     
     if header_row_idx is None:
         print("Could not find header row with any strategy")
@@ -355,78 +659,32 @@ def find_column_indices(df):
     else:
         print("No price candidates found!")
 
-    # If we didn't find some columns, try to infer them from the data
+    # If we didn't find some columns, try to infer them from the data of the first rows below the header
+    data_rows = slice(header_row_idx + 1, min(header_row_idx + 10, len(df)))
+    headed = profile.present[header_row_idx]
     if column_indices['quantity'] is None:
         print("Quantity column not found, trying to infer from data...")
-        # Look for numeric columns that might be quantity
-        for col_idx, value in enumerate(header_row):
-            if pd.isna(value):
-                continue
-            # Check if this column has mostly integer values
-            numeric_count = 0
-            total_count = 0
-            for row_idx in range(header_row_idx + 1, min(header_row_idx + 10, len(df))):
-                if pd.notna(df.iloc[row_idx, col_idx]):
-                    total_count += 1
-                    try:
-                        val = float(df.iloc[row_idx, col_idx])
-                        if val == int(val) and val > 0:  # Integer and positive
-                            numeric_count += 1
-                    except:
-                        pass
-            
-            if total_count > 0 and numeric_count / total_count > 0.7:  # 70% are integers
-                column_indices['quantity'] = col_idx
-                print(f"Inferred quantity column at {col_idx} based on data pattern")
-                break
+        # Look for numeric columns that might be quantity: 70% positive integers
+        col_idx = SheetProfile.first(headed & (profile.share(profile.whole & (profile.values > 0), data_rows) > 0.7))
+        if col_idx is not None:
+            column_indices['quantity'] = col_idx
+            print(f"Inferred quantity column at {col_idx} based on data pattern")
     
     if column_indices['price'] is None:
         print("Price column not found, trying to infer from data...")
-        # Look for numeric columns that might be price
-        for col_idx, value in enumerate(header_row):
-            if pd.isna(value):
-                continue
-            # Check if this column has decimal values
-            decimal_count = 0
-            total_count = 0
-            for row_idx in range(header_row_idx + 1, min(header_row_idx + 10, len(df))):
-                if pd.notna(df.iloc[row_idx, col_idx]):
-                    total_count += 1
-                    try:
-                        val = float(df.iloc[row_idx, col_idx])
-                        if val > 0:  # Positive values
-                            decimal_count += 1
-                    except:
-                        pass
-            
-            if total_count > 0 and decimal_count / total_count > 0.5:  # 50% are positive numbers
-                column_indices['price'] = col_idx
-                print(f"Inferred price column at {col_idx} based on data pattern")
-                break
+        # Look for numeric columns that might be price: 50% positive numbers
+        col_idx = SheetProfile.first(headed & (profile.share(profile.values > 0, data_rows) > 0.5))
+        if col_idx is not None:
+            column_indices['price'] = col_idx
+            print(f"Inferred price column at {col_idx} based on data pattern")
     
     if column_indices['volume'] is None:
         print("Volume column not found, trying to infer from data...")
-        # Look for numeric columns that might be volume (usually smaller decimal values)
-        for col_idx, value in enumerate(header_row):
-            if pd.isna(value):
-                continue
-            # Check if this column has small decimal values (typical for volume)
-            small_decimal_count = 0
-            total_count = 0
-            for row_idx in range(header_row_idx + 1, min(header_row_idx + 10, len(df))):
-                if pd.notna(df.iloc[row_idx, col_idx]):
-                    total_count += 1
-                    try:
-                        val = float(df.iloc[row_idx, col_idx])
-                        if 0 < val < 10:  # Small positive values typical for volume
-                            small_decimal_count += 1
-                    except:
-                        pass
-            
-            if total_count > 0 and small_decimal_count / total_count > 0.3:  # 30% are small decimals
-                column_indices['volume'] = col_idx
-                print(f"Inferred volume column at {col_idx} based on data pattern")
-                break
+        # Look for numeric columns that might be volume: 30% small positive values
+        col_idx = SheetProfile.first(headed & (profile.share((profile.values > 0) & (profile.values < 10), data_rows) > 0.3))
+        if col_idx is not None:
+            column_indices['volume'] = col_idx
+            print(f"Inferred volume column at {col_idx} based on data pattern")
     
     # Verify we found at least some required columns
     found_columns = [col for col, idx in column_indices.items() if idx is not None]
@@ -443,15 +701,16 @@ def find_column_indices(df):
     
     return column_indices
 
-def find_product_rows(df):
+def find_product_rows(df, profile=None):
     """
     Find the start and end rows for products based on the header row and product code presence.
     Returns a tuple of (start_row, end_row).
     """
+    if profile is None:
+        profile = SheetProfile(df)
     print("\nSearching for product rows...")
     
     # Find the header row with multiple possible patterns
-    header_row_idx = None
     header_patterns = [
         'Item NO.',
         'Item No.',
@@ -461,36 +720,17 @@ def find_product_rows(df):
         'Product',
         'Description'
     ]
-    
-    for idx, row in df.iterrows():
-        if pd.isna(row[0]):
-            continue
-            
-        first_col = str(row[0]).strip()
-        if any(pattern.lower() in first_col.lower() for pattern in header_patterns):
-            header_row_idx = idx
-            print(f"Found header row at index {idx}")
-            break
+    header_row_idx = SheetProfile.first(profile.keyword_hits(header_patterns, 0))
+    if header_row_idx is not None:
+        print(f"Found header row at index {header_row_idx}")
     
     if header_row_idx is None:
         # Try alternative approach - look for any row with header-like content
-        for idx, row in df.iterrows():
-            if pd.isna(row[0]):
-                continue
-                
-            # Check if this row has multiple non-empty cells that look like headers
-            header_like_cells = 0
-            for col_idx, value in enumerate(row):
-                if pd.notna(value):
-                    value_str = str(value).strip().upper()
-                    # Look for common header keywords
-                    if any(keyword in value_str for keyword in ['QTY', 'QUANTITY', 'PRICE', 'CBM', 'VOLUME', 'AMOUNT', 'COST']):
-                        header_like_cells += 1
-            
-            if header_like_cells >= 2:  # At least 2 columns look like headers
-                header_row_idx = idx
-                print(f"Found alternative header row at index {idx}")
-                break
+        # (at least 2 columns look like headers)
+        keyword_cells = profile.keyword_hits(['QTY', 'QUANTITY', 'PRICE', 'CBM', 'VOLUME', 'AMOUNT', 'COST'])
+        header_row_idx = SheetProfile.first(profile.present[:, 0] & (keyword_cells.sum(axis=1) >= 2))
+        if header_row_idx is not None:
+            print(f"Found alternative header row at index {header_row_idx}")
     
     if header_row_idx is None:
         print("Could not find header row")
@@ -502,79 +742,39 @@ def find_product_rows(df):
     
     # Find the end row by looking for the first row without a product code
     end_row = None
+    non_empty = profile.row_cells > 0
     
-    # Strategy 1: Look for rows without alphanumeric content in first column
-    for idx, row in df.iloc[start_row:].iterrows():
-        # Skip empty rows
-        if row.isna().all():
-            continue
-            
-        # Check if the first column contains a product code
-        first_col = str(row[0]).strip() if pd.notna(row[0]) else ''
-        if not first_col or not any(c.isalnum() for c in first_col):  # No alphanumeric characters means no product code
-            end_row = idx - 1
-            print(f"Found end of products at row {end_row} (Strategy 1)")
-            break
+    # Strategy 1: Look for non-empty rows without alphanumeric content in first column
+    # (no alphanumeric characters means no product code)
+    idx = SheetProfile.first(non_empty & ~profile.matches(r'[^\W_]', 0), start_row)
+    if idx is not None:
+        end_row = idx - 1
+        print(f"Found end of products at row {end_row} (Strategy 1)")
     
     # Strategy 2: Look for summary/total rows
     if end_row is None:
-        for idx, row in df.iloc[start_row:].iterrows():
-            if pd.isna(row[0]):
-                continue
-                
-            first_col = str(row[0]).strip().upper()
-            # Look for summary keywords
-            summary_keywords = ['TOTAL', 'SUM', 'GRAND TOTAL', 'SUBTOTAL', 'TOTALS']
-            if any(keyword in first_col for keyword in summary_keywords):
-                end_row = idx - 1
-                print(f"Found end of products at row {end_row} (Strategy 2 - found summary row)")
-                break
+        summary_keywords = ['TOTAL', 'SUM', 'GRAND TOTAL', 'SUBTOTAL', 'TOTALS']
+        idx = SheetProfile.first(profile.keyword_hits(summary_keywords, 0), start_row)
+        if idx is not None:
+            end_row = idx - 1
+            print(f"Found end of products at row {end_row} (Strategy 2 - found summary row)")
     
-    # Strategy 3: Look for rows with very different data patterns
+    # Strategy 3: Look for rows with very different data patterns: a row with no numeric
+    # data right after a row that had some
     if end_row is None:
-        for idx, row in df.iloc[start_row:].iterrows():
-            if pd.isna(row[0]):
-                continue
-                
-            # Check if this row has a very different pattern (e.g., all text, no numbers)
-            numeric_count = 0
-            total_cells = 0
-            for col_idx, val in enumerate(row):
-                if pd.notna(val):
-                    total_cells += 1
-                    try:
-                        float(val)
-                        numeric_count += 1
-                    except:
-                        pass
-            
-            # If this row has no numeric data and previous rows did, it might be the end
-            if total_cells > 0 and numeric_count == 0:
-                # Check if previous rows had numeric data
-                prev_row = df.iloc[idx - 1]
-                prev_numeric_count = 0
-                prev_total_cells = 0
-                for col_idx, val in enumerate(prev_row):
-                    if pd.notna(val):
-                        prev_total_cells += 1
-                        try:
-                            float(val)
-                            prev_numeric_count += 1
-                        except:
-                            pass
-                
-                if prev_total_cells > 0 and prev_numeric_count > 0:
-                    end_row = idx - 1
-                    print(f"Found end of products at row {end_row} (Strategy 3 - data pattern change)")
-                    break
+        no_numbers = profile.present[:, 0] & non_empty & (profile.row_numbers == 0)
+        after_numbers = np.concatenate(([False], non_empty[:-1] & (profile.row_numbers[:-1] > 0)))
+        idx = SheetProfile.first(no_numbers & after_numbers, start_row)
+        if idx is not None:
+            end_row = idx - 1
+            print(f"Found end of products at row {end_row} (Strategy 3 - data pattern change)")
     
     # If we didn't find an end row, use the last non-empty row
     if end_row is None:
-        for idx in range(len(df) - 1, start_row - 1, -1):
-            if not df.iloc[idx].isna().all():
-                end_row = idx
-                print(f"Using last non-empty row as end: {end_row}")
-                break
+        rows = np.flatnonzero(non_empty[start_row:])
+        if len(rows):
+            end_row = start_row + int(rows[-1])
+            print(f"Using last non-empty row as end: {end_row}")
     
     if end_row is None:
         print("Could not find end of product data")
@@ -588,18 +788,30 @@ def process_excel_data(df):
     print("Starting Excel processing...")
     print(f"DataFrame shape: {df.shape}")
     
+    # Cell facts for every heuristic below, computed once for the sheet
+    profile = SheetProfile(df)
+
     # Find the column indices from the header row
-    column_indices = find_column_indices(df)
+    column_indices = find_column_indices(df, profile)
     if column_indices is None:
         return {'products': [], 'columns_found': {}}
     
     # Find the start and end rows for products
-    start_row, end_row = find_product_rows(df)
+    start_row, end_row = find_product_rows(df, profile)
     if start_row is None or end_row is None:
         return {'products': [], 'columns_found': {}}
     
     print(f"\nProcessing products from row {start_row} to {end_row}")
     
+    # The numeric columns of the product rows, as parsed by the profile (unparseable cells count as 0)
+    numbers, failed, parse_failures = {}, {}, {}
+    product_rows = slice(start_row, end_row + 1)
+    for field in ('quantity', 'price', 'volume'):
+        if column_indices[field] is not None:
+            numbers[field] = np.nan_to_num(profile.values[product_rows, column_indices[field]]).tolist()
+            failed[field] = profile.failed[product_rows, column_indices[field]].tolist()
+            parse_failures[field] = 0
+    
     # Process all products
     products = []
     
@@ -641,9 +853,9 @@ def process_excel_data(df):
                 continue
             
             # Get values from the identified columns
-            quantity = safe_float_convert(row[column_indices['quantity']])
-            price_per_unit = safe_float_convert(row[column_indices['price']])
-            volume = safe_float_convert(row[column_indices['volume']])
+            quantity = numbers['quantity'][current_row - start_row]
+            price_per_unit = numbers['price'][current_row - start_row]
+            volume = numbers['volume'][current_row - start_row]
             
             print(f"\nFound values for {product_info['product_code']}:")
             print(f"Quantity: {quantity} (col {column_indices['quantity']})")
@@ -655,8 +867,14 @@ def process_excel_data(df):
             
             # Only add product if we have at least a product code and either quantity or price
             if product_info['product_code'] and (quantity > 0 or price_per_unit > 0):
+                for field in failed:
+                    if failed[field][current_row - start_row]:
+                        parse_failures[field] += 1
+                        print(f"Could not parse {field} value {row[column_indices[field]]!r}, using 0")
                 product = {
                     'name': f"{product_info['product_code']} - {product_info['item_number']}",
+                    'product_code': product_info['product_code'],
+                    'item_number': product_info['item_number'],
                     'description': product_info['description'],
                     'quantity': quantity,
                     'total_volume': volume,
@@ -687,6 +905,7 @@ def process_excel_data(df):
     
     return {
         'products': products,
+        'parse_failures': parse_failures,
         'columns_found': {
             'name': 'Product Code & Item No.',
             'quantity': f'Column {column_indices["quantity"]} (QTY(PCS))',
@@ -695,6 +914,127 @@ def process_excel_data(df):
         }
     }
 
+# --- BEGIN: Spreadsheet ingestion ---
+# Every parser reads uploads through read_table(), so CSV/TSV and ODS files go
+# through the same header detection and extraction as Excel workbooks.
+SPREADSHEET_EXTENSIONS = ('.xls', '.xlsx', '.ods')
+DELIMITED_EXTENSIONS = ('.csv', '.tsv')
+UPLOAD_EXTENSIONS = SPREADSHEET_EXTENSIONS + DELIMITED_EXTENSIONS
+
+def is_delimited(filepath):
+    return filepath.lower().endswith(DELIMITED_EXTENSIONS)
+
+def upload_filename(filename):
+    """
+    A safe name to save an upload under, keeping the extension read_table() goes by.
+    secure_filename() drops non-ASCII characters, so "发票.csv" would come out as "csv";
+    such stems are replaced by a hash of the original.
+    """
+    stem, extension = os.path.splitext(filename)
+    safe_stem = secure_filename(stem) or hashlib.sha1(stem.encode('utf-8')).hexdigest()[:16]
+    return safe_stem + extension.lower()
+
+def decodes_as(sample, encoding):
+    """True if `sample` is valid in `encoding`, allowing a character cut off at the end of the sample."""
+    try:
+        sample.decode(encoding)
+        return True
+    except UnicodeDecodeError as e:
+        return e.start >= len(sample) - 4
+
+def detect_encoding(sample):
+    """
+    Encoding of a CSV export from its first bytes: a BOM, BOM-less UTF-16 (NUL bytes
+    between ASCII characters), UTF-8, then GB18030 (a superset of GBK) for Chinese systems.
+    """
+    if sample.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    if sample[1::2].count(0) > len(sample) // 4:
+        return 'utf-16-le'
+    if sample[0::2].count(0) > len(sample) // 4:
+        return 'utf-16-be'
+    for encoding in ('utf-8', 'gb18030'):
+        if decodes_as(sample, encoding):
+            return encoding
+    return 'latin-1'
+
+def detect_delimiter(text, filepath):
+    """Field delimiter of a CSV export (.tsv files are always tab-separated)."""
+    if filepath.lower().endswith('.tsv'):
+        return '\t'
+    try:
+        return csv.Sniffer().sniff(text, delimiters=',;\t|').delimiter
+    except csv.Error:
+        # Title lines often confuse the sniffer - fall back to the most frequent candidate
+        return max(',;\t|', key=text.count)
+
+def read_delimited(filepath, nrows=None):
+    """
+    A CSV/TSV file as a header=None DataFrame of strings (blank cells are None, like empty
+    Excel cells). Rows are streamed through csv.reader with the detected encoding and delimiter.
+    """
+    with open(filepath, 'rb') as f:
+        sample = f.read(64 * 1024)
+    encoding = detect_encoding(sample)
+    # The sniffer is regex-heavy; the first lines are enough to tell the delimiter
+    delimiter = detect_delimiter(sample[:8192].decode(encoding, errors='ignore'), filepath)
+    with open(filepath, newline='', encoding=encoding, errors='replace') as f:
+        rows = csv.reader(f, delimiter=delimiter)
+        if nrows is not None:
+            rows = itertools.islice(rows, nrows)
+        data = [[cell if cell.strip() else None for cell in row] for row in rows]
+    # Rows shorter than the widest one are padded with None
+    return pd.DataFrame(data, dtype=object)
+
+def spreadsheet_engine(filepath):
+    """pandas engine for a workbook (None lets pandas pick xlrd/openpyxl)."""
+    return 'odf' if filepath.lower().endswith('.ods') else None
+
+def read_table(filepath, sheet_name=0, nrows=None, workbook=None):
+    """
+    One sheet of an uploaded Excel, ODS, CSV or TSV file as a header=None DataFrame,
+    read from `workbook` when the file is already open (see open_workbook).
+    """
+    if is_delimited(filepath):
+        return read_delimited(filepath, nrows)
+    try:
+        return pd.read_excel(filepath if workbook is None else workbook, sheet_name=sheet_name, header=None,
+                             nrows=nrows, engine=spreadsheet_engine(filepath))
+    except ImportError:
+        if spreadsheet_engine(filepath) == 'odf':
+            raise ValueError("Reading .ods files requires odfpy (pip install odfpy)")
+        raise
+
+@contextmanager
+def open_workbook(filepath):
+    """
+    The upload as an open pd.ExcelFile, so several sheets are read without opening it
+    again (xlrd parses a whole .xls on every open). None for a CSV/TSV file.
+    """
+    if is_delimited(filepath):
+        yield None
+        return
+    try:
+        workbook = pd.ExcelFile(filepath, engine=spreadsheet_engine(filepath))
+    except ImportError:
+        if spreadsheet_engine(filepath) == 'odf':
+            raise ValueError("Reading .ods files requires odfpy (pip install odfpy)")
+        raise
+    with workbook:
+        yield workbook
+
+def list_sheets(filepath, workbook=None):
+    """Sheet names of an upload (of `workbook` if already open); a CSV/TSV file is one sheet named after the file."""
+    if is_delimited(filepath):
+        return [os.path.basename(filepath)]
+    if workbook is not None:
+        return workbook.sheet_names
+    with open_workbook(filepath) as workbook:
+        return workbook.sheet_names
+# --- END: Spreadsheet ingestion ---
+
 def analyze_excel_structure(filepath):
     """
     Analyze the structure of an Excel file to help understand its format.
@@ -705,7 +1045,10 @@ def analyze_excel_structure(filepath):
         # Read the Excel file with fallback for format detection
         df = None
         try:
-            if filepath.endswith('.xls'):
+            if not filepath.endswith(('.xls', '.xlsx')):
+                # CSV/TSV/ODS
+                df = read_table(filepath)
+            elif filepath.endswith('.xls'):
                 # Try xlrd first for .xls files
                 df = pd.read_excel(filepath, header=None, engine='xlrd')
             else:
@@ -743,95 +1086,44 @@ def analyze_excel_structure(filepath):
                     row_data.append(f"Col{col_idx}: <empty>")
             print(f"Row {idx}: {row_data}")
         
+        # The report below only covers the first 20 rows, so only those are profiled
+        profile = SheetProfile(df.iloc[:20])
+        
         # Look for potential header rows with more flexible patterns
         print("\nSearching for potential header rows...")
         header_candidates = []
-        
+        keyword_cells = profile.keyword_hits(HEADER_KEYWORDS)
         for idx in range(min(15, len(df))):
-            row = df.iloc[idx]
-            if pd.isna(row[0]):
-                continue
-                
-            # Check all columns in this row for header-like content
-            header_score = 0
-            header_content = []
-            
-            for col_idx, value in enumerate(row):
-                if pd.notna(value):
-                    value_str = str(value).strip().upper()
-                    # Look for common header keywords
-                    header_keywords = [
-                        'ITEM', 'NO', 'NUMBER', 'PRODUCT', 'DESCRIPTION', 'NAME',
-                        'QTY', 'QUANTITY', 'PCS', 'PIECES', 'UNITS',
-                        'PRICE', 'COST', 'AMOUNT', 'USD', '$', 'UNIT PRICE',
-                        'CBM', 'VOLUME', 'SIZE', 'DIMENSION', 'M3', 'CUBIC',
-                        'TOTAL', 'SUM', 'GRAND'
-                    ]
-                    
-                    for keyword in header_keywords:
-                        if keyword in value_str:
-                            header_score += 1
-                            header_content.append(f"Col{col_idx}: {value_str}")
-                            break
-            
-            if header_score >= 2:  # At least 2 columns look like headers
+            header_score = int(keyword_cells[idx].sum())
+            if profile.present[idx, 0] and header_score >= 2:  # At least 2 columns look like headers
+                header_content = [f"Col{col_idx}: {profile.text(col_idx).iat[idx]}"
+                                  for col_idx in np.flatnonzero(keyword_cells[idx])]
                 header_candidates.append((idx, header_score, header_content))
                 print(f"Row {idx} - Score {header_score}: {header_content}")
         
         # Look for numeric data patterns in each column
         print("\nAnalyzing numeric data patterns...")
-        for col_idx in range(min(7, len(df.columns))):
-            numeric_count = 0
-            integer_count = 0
-            decimal_count = 0
-            total_count = 0
-            sample_values = []
-            
-            for row_idx in range(1, min(20, len(df))):  # Skip first row, check next 19
-                if pd.notna(df.iloc[row_idx, col_idx]):
-                    total_count += 1
-                    try:
-                        val = float(df.iloc[row_idx, col_idx])
-                        numeric_count += 1
-                        sample_values.append(val)
-                        
-                        if val == int(val):
-                            integer_count += 1
-                        else:
-                            decimal_count += 1
-                    except:
-                        pass
-            
-            if total_count > 0:
-                numeric_ratio = numeric_count / total_count
-                integer_ratio = integer_count / total_count if numeric_count > 0 else 0
-                decimal_ratio = decimal_count / total_count if numeric_count > 0 else 0
-                
-                print(f"Column {col_idx}: {numeric_ratio:.1%} numeric ({integer_ratio:.1%} integers, {decimal_ratio:.1%} decimals)")
-                print(f"  Sample values: {sample_values[:5]}")
+        columns = profile.columns(slice(1, 20))  # Skip first row, check next 19
+        for col_idx, stats in columns.head(7).iterrows():
+            if stats['cells'] > 0:
+                decimal_ratio = stats['numeric_ratio'] - stats['integer_ratio']
+                print(f"Column {col_idx}: {stats['numeric_ratio']:.1%} numeric ({stats['integer_ratio']:.1%} integers, "
+                      f"{decimal_ratio:.1%} decimals), {stats['mean_length']:.0f} characters on average")
+                if stats['numeric_ratio'] > 0:
+                    print(f"  Range: {stats['min']:g} to {stats['max']:g}")
+                sample_values = profile.values[1:20, col_idx]
+                print(f"  Sample values: {sample_values[~np.isnan(sample_values)][:5].tolist()}")
         
         # Look for product-like rows (rows with alphanumeric content in first column)
         print("\nSearching for product-like rows...")
         product_candidates = []
-        for idx in range(1, min(20, len(df))):  # Skip first row
-            row = df.iloc[idx]
-            if pd.notna(row[0]):
-                first_col = str(row[0]).strip()
-                # Check if first column contains alphanumeric content (potential product code)
-                if any(c.isalnum() for c in first_col) and len(first_col) > 2:
-                    # Check if this row has some numeric data
-                    numeric_in_row = 0
-                    for col_idx, val in enumerate(row[1:], 1):  # Check other columns
-                        if pd.notna(val):
-                            try:
-                                float(val)
-                                numeric_in_row += 1
-                            except:
-                                pass
-                    
-                    if numeric_in_row > 0:
-                        product_candidates.append((idx, first_col, numeric_in_row))
-                        print(f"Row {idx}: '{first_col[:30]}...' - {numeric_in_row} numeric columns")
+        # Rows whose first column could be a product code, with numbers in the other columns
+        product_like = profile.matches(r'[^\W_]', 0) & (profile.lengths(0) > 2)
+        numeric_in_rows = profile.row_numbers - profile.numeric[:, 0]
+        for idx in np.flatnonzero(product_like[1:] & (numeric_in_rows[1:] > 0)) + 1:  # Skip first row
+            first_col = str(df.iat[idx, 0]).strip()
+            product_candidates.append((idx, first_col, int(numeric_in_rows[idx])))
+            print(f"Row {idx}: '{first_col[:30]}...' - {numeric_in_rows[idx]} numeric columns")
         
         return df
         
@@ -839,7 +1131,139 @@ def analyze_excel_structure(filepath):
         print(f"Error analyzing Excel file: {str(e)}")
         return None
 
+# --- BEGIN: Currency conversion ---
+CURRENCIES = ['ILS', 'USD', 'CNY', 'EUR', 'HKD']
+CURRENCY_ALIASES = {'RMB': 'CNY', 'NIS': 'ILS'}
+CURRENCY_INDEX = {code: idx for idx, code in enumerate(CURRENCIES)}
+CURRENCY_INDEX.update({alias: CURRENCY_INDEX[code] for alias, code in CURRENCY_ALIASES.items()})
+
+def currency_index(currency):
+    """Row/column of a currency code (or alias like RMB) in a CrossRates matrix. Raises ValueError."""
+    try:
+        return CURRENCY_INDEX[(currency or 'USD').strip().upper()]
+    except KeyError:
+        raise ValueError(f"Unsupported currency {currency}")
+
+class CrossRates:
+    """
+    Every exchange rate between CURRENCIES as one N×N matrix:
+    matrix[i, j] is the price of one unit of currency i in currency j (NaN if unknown).
+    """
+    def __init__(self, values, source=None, fetched_at=None):
+        # values[i]: worth of one unit of currency i in any common base currency, 0 if unknown
+        self.values = np.asarray(values, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            matrix = self.values[:, None] / self.values[None, :]
+        matrix[~np.isfinite(matrix) | (matrix == 0)] = np.nan
+        self.matrix = matrix
+        self.source = source
+        self.fetched_at = fetched_at
+
+    @classmethod
+    def from_usd_quotes(cls, quotes, source=None, fetched_at=None):
+        """From {currency: units per 1 USD}, as the exchange-rate APIs return them."""
+        values = [1.0 if code == 'USD' else (1 / quotes[code] if quotes.get(code) else 0)
+                  for code in CURRENCIES]
+        return cls(values, source, fetched_at)
+
+    def rate(self, from_currency, to_currency):
+        """Price of one unit of `from_currency` in `to_currency`, or None if unknown."""
+        rate = self.matrix[currency_index(from_currency), currency_index(to_currency)]
+        return None if np.isnan(rate) else float(rate)
+
+    def pairs(self, targets=('ILS', 'USD')):
+        """Known rates into each target currency as {'CNY_ILS': rate, ...}."""
+        pairs = {}
+        for target in targets:
+            for code in CURRENCIES:
+                rate = self.rate(code, target) if code != target else None
+                if rate is not None:
+                    pairs[f"{code}_{target}"] = rate
+        return pairs
+
+cross_rates_cache = OrderedDict()   # (source, fetched_at) -> CrossRates
+latest_cross_rates = None           # built from the most recent successful fetch
+
+def cross_rates_for(data, source, fetched_at):
+    """The CrossRates of one rate fetch; built once, then reused while the response stays cached."""
+    global latest_cross_rates
+    key = (source, fetched_at)
+    cross_rates = cross_rates_cache.get(key)
+    if cross_rates is None:
+        cross_rates = CrossRates.from_usd_quotes(data['rates'], source, fetched_at)
+        cross_rates_cache[key] = cross_rates
+        while len(cross_rates_cache) > 8:
+            cross_rates_cache.popitem(last=False)
+    if latest_cross_rates is None or fetched_at >= (latest_cross_rates.fetched_at or 0):
+        latest_cross_rates = cross_rates
+    return cross_rates
+
+def market_ils_rate(currency):
+    """ILS per unit of `currency` from the latest fetched rates, else the last stored rate; None if unknown."""
+    code = CURRENCIES[currency_index(currency)]
+    if latest_cross_rates is not None:
+        rate = latest_cross_rates.rate(code, 'ILS')
+        if rate is not None:
+            return rate
+    stored = stored_rate(f"{code}_ILS")
+    return stored['rate'] if stored else None
+# --- END: Currency conversion ---
+
+# --- BEGIN: Fixed-point money ---
+# Rates, prices, duty/VAT rates and volumes are held in millionths; money in agorot
+MICRO = 1000000
+
+def to_fixed(values, scale):
+    """Non-negative amounts as int64 multiples of 1/scale, rounded half up."""
+    return np.floor(np.asarray(values, dtype=float) * scale + 0.5).astype(np.int64)
+
+def scaled_product(a, b, scale):
+    """
+    round(a * b / scale), half up, for non-negative int64 values. `a` is split at `scale`,
+    so the largest intermediate is (scale - 1) * b rather than a * b.
+    """
+    high, low = np.divmod(a, scale)
+    return high * b + (low * b + scale // 2) // scale
+
+def allocate(total, weights):
+    """
+    Split the integer `total` in proportion to int64 `weights` with largest-remainder rounding:
+    each share is the floor or ceiling of its exact value and the shares add up to `total`.
+    """
+    weight_sum = int(weights.sum())
+    whole, part = divmod(total, weight_sum)
+    shares = whole * weights + (part * weights) // weight_sum
+    remainders = (part * weights) % weight_sum
+    shortfall = total - int(shares.sum())
+    if shortfall:
+        shares[np.argsort(-remainders, kind='stable')[:shortfall]] += 1
+    return shares
+
+def split_per_unit(components, quantity):
+    """
+    Per-unit values of each line's cost components (lines x components, int64), rounded with
+    largest remainders within the line so they add up to the line total per unit, rounded half up.
+    Lines without quantity get zeros.
+    """
+    divisor = np.maximum(quantity, 1)
+    floors, remainders = np.divmod(components, divisor[:, None])
+    target = (components.sum(axis=1) + divisor // 2) // divisor
+    shortfall = target - floors.sum(axis=1)
+    ranks = np.argsort(np.argsort(-remainders, axis=1, kind='stable'), axis=1)
+    per_unit = floors + (ranks < shortfall[:, None])
+    per_unit[quantity <= 0] = 0
+    return per_unit
+# --- END: Fixed-point money ---
+
 class ContainerCalculator:
+    # Per-product result columns, in the order they appear in each result row
+    COST_COLUMNS = [
+        'original_cost_per_unit_ils', 'shipping_cost_per_unit_ils', 'local_transportation_per_unit_ils',
+        'unloading_per_unit_ils', 'additional_fees_per_unit_ils', 'final_cost_per_unit_ils',
+        'final_cost_per_unit_with_vat_ils', 'vat_per_unit_ils', 'shipping_cost_ils', 'local_transportation_ils',
+        'unloading_cost_ils', 'additional_fees_ils', 'duty_per_unit_ils', 'duty_ils', 'total_cost_ils'
+    ]
+
     def __init__(self):
         self.container_cost_usd = 0
         self.container_volume = 0
@@ -849,19 +1273,25 @@ class ContainerCalculator:
         self.local_transportation_ils = 0
         self.unloading_cost_ils = 0
         self.additional_fees_ils = 0
+        self.exchange_rates = {}   # ILS per unit of other currencies (EUR, HKD...)
+        self.tariffs = None   # TariffTable for per-product customs duty by HS code
+        self.exact = False    # integer agorot instead of floats (calculate_columns_exact)
         self.products = []
 
-    def add_product(self, name, quantity, total_volume, cost_per_unit, currency='USD'):
+    def add_product(self, name, quantity, total_volume, cost_per_unit, currency='USD', hs_code=''):
         self.products.append({
             'name': name,
             'quantity': quantity,
             'total_volume': total_volume,
             'volume_per_unit': total_volume / quantity if quantity > 0 else 0,
             'cost_per_unit': cost_per_unit,
-            'currency': currency
+            'currency': currency,
+            'currency_index': currency_index(currency),
+            'hs_code': hs_code or ''
         })
 
-    def calculate_costs(self):
+    def prepare(self):
+        """Validate the inputs. Returns (currency_indices, conversion_rate, duty_rate) arrays."""
         total_volume = sum(p['total_volume'] for p in self.products)
         if total_volume > self.container_volume:
             raise ValueError("Total product volume exceeds container volume")
@@ -870,88 +1300,218 @@ class ContainerCalculator:
         if self.usd_to_ils_rate == 0 and self.rmb_to_ils_rate == 0:
             raise ValueError("No valid exchange rate provided.")
 
+        # Determine conversion rate: ILS per unit of each currency, indexed per product (the
+        # ILS column of CrossRates, without building the N×N matrix for every calculation)
+        ils_values = np.zeros(len(CURRENCIES))
+        for currency, rate in self.exchange_rates.items():
+            ils_values[currency_index(currency)] = rate
+        ils_values[currency_index('ILS')] = 1
+        ils_values[currency_index('USD')] = self.usd_to_ils_rate
+        ils_values[currency_index('RMB')] = self.rmb_to_ils_rate
+        currency_indices = np.array([p['currency_index'] for p in self.products], dtype=int)
+        conversion_rate = ils_values[currency_indices]
+        conversion_rate[~np.isfinite(conversion_rate)] = 0
+        if not conversion_rate.all():
+            missing = self.products[int(np.argmin(conversion_rate != 0))]['currency']
+            raise ValueError(f"Missing conversion rate for currency {missing}")
+
+        # Customs duty rate per product, from its HS code (0 without a code or tariff match)
+        hs_codes = [p['hs_code'] for p in self.products]
+        if self.tariffs is not None and any(hs_codes):
+            duty_rate = np.array(self.tariffs.duty_rates(hs_codes), dtype=float)
+        else:
+            duty_rate = np.zeros(len(self.products))
+        return currency_indices, conversion_rate, duty_rate
+
+    def calculate_columns(self):
+        """
+        Unrounded per-product results as NumPy arrays in product order: every COST_COLUMNS
+        entry plus the inputs (quantity, total_volume, cost_per_unit, currency_index),
+        duty_rate and shipping_cost_usd.
+        """
+        if self.exact:
+            return self.calculate_columns_exact()
+        total_volume = sum(p['total_volume'] for p in self.products)
+        currency_indices, conversion_rate, duty_rate = self.prepare()
+
+        # All products in one pass: each array holds one value per product
+        quantity = np.array([p['quantity'] for p in self.products], dtype=float)
+        product_volume = np.array([p['total_volume'] for p in self.products], dtype=float)
+        cost_per_unit = np.array([p['cost_per_unit'] for p in self.products], dtype=float)
+        has_quantity = quantity > 0
+
+        def per_unit(values):
+            return np.divide(values, quantity, out=np.zeros_like(values), where=has_quantity)
+
+        volume_ratio = product_volume / total_volume if total_volume > 0 else np.zeros_like(product_volume)
+        shipping_cost_usd = self.container_cost_usd * volume_ratio
+        shipping_cost_per_unit_usd = per_unit(shipping_cost_usd)
+
+        # Convert product cost to ILS
+        original_cost_per_unit_ils = cost_per_unit * conversion_rate
+        shipping_cost_per_unit_ils = shipping_cost_per_unit_usd * self.usd_to_ils_rate  # Shipping is always in USD
+        shipping_cost_ils = shipping_cost_usd * self.usd_to_ils_rate
+
+        # Local costs in ILS
+        local_transportation_ils = self.local_transportation_ils * volume_ratio
+        unloading_ils = self.unloading_cost_ils * volume_ratio
+        additional_fees_ils = self.additional_fees_ils * volume_ratio
+
+        local_transportation_per_unit_ils = per_unit(local_transportation_ils)
+        unloading_per_unit_ils = per_unit(unloading_ils)
+        additional_fees_per_unit_ils = per_unit(additional_fees_ils)
+
+        # Duty is charged on the CIF value: goods plus international shipping
+        total_original_cost_ils = cost_per_unit * quantity * conversion_rate
+        duty_per_unit_ils = (original_cost_per_unit_ils + shipping_cost_per_unit_ils) * duty_rate
+        duty_ils = (total_original_cost_ils + shipping_cost_ils) * duty_rate
+
+        # Final cost per unit in ILS
+        final_cost_per_unit_ils = (original_cost_per_unit_ils +
+                                   shipping_cost_per_unit_ils +
+                                   local_transportation_per_unit_ils +
+                                   unloading_per_unit_ils +
+                                   additional_fees_per_unit_ils +
+                                   duty_per_unit_ils)
+        vat_per_unit_ils = final_cost_per_unit_ils * self.import_tax_rate
+        final_cost_per_unit_with_vat_ils = final_cost_per_unit_ils + vat_per_unit_ils
+
+        # Totals for each product
+        total_product_cost_ils = (shipping_cost_ils +
+                                  local_transportation_ils +
+                                  unloading_ils +
+                                  additional_fees_ils +
+                                  duty_ils +
+                                  total_original_cost_ils)
+
+        return {
+            'quantity': quantity,
+            'total_volume': product_volume,
+            'cost_per_unit': cost_per_unit,
+            'currency_index': currency_indices,
+            'duty_rate': duty_rate,
+            'shipping_cost_usd': shipping_cost_usd,
+            'original_cost_per_unit_ils': original_cost_per_unit_ils,
+            'shipping_cost_per_unit_ils': shipping_cost_per_unit_ils,
+            'local_transportation_per_unit_ils': local_transportation_per_unit_ils,
+            'unloading_per_unit_ils': unloading_per_unit_ils,
+            'additional_fees_per_unit_ils': additional_fees_per_unit_ils,
+            'final_cost_per_unit_ils': final_cost_per_unit_ils,
+            'final_cost_per_unit_with_vat_ils': final_cost_per_unit_with_vat_ils,
+            'vat_per_unit_ils': vat_per_unit_ils,
+            'shipping_cost_ils': shipping_cost_ils,
+            'local_transportation_ils': local_transportation_ils,
+            'unloading_cost_ils': unloading_ils,
+            'additional_fees_ils': additional_fees_ils,
+            'duty_per_unit_ils': duty_per_unit_ils,
+            'duty_ils': duty_ils,
+            'total_cost_ils': total_product_cost_ils
+        }
+
+    def calculate_columns_exact(self):
+        """
+        calculate_columns() in integer fixed point: money in int64 agorot, rates, prices and
+        volumes in millionths. Container, local, unloading and fee costs are split by volume
+        with largest-remainder rounding, so the product lines add up exactly to the shipment
+        totals. Returns ILS float arrays (agorot / 100) like calculate_columns(), with the
+        agorot themselves under 'agorot' instead of shipping_cost_usd.
+        """
+        currency_indices, conversion_rate, duty_rate = self.prepare()
+        quantity = np.array([p['quantity'] for p in self.products], dtype=np.int64)
+        product_volume = np.array([p['total_volume'] for p in self.products], dtype=float)
+        cost_per_unit = np.array([p['cost_per_unit'] for p in self.products], dtype=float)
+        volume = to_fixed(product_volume, MICRO)
+        if not volume.any():
+            raise ValueError("Total volume cannot be zero. Please check your product data.")
+        usd_to_ils = int(to_fixed(self.usd_to_ils_rate, MICRO))
+
+        # Goods: price (millionths) x quantity x rate (millionths) -> agorot
+        price, conversion = to_fixed(cost_per_unit, MICRO), to_fixed(conversion_rate, MICRO)
+        goods = scaled_product(price * quantity, conversion, MICRO * MICRO // 100)
+        shipping = allocate(int(scaled_product(int(to_fixed(self.container_cost_usd, 100)), usd_to_ils, MICRO)),
+                            volume)
+        local_transportation = allocate(int(to_fixed(self.local_transportation_ils, 100)), volume)
+        unloading = allocate(int(to_fixed(self.unloading_cost_ils, 100)), volume)
+        additional_fees = allocate(int(to_fixed(self.additional_fees_ils, 100)), volume)
+        # Duty is charged on the CIF value: goods plus international shipping
+        duty_rate_fixed = to_fixed(duty_rate, MICRO)
+        duty = scaled_product(goods + shipping, duty_rate_fixed, MICRO)
+
+        components = np.stack([goods, shipping, local_transportation, unloading, additional_fees, duty], axis=1)
+        per_unit = split_per_unit(components, quantity)
+        # Lines without a quantity still show the converted unit price and its duty, as in calculate_columns()
+        no_quantity = quantity <= 0
+        if no_quantity.any():
+            unit_goods = scaled_product(price, conversion, MICRO * MICRO // 100)
+            per_unit[no_quantity, 0] = unit_goods[no_quantity]
+            per_unit[no_quantity, 5] = scaled_product(unit_goods, duty_rate_fixed, MICRO)[no_quantity]
+        final_per_unit = per_unit.sum(axis=1)
+        vat_per_unit = scaled_product(final_per_unit, int(to_fixed(self.import_tax_rate, MICRO)), MICRO)
+
+        agorot = {
+            'original_cost_per_unit_ils': per_unit[:, 0],
+            'shipping_cost_per_unit_ils': per_unit[:, 1],
+            'local_transportation_per_unit_ils': per_unit[:, 2],
+            'unloading_per_unit_ils': per_unit[:, 3],
+            'additional_fees_per_unit_ils': per_unit[:, 4],
+            'final_cost_per_unit_ils': final_per_unit,
+            'final_cost_per_unit_with_vat_ils': final_per_unit + vat_per_unit,
+            'vat_per_unit_ils': vat_per_unit,
+            'shipping_cost_ils': shipping,
+            'local_transportation_ils': local_transportation,
+            'unloading_cost_ils': unloading,
+            'additional_fees_ils': additional_fees,
+            'duty_per_unit_ils': per_unit[:, 5],
+            'duty_ils': duty,
+            'total_cost_ils': components.sum(axis=1)
+        }
+        columns = {name: values / 100 for name, values in agorot.items()}
+        columns.update({
+            'quantity': quantity.astype(float),
+            'total_volume': product_volume,
+            'cost_per_unit': cost_per_unit,
+            'currency_index': currency_indices,
+            'duty_rate': duty_rate,
+            'agorot': agorot
+        })
+        return columns
+
+    def calculate_costs(self):
+        arrays = self.calculate_columns()
+        total_volume = sum(p['total_volume'] for p in self.products)
+
+        # Back to plain floats; Python's round() keeps the exact rounding of the per-product loop
+        columns = {name: arrays[name].tolist() for name in self.COST_COLUMNS}
+        duty_rates = arrays['duty_rate'].tolist()
+
         results = []
-        total_shipping_usd = 0
-        total_import_tax_ils = 0
-        total_local_transportation_ils = 0
-        total_unloading_ils = 0
-        total_additional_fees_ils = 0
-        total_cost_ils = 0
-
-        for product in self.products:
-            volume_ratio = product['total_volume'] / total_volume if total_volume > 0 else 0
-            shipping_cost_usd = self.container_cost_usd * volume_ratio
-            shipping_cost_per_unit_usd = shipping_cost_usd / product['quantity'] if product['quantity'] > 0 else 0
-
-            # Determine conversion rate
-            if product['currency'] == 'RMB':
-                conversion_rate = self.rmb_to_ils_rate
-            else:
-                conversion_rate = self.usd_to_ils_rate
-            if conversion_rate == 0:
-                raise ValueError(f"Missing conversion rate for currency {product['currency']}")
-
-            # Convert product cost to ILS
-            original_cost_per_unit_ils = product['cost_per_unit'] * conversion_rate
-            shipping_cost_per_unit_ils = shipping_cost_per_unit_usd * self.usd_to_ils_rate  # Shipping is always in USD
-
-            # Local costs in ILS
-            local_transportation_ils = self.local_transportation_ils * volume_ratio
-            unloading_ils = self.unloading_cost_ils * volume_ratio
-            additional_fees_ils = self.additional_fees_ils * volume_ratio
-
-            local_transportation_per_unit_ils = local_transportation_ils / product['quantity'] if product['quantity'] > 0 else 0
-            unloading_per_unit_ils = unloading_ils / product['quantity'] if product['quantity'] > 0 else 0
-            additional_fees_per_unit_ils = additional_fees_ils / product['quantity'] if product['quantity'] > 0 else 0
-
-            # Final cost per unit in ILS
-            final_cost_per_unit_ils = (original_cost_per_unit_ils +
-                                       shipping_cost_per_unit_ils +
-                                       local_transportation_per_unit_ils +
-                                       unloading_per_unit_ils +
-                                       additional_fees_per_unit_ils)
-            vat_per_unit_ils = final_cost_per_unit_ils * self.import_tax_rate
-            final_cost_per_unit_with_vat_ils = final_cost_per_unit_ils + vat_per_unit_ils
-
-            # Totals for this product
-            total_product_cost_ils = (shipping_cost_usd * self.usd_to_ils_rate +
-                                      local_transportation_ils +
-                                      unloading_ils +
-                                      additional_fees_ils)
-            
-            # Add the original product cost converted to ILS
-            total_original_cost_ils = product['cost_per_unit'] * product['quantity'] * conversion_rate
-            total_product_cost_ils += total_original_cost_ils
-
-            total_shipping_usd += shipping_cost_usd
-            total_import_tax_ils += vat_per_unit_ils * product['quantity']
-            total_local_transportation_ils += local_transportation_ils
-            total_unloading_ils += unloading_ils
-            total_additional_fees_ils += additional_fees_ils
-            total_cost_ils += total_product_cost_ils
-
-            results.append({
+        for idx, product in enumerate(self.products):
+            row = {
                 'name': product['name'],
                 'quantity': product['quantity'],
                 'total_volume': product['total_volume'],
-                'volume_per_unit': product['volume_per_unit'],
-                'original_cost_per_unit_ils': round(original_cost_per_unit_ils, 2),
-                'shipping_cost_per_unit_ils': round(shipping_cost_per_unit_ils, 2),
-                'local_transportation_per_unit_ils': round(local_transportation_per_unit_ils, 2),
-                'unloading_per_unit_ils': round(unloading_per_unit_ils, 2),
-                'additional_fees_per_unit_ils': round(additional_fees_per_unit_ils, 2),
-                'final_cost_per_unit_ils': round(final_cost_per_unit_ils, 2),
-                'final_cost_per_unit_with_vat_ils': round(final_cost_per_unit_with_vat_ils, 2),
-                'vat_per_unit_ils': round(vat_per_unit_ils, 2),
-                'shipping_cost_ils': round(shipping_cost_usd * self.usd_to_ils_rate, 2),
-                'local_transportation_ils': round(local_transportation_ils, 2),
-                'unloading_cost_ils': round(unloading_ils, 2),
-                'additional_fees_ils': round(additional_fees_ils, 2),
-                'total_cost_ils': round(total_product_cost_ils, 2),
-                'currency': product['currency']
-            })
+                'volume_per_unit': product['volume_per_unit']
+            }
+            for name, values in columns.items():
+                row[name] = round(values[idx], 2)
+            row['hs_code'] = product['hs_code']
+            row['duty_rate'] = duty_rates[idx]
+            row['currency'] = product['currency']
+            results.append(row)
 
-        # Add totals row
+        # Add totals row (sums are accumulated in product order, like the per-product loop did)
+        if 'agorot' in arrays:
+            # Fixed point: the totals are the exact sums of the product lines
+            totals = {name: int(values.sum()) / 100 for name, values in arrays['agorot'].items()}
+        else:
+            totals = {
+                'shipping_cost_ils': round(sum(arrays['shipping_cost_usd'].tolist()) * self.usd_to_ils_rate, 2),
+                'local_transportation_ils': round(sum(columns['local_transportation_ils']), 2),
+                'unloading_cost_ils': round(sum(columns['unloading_cost_ils']), 2),
+                'additional_fees_ils': round(sum(columns['additional_fees_ils']), 2),
+                'duty_ils': round(sum(columns['duty_ils']), 2),
+                'total_cost_ils': round(sum(columns['total_cost_ils']), 2)
+            }
         total_quantity = sum(p['quantity'] for p in self.products)
         results.append({
             'name': 'TOTALS',
@@ -966,17 +1526,221 @@ class ContainerCalculator:
             'final_cost_per_unit_ils': 0,
             'final_cost_per_unit_with_vat_ils': 0,
             'vat_per_unit_ils': 0,
-            'shipping_cost_ils': round(total_shipping_usd * self.usd_to_ils_rate, 2),
-            'local_transportation_ils': round(total_local_transportation_ils, 2),
-            'unloading_cost_ils': round(total_unloading_ils, 2),
-            'additional_fees_ils': round(total_additional_fees_ils, 2),
-            'total_cost_ils': round(total_cost_ils, 2),
+            'shipping_cost_ils': totals['shipping_cost_ils'],
+            'local_transportation_ils': totals['local_transportation_ils'],
+            'unloading_cost_ils': totals['unloading_cost_ils'],
+            'additional_fees_ils': totals['additional_fees_ils'],
+            'duty_per_unit_ils': 0,
+            'duty_ils': totals['duty_ils'],
+            'total_cost_ils': totals['total_cost_ils'],
             'is_total': True,
             'currency': ''
         })
 
         return results
 
+# --- BEGIN: Response compression ---
+@app.after_request
+def compress_response(response):
+    """gzip/brotli-compress large JSON responses, negotiated from Accept-Encoding."""
+    if (response.mimetype != 'application/json' or response.status_code != 200 or
+            response.direct_passthrough or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < app.config['COMPRESS_MIN_SIZE']:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted.quality('br') > 0:
+        response.set_data(brotli.compress(body, quality=app.config['COMPRESS_BROTLI_QUALITY']))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted.quality('gzip') > 0:
+        response.set_data(gzip.compress(body, compresslevel=app.config['COMPRESS_GZIP_LEVEL']))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+# --- END: Response compression ---
+
+# --- BEGIN: Admission control ---
+# Parse- and compute-heavy routes may only run ADMISSION_CLASSES[name]['limit'] at a time
+# across all workers of this deployment, with at most 'queue' more waiting up to 'wait'
+# seconds; anything beyond that is turned away at once with 503 and Retry-After, so
+# a burst of large uploads cannot occupy every worker and starve /, /calculate and the
+# rate routes. Slots are lock files under ADMISSION_FOLDER held with flock(), which the
+# OS releases if a worker dies mid-request.
+
+class Overloaded(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class AdmissionGate:
+    """Cross-process concurrency limit with a bounded wait queue for one class of routes."""
+    poll_interval = 0.05
+
+    def __init__(self, name, limit, queue, wait):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.wait = wait
+        self.lock = threading.Lock()
+        # Counters for this worker process
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = Counter()
+        self.average_seconds = None   # moving average of admitted requests' run time
+
+    def slot_paths(self, kind, count):
+        folder = app.config['ADMISSION_FOLDER']
+        return [os.path.join(folder, f"{self.name}.{kind}.{slot}") for slot in range(count)]
+
+    @staticmethod
+    def try_lock(paths):
+        """Hold the first free slot file in `paths`: returns its descriptor, or None if all are taken."""
+        for path in paths:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            # The holder's pid, so stats() can count held slots without taking them
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, str(os.getpid()).encode(), 0)
+            return fd
+        return None
+
+    @staticmethod
+    def unlock(fd):
+        os.ftruncate(fd, 0)
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    @staticmethod
+    def held(paths):
+        count = 0
+        for path in paths:
+            try:
+                with open(path) as f:
+                    pid = int(f.read() or 0)
+                if pid:
+                    os.kill(pid, 0)
+                    count += 1
+            except (OSError, ValueError):
+                pass
+        return count
+
+    def retry_after(self):
+        """Seconds until a slot is likely free: the queue ahead drained at the average run time."""
+        if self.average_seconds is None:
+            return app.config['ADMISSION_RETRY_AFTER']
+        waves = (self.queue + self.limit) / self.limit
+        return min(60, max(1, math.ceil(self.average_seconds * waves)))
+
+    def reject(self, reason):
+        with self.lock:
+            self.rejected[reason] += 1
+        print(f"Admission: rejected {request.path} ({self.name}, {reason})")
+        raise Overloaded(reason, self.retry_after())
+
+    def acquire(self):
+        """A running slot's descriptor, waiting in the queue if there is room. Raises Overloaded."""
+        fd = self.try_lock(self.slot_paths('run', self.limit))
+        if fd is None:
+            waiting = self.try_lock(self.slot_paths('wait', self.queue))
+            if waiting is None:
+                self.reject('queue_full')
+            with self.lock:
+                self.queued += 1
+            try:
+                deadline = time.monotonic() + self.wait
+                while fd is None and time.monotonic() < deadline:
+                    time.sleep(self.poll_interval)
+                    fd = self.try_lock(self.slot_paths('run', self.limit))
+            finally:
+                self.unlock(waiting)
+            if fd is None:
+                self.reject('timeout')
+        with self.lock:
+            self.admitted += 1
+        return fd
+
+    def release(self, fd, seconds):
+        self.unlock(fd)
+        with self.lock:
+            self.average_seconds = seconds if self.average_seconds is None else 0.8 * self.average_seconds + 0.2 * seconds
+
+    def stats(self):
+        return {
+            'limit': self.limit,
+            'queue': self.queue,
+            'running': self.held(self.slot_paths('run', self.limit)),
+            'waiting': self.held(self.slot_paths('wait', self.queue)),
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'rejected': dict(self.rejected),
+            'average_seconds': round(self.average_seconds, 3) if self.average_seconds is not None else None
+        }
+
+admission_gates = {}
+admission_endpoints = {}
+
+def admission_gate(endpoint):
+    """The AdmissionGate guarding a Flask endpoint, or None for unrestricted routes."""
+    if fcntl is None or not app.config['ADMISSION_ENABLED']:
+        return None
+    if not admission_gates:
+        os.makedirs(app.config['ADMISSION_FOLDER'], exist_ok=True)
+        for name, options in app.config['ADMISSION_CLASSES'].items():
+            admission_gates[name] = AdmissionGate(name, options['limit'], options['queue'], options['wait'])
+            admission_endpoints.update(dict.fromkeys(options['endpoints'], name))
+    name = admission_endpoints.get(endpoint)
+    return admission_gates[name] if name else None
+
+@app.before_request
+def admit_request():
+    gate = admission_gate(request.endpoint)
+    if gate is None:
+        return None
+    try:
+        g.admission_slot = (gate, gate.acquire(), time.perf_counter())
+    except Overloaded as e:
+        response = jsonify({'error': f'השרת עמוס כרגע, נסו שוב בעוד {e.retry_after} שניות', 'reason': e.reason})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    return None
+
+def release_slot(slot):
+    gate, fd, started = slot
+    gate.release(fd, time.perf_counter() - started)
+
+@app.after_request
+def hold_admission_while_streaming(response):
+    """A streamed body (generator, send_file) is produced after the view returns: keep the slot until it is sent."""
+    if response.is_streamed and 'admission_slot' in g:
+        slot = g.pop('admission_slot')
+        if response.direct_passthrough:
+            # Werkzeug hands a passthrough body to the server as is, without calling response.close()
+            response.response = ClosingIterator(response.response, lambda: release_slot(slot))
+        else:
+            response.call_on_close(lambda: release_slot(slot))
+    return response
+
+@app.teardown_request
+def release_admission(exc=None):
+    slot = g.pop('admission_slot', None)
+    if slot is not None:
+        release_slot(slot)
+
+def admission_stats():
+    if fcntl is None or not app.config['ADMISSION_ENABLED']:
+        return {'enabled': False}
+    admission_gate(None)
+    return dict({'enabled': True}, **{name: gate.stats() for name, gate in admission_gates.items()})
+# --- END: Admission control ---
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -1006,27 +1770,46 @@ def upload_file():
     if file.filename == '':
         return jsonify({'error': 'לא נבחר קובץ'}), 400
     
-    if not file.filename.endswith(('.xls', '.xlsx')):
-        return jsonify({'error': 'הקובץ חייב להיות בפורמט אקסל (.xls או .xlsx)'}), 400
+    if not file.filename.lower().endswith(UPLOAD_EXTENSIONS):
+        return jsonify({'error': 'הקובץ חייב להיות בפורמט אקסל (.xls או .xlsx), ODS או CSV/TSV'}), 400
+    try:
+        export_format = export_format_arg(request.form.get('format'))
+    except ValueError:
+        return jsonify({'error': 'פורמט ייצוא לא נתמך'}), 400
+    if export_format != 'json' and not pyarrow_available():
+        return jsonify({'error': PYARROW_MISSING}), 501
     
+    timings = {}
     try:
         # Save the file temporarily
-        filename = secure_filename(file.filename)
+        filename = upload_filename(file.filename)
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
         
         print(f"\nReading Excel file: {filename}")
         
         # First, analyze the file structure
+        stage_start = time.perf_counter()
         df = analyze_excel_structure(filepath)
+        timings['analyze_structure'] = time.perf_counter() - stage_start
         if df is None:
+            maybe_capture_upload(filepath, 'upload', timings, error='Could not read Excel file')
+            os.remove(filepath)
             return jsonify({'error': 'שגיאה בקריאת קובץ אקסל'}), 500
         
         # Process the data using the DataFrame from analyze_excel_structure
+        stage_start = time.perf_counter()
         result = process_excel_data(df)
+        timings['process_data'] = time.perf_counter() - stage_start
+        maybe_capture_upload(filepath, 'upload', timings, products=result['products'])
+        record_skus(result['products'], supplier=filename)
         
         # Clean up
+        file_hash = file_sha256(filepath)
         os.remove(filepath)
+        if export_format != 'json':
+            return columnar_response(products_table(result['products']), export_format,
+                                     os.path.splitext(filename)[0])
         
         # Format the response with a more informative message
         total_products = len(result['products'])
@@ -1039,7 +1822,9 @@ def upload_file():
             'message': message,
             'products': result['products'],
             'columns_found': result['columns_found'],
-            'total_products': total_products
+            'parse_failures': result.get('parse_failures', {}),
+            'total_products': total_products,
+            'file_hash': file_hash
         }
         
         return jsonify(response)
@@ -1047,68 +1832,899 @@ def upload_file():
     except Exception as e:
         print(f"Error processing file: {str(e)}")
         if 'filepath' in locals() and os.path.exists(filepath):
+            maybe_capture_upload(filepath, 'upload', timings, error=e)
             os.remove(filepath)
         return jsonify({'error': f'שגיאה בעיבוד הקובץ: {str(e)}'}), 500
 
-@app.route('/calculate', methods=['POST'])
-def calculate():
-    """Calculate shipping costs and display results."""
-    try:
-        # Get JSON data from request
-        data = request.get_json()
+# --- BEGIN: /calculate result cache ---
+CALCULATION_SETTINGS = [
+    # (request field, default - None means required)
+    ('container_cost_usd', None),
+    ('container_volume', None),
+    ('import_tax_rate', None),
+    ('usd_to_ils_rate', None),
+    ('rmb_to_ils_rate', 0),
+    ('local_transportation_ils', 0),
+    ('unloading_cost_ils', 0),
+    ('additional_fees_ils', 0)
+]
+
+def normalize_float(value):
+    """Coerce to float and drop binary noise, so 0.1 + 0.2 and 0.3 hash the same."""
+    return round(float(value), 10)
+
+def parse_calculation_request(data):
+    """
+    Validate and normalize a /calculate request body.
+    Returns (settings, products) where products are (name, quantity, total_volume,
+    cost_per_unit, currency, hs_code) tuples in request order. Raises KeyError/ValueError.
+    Currencies other than USD, RMB and ILS take their ILS rate from `exchange_rates`
+    ({"EUR": 4.02}) or the latest market rate, recorded in settings['exchange_rates'].
+    """
+    settings = {}
+    for field, default in CALCULATION_SETTINGS:
+        settings[field] = normalize_float(data[field] if default is None else data.get(field, default))
+
+    products = []
+    for product in data['products']:
+        products.append((
+            product.get('name') or product.get('item'),
+            int(product['quantity']),
+            normalize_float(product['total_volume']),
+            normalize_float(product['cost_per_unit_usd']) if 'cost_per_unit_usd' in product else normalize_float(product['price']),
+            (product.get('currency') or 'USD').strip().upper(),
+            normalize_hs_code(product.get('hs_code'))
+        ))
+
+    exchange_rates = {}
+    requested_rates = {code.upper(): rate for code, rate in (data.get('exchange_rates') or {}).items()}
+    for currency in sorted({product[4] for product in products}):
+        code = CURRENCIES[currency_index(currency)]
+        if code in ('ILS', 'USD', 'CNY') or code in exchange_rates:
+            continue
+        rate = requested_rates.get(code) or market_ils_rate(code)
+        if rate:
+            exchange_rates[code] = normalize_float(rate)
+    if exchange_rates:
+        settings['exchange_rates'] = exchange_rates
+    # Integer agorot with lines that add up exactly to the totals (ContainerCalculator.exact)
+    if data.get('exact'):
+        settings['exact'] = True
+    return settings, products
+
+def calculation_key(settings, canonical_products, tariff_version=''):
+    """
+    Deterministic hash of a normalized calculation, the calculator version and, for
+    products with HS codes, the tariff schedule version (the result cache key).
+    """
+    canonical = json.dumps([CALCULATOR_VERSION, tariff_version, settings, canonical_products],
+                           sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()[:32]
+
+def calculation_etag(key, order, supplier_file_hash=None):
+    """
+    ETag of a /calculate response. The body lists products in request `order`, so reordered
+    rows must not get a 304; the same numbers for another supplier file are a new history
+    entry, so they must not be answered with a 304 that skips saving them either.
+    """
+    return hashlib.sha256(json.dumps([key, order, supplier_file_hash]).encode('utf-8')).hexdigest()[:32]
+
+class CalculationCache:
+    """
+    Bounded LRU cache of /calculate results keyed by calculation_key(), which includes the
+    calculator version, so results of another version are never served. Entries hold the results in canonical (sorted) product order plus the serialized
+    response for the product order it was last requested in.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'size': len(self.entries),
+                'max_size': self.max_size,
+                'calculator_version': CALCULATOR_VERSION
+            }
+
+calculation_cache = CalculationCache(app.config['CALCULATION_CACHE_SIZE'])
+
+def plan_calculation(data):
+    """
+    Parse a /calculate body. Returns (settings, products, order, canonical_products, key).
+    Results are computed in canonical (sorted) product order so the same products in any
+    order share one cache entry; order[k] is the request index of canonical row k.
+    """
+    settings, products = parse_calculation_request(data)
+    order = tuple(sorted(range(len(products)), key=lambda i: (products[i][0] or '',) + products[i][1:]))
+    canonical_products = [products[i] for i in order]
+    # Duty rates depend on the imported tariff schedule, so its version is part of the key
+    tariff_version = ''
+    if any(product[5] for product in products):
+        tariff_table.refresh()
+        tariff_version = tariff_table.version
+    return settings, products, order, canonical_products, calculation_key(settings, canonical_products, tariff_version)
+
+def calculator_for(settings, products):
+    """A ContainerCalculator set up with normalized settings and product tuples."""
+    calculator = ContainerCalculator()
+    calculator.container_cost_usd = settings['container_cost_usd']
+    calculator.container_volume = settings['container_volume']
+    calculator.import_tax_rate = settings['import_tax_rate']
+    calculator.usd_to_ils_rate = settings['usd_to_ils_rate']
+    calculator.rmb_to_ils_rate = settings['rmb_to_ils_rate']
+    calculator.local_transportation_ils = settings['local_transportation_ils']
+    calculator.unloading_cost_ils = settings['unloading_cost_ils']
+    calculator.additional_fees_ils = settings['additional_fees_ils']
+    calculator.exchange_rates = settings.get('exchange_rates', {})
+    calculator.exact = settings.get('exact', False)
+    calculator.tariffs = tariff_table
+    for name, quantity, total_volume, cost_per_unit, currency, hs_code in products:
+        calculator.add_product(name=name, quantity=quantity, total_volume=total_volume,
+                               cost_per_unit=cost_per_unit, currency=currency, hs_code=hs_code)
+    return calculator
+
+def in_request_order(canonical_results, order):
+    """Put product rows back in request order; the TOTALS row stays last."""
+    results = [None] * len(order)
+    for canonical_idx, request_idx in enumerate(order):
+        results[request_idx] = canonical_results[canonical_idx]
+    results.append(canonical_results[-1])
+    return results
+# --- END: /calculate result cache ---
+
+@app.route('/calculate', methods=['POST'])
+def calculate():
+    """Calculate shipping costs and display results."""
+    try:
+        # Get JSON data from request
+        data = request.get_json()
         if not data:
             return jsonify({'error': 'לא סופקו נתונים'}), 400
 
-        # Extract values from JSON data
-        container_cost = float(data['container_cost_usd'])
-        container_volume = float(data['container_volume'])
-        import_tax_rate = float(data['import_tax_rate'])
-        usd_to_ils_rate = float(data['usd_to_ils_rate'])
-        rmb_to_ils_rate = float(data.get('rmb_to_ils_rate', 0))
-        local_transportation = float(data.get('local_transportation_ils', 0))
-        unloading_cost = float(data.get('unloading_cost_ils', 0))
-        additional_fees = float(data.get('additional_fees_ils', 0))
-        products = data['products']
-
+        # Extract and normalize values from JSON data
+        settings, products, order, canonical_products, key = plan_calculation(data)
         if not products:
             return jsonify({'error': 'לא נמצאו מוצרים'}), 400
 
-        # Initialize calculator
-        calculator = ContainerCalculator()
-        calculator.container_cost_usd = container_cost
-        calculator.container_volume = container_volume
-        calculator.import_tax_rate = import_tax_rate
-        calculator.usd_to_ils_rate = usd_to_ils_rate
-        calculator.rmb_to_ils_rate = rmb_to_ils_rate
-        calculator.local_transportation_ils = local_transportation
-        calculator.unloading_cost_ils = unloading_cost
-        calculator.additional_fees_ils = additional_fees
-
-        # Add products to calculator
-        for product in products:
-            calculator.add_product(
-                name=product.get('name') or product.get('item'),
-                quantity=int(product['quantity']),
-                total_volume=float(product['total_volume']),
-                cost_per_unit= float(product['cost_per_unit_usd']) if 'cost_per_unit_usd' in product else float(product['price']),
-                currency=product.get('currency', 'USD')
-            )
+        # Identical calculation (same row order and supplier file) the client already has - skip all work
+        etag = calculation_etag(key, order, data.get('supplier_file_hash'))
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            return response
 
-        # Calculate costs
-        results = calculator.calculate_costs()
+        entry = calculation_cache.get(key)
+        if entry is not None:
+            canonical_results, summary = entry['canonical_results'], entry['summary']
+        else:
+            # Calculate costs
+            canonical_results = calculator_for(settings, canonical_products).calculate_costs()
+            summary = {
+                'total_volume': f"{sum(p[2] for p in products):.3f}",
+                'total_cost_usd': f"${sum(p[1] * p[3] for p in products):.2f}",
+                'container_cost': f"${settings['container_cost_usd']:.2f}",
+                'local_transportation': f"₪{settings['local_transportation_ils']:.2f}",
+                'unloading_cost': f"₪{settings['unloading_cost_ils']:.2f}",
+                'additional_fees': f"₪{settings['additional_fees_ils']:.2f}"
+            }
 
-        return jsonify({
-            'results': results,
-            'summary': {
-                'total_volume': f"{sum(p['total_volume'] for p in products):.3f}",
-                'total_cost_usd': f"${sum(p['quantity'] * (p.get('cost_per_unit_usd', p.get('price', 0))) for p in products):.2f}",
-                'container_cost': f"${container_cost:.2f}",
-                'local_transportation': f"₪{local_transportation:.2f}",
-                'unloading_cost': f"₪{unloading_cost:.2f}",
-                'additional_fees': f"₪{additional_fees:.2f}"
+        results = in_request_order(canonical_results, order)
+        if entry is not None and entry['order'] == order:
+            body = entry['body']
+        else:
+            body = app.json.response({'results': results, 'summary': summary}).get_data()
+            calculation_cache.put(key, {
+                'order': order,
+                'body': body,
+                'canonical_results': canonical_results,
+                'summary': summary
+            })
+        # Every run goes into the history, cached or not (a 304 above is a run already stored)
+        save_calculation(key, settings, products,
+                         [product.get('description', '') for product in data['products']],
+                         results, summary, supplier_file_hash=data.get('supplier_file_hash'))
+
+        response = app.response_class(body, mimetype=app.json.mimetype)
+        response.set_etag(etag, weak=True)
+        return response
+
+    except KeyError as e:
+        return jsonify({'error': f'שדה חסר: {str(e)}'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'אירעה שגיאה: {str(e)}'}), 500
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Runtime counters for this worker process."""
+    return jsonify({
+        'calculation_cache': calculation_cache.stats(),
+        'admission': admission_stats(),
+        'rate_providers': provider_health.stats()
+    })
+
+# --- BEGIN: Rate provider health ---
+class ProviderUnavailable(Exception):
+    """A provider's circuit is open, so it is not called."""
+
+class CircuitBreaker:
+    """
+    Health of one exchange-rate provider (host). Closed: calls go through. After
+    RATE_BREAKER_FAILURES failures in a row, or an error rate of RATE_BREAKER_ERROR_RATE over
+    the last RATE_BREAKER_WINDOW calls, it opens and the provider is skipped for a cooldown
+    (doubled on every failed retry, up to RATE_BREAKER_MAX_COOLDOWN). Then it is half-open:
+    one trial call decides whether it closes again or reopens. Calls are forgotten after
+    RATE_HEALTH_MEMORY seconds, so a provider passed over for its errors is tried again.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.state = 'closed'
+        self.consecutive_failures = 0
+        self.calls = deque(maxlen=app.config['RATE_BREAKER_WINDOW'])   # (called_at, succeeded, seconds)
+        self.latency = None          # moving average of successful calls, seconds
+        self.cooldown = app.config['RATE_BREAKER_COOLDOWN']
+        self.opened_at = None
+        self.trial_started = None    # when the half-open trial call went out
+        self.last_error = None
+        self.lock = threading.Lock()
+
+    def current_state(self):
+        """The state, with an open breaker past its cooldown moved to half-open."""
+        if self.state == 'open' and time.time() - self.opened_at >= self.cooldown:
+            self.state = 'half_open'
+        return self.state
+
+    def allow(self):
+        """Whether a call may go out now (for a half-open breaker, only one trial at a time)."""
+        with self.lock:
+            if self.current_state() == 'half_open':
+                # One trial at a time (a trial that never reported back is given up on)
+                if self.trial_started and time.time() - self.trial_started < 2 * app.config['RATE_TIMEOUT']:
+                    return False
+                self.trial_started = time.time()
+            return self.state != 'open'
+
+    def record_success(self, seconds):
+        with self.lock:
+            self.calls.append((time.time(), True, seconds))
+            self.latency = seconds if self.latency is None else 0.7 * self.latency + 0.3 * seconds
+            self.consecutive_failures = 0
+            if self.state != 'closed':
+                print(f"Rate provider {self.name}: circuit closed")
+            self.state = 'closed'
+            self.cooldown = app.config['RATE_BREAKER_COOLDOWN']
+            self.trial_started = None
+
+    def record_failure(self, seconds, error):
+        with self.lock:
+            self.calls.append((time.time(), False, seconds))
+            self.consecutive_failures += 1
+            self.last_error = str(error)
+            if self.state == 'half_open':
+                self.cooldown = min(self.cooldown * 2, app.config['RATE_BREAKER_MAX_COOLDOWN'])
+                self.open()
+            elif self.state == 'closed' and (
+                    self.consecutive_failures >= app.config['RATE_BREAKER_FAILURES'] or
+                    (len(self.recent_calls()) >= app.config['RATE_BREAKER_FAILURES'] and
+                     self.error_rate() >= app.config['RATE_BREAKER_ERROR_RATE'])):
+                self.open()
+            self.trial_started = None
+
+    def open(self):
+        self.state = 'open'
+        self.opened_at = time.time()
+        print(f"Rate provider {self.name}: circuit open for {self.cooldown:.0f}s ({self.last_error})")
+
+    def recent_calls(self):
+        since = time.time() - app.config['RATE_HEALTH_MEMORY']
+        return [succeeded for called_at, succeeded, _ in self.calls if called_at >= since]
+
+    def error_rate(self):
+        recent = self.recent_calls()
+        return recent.count(False) / len(recent) if recent else 0.0
+
+    def score(self):
+        """Sort key, healthiest first: state, then recent error rate, then latency."""
+        rank = {'closed': 0, 'half_open': 1, 'open': 2}[self.current_state()]
+        return (rank, round(self.error_rate(), 1), self.latency if self.latency is not None else 0.0)
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                'state': self.current_state(),
+                'error_rate': round(self.error_rate(), 3),
+                'recent_calls': len(self.recent_calls()),
+                'consecutive_failures': self.consecutive_failures,
+                'latency_ms': round(self.latency * 1000, 1) if self.latency is not None else None,
+                'last_error': self.last_error
             }
-        })
+            if self.state == 'open':
+                stats['retry_in_seconds'] = round(max(0.0, self.opened_at + self.cooldown - time.time()), 1)
+            return stats
+
+class ProviderHealth:
+    """Circuit breakers of the rate providers seen by this worker, by host."""
+    def __init__(self):
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def breaker(self, url):
+        name = urlsplit(url).netloc or url
+        with self.lock:
+            if name not in self.breakers:
+                self.breakers[name] = CircuitBreaker(name)
+            return self.breakers[name]
+
+    def ordered(self, providers, url=lambda provider: provider):
+        """`providers` healthiest first (stable, so configured order breaks ties)."""
+        return sorted(providers, key=lambda provider: self.breaker(url(provider)).score())
+
+    def states(self):
+        """{host: state} for rate responses."""
+        return {name: breaker.current_state() for name, breaker in self.breakers.items()}
+
+    def stats(self):
+        return {name: breaker.stats() for name, breaker in self.breakers.items()}
+
+provider_health = ProviderHealth()
+
+def usd_quote_ils(data):
+    """ILS per USD of a USD-based rate response; raises on a missing or non-positive rate."""
+    rate = float(data['rates']['ILS'])
+    if not rate > 0:
+        raise ValueError(f"Invalid USD/ILS rate: {rate}")
+    return rate
+
+def usd_rate_table(data):
+    """The {currency: units per USD} table of a full-table provider; raises unless ILS and CNY are positive."""
+    rates = data['rates']
+    for code in ('ILS', 'CNY'):
+        if not float(rates[code]) > 0:
+            raise ValueError(f"Invalid USD/{code} rate: {rates[code]}")
+    return rates
+
+# Rate providers, tried healthiest first by /get-exchange-rate and /get-currency-rates (and asgi.py)
+USD_ILS_APIS = [
+    {
+        'url': 'https://api.exchangerate-api.com/v4/latest/USD',
+        'extract': usd_quote_ils
+    },
+    {
+        'url': 'https://open.er-api.com/v6/latest/USD',
+        'extract': usd_quote_ils
+    },
+    {
+        'url': 'https://api.frankfurter.app/latest?from=USD&to=ILS',
+        'extract': usd_quote_ils
+    }
+]
+CURRENCY_RATE_APIS = [
+    'https://api.exchangerate-api.com/v4/latest/USD',
+    'https://open.er-api.com/v6/latest/USD'
+]
+
+def usd_ils_providers():
+    """USD/ILS providers: RATE_PROVIDER_URLS when configured (e.g. a local fake), else USD_ILS_APIS."""
+    urls = app.config['RATE_PROVIDER_URLS']
+    apis = [{'url': url, 'extract': usd_quote_ils} for url in urls] if urls else USD_ILS_APIS
+    return provider_health.ordered(apis, url=lambda api: api['url'])
+
+def currency_rate_providers():
+    """Providers of full USD-based rate tables: RATE_PROVIDER_URLS when configured, else CURRENCY_RATE_APIS."""
+    return provider_health.ordered(app.config['RATE_PROVIDER_URLS'] or CURRENCY_RATE_APIS)
+# --- END: Rate provider health ---
+
+# --- BEGIN: Exchange-rate cache ---
+rate_cache = {}  # url -> (fetched_at, response json)
+
+def cached_rates_json(url):
+    """(data, fetched_at) of a response younger than RATE_CACHE_TTL seconds, else None."""
+    cached = rate_cache.get(url)
+    if cached and time.time() - cached[0] < app.config['RATE_CACHE_TTL']:
+        return cached[1], cached[0]
+    return None
+
+def fetch_rates_json(url, extract):
+    """
+    GET an exchange-rate API, reusing a response younger than RATE_CACHE_TTL seconds.
+    Returns (data, fetched_at timestamp), or (None, None) if the API answered with a non-200 status.
+    A response only counts as a success, and is cached, once `extract(data)` accepts it; an error
+    body or malformed rates are a breaker failure and re-raise.
+    Raises ProviderUnavailable without calling it while the provider's circuit is open.
+    """
+    cached = cached_rates_json(url)
+    if cached:
+        return cached
+    breaker = provider_health.breaker(url)
+    if not breaker.allow():
+        raise ProviderUnavailable(f"circuit {breaker.state}")
+    start = time.perf_counter()
+    try:
+        response = requests.get(url, timeout=app.config['RATE_TIMEOUT'])
+        if response.status_code != 200:
+            breaker.record_failure(time.perf_counter() - start, f"HTTP {response.status_code}")
+            return None, None
+        data = response.json()
+        extract(data)
+    except Exception as e:
+        breaker.record_failure(time.perf_counter() - start, e)
+        raise
+    breaker.record_success(time.perf_counter() - start)
+    fetched_at = time.time()
+    rate_cache[url] = (fetched_at, data)
+    return data, fetched_at
+# --- END: Exchange-rate cache ---
+
+# --- BEGIN: Exchange-rate history store ---
+def get_db():
+    """Open a connection to the local SQLite database (one per call - cheap, and safe across threads/workers)."""
+    connection = sqlite3.connect(app.config['DATABASE_PATH'], timeout=10)
+    connection.row_factory = sqlite3.Row
+    # Safe with WAL journaling and avoids an fsync per commit
+    connection.execute('PRAGMA synchronous=NORMAL')
+    return connection
+
+class SQLiteStore:
+    """
+    Base for tables in the local database: creates `schema` on first connect. An entry is
+    an SQL statement, or a function of the connection for migrations SQL alone can't express.
+    """
+    schema = []
+
+    def __init__(self):
+        self.ready = False
+
+    def connect(self):
+        connection = get_db()
+        if not self.ready:
+            connection.execute('PRAGMA journal_mode=WAL')
+            for statement in self.schema:
+                if callable(statement):
+                    statement(connection)
+                else:
+                    connection.execute(statement)
+            connection.commit()
+            self.ready = True
+        return connection
 
+class RateStore(SQLiteStore):
+    """
+    Every successfully fetched rate, indexed by (pair, date).
+    Answers range queries and "rate as of date X" lookups, and is the fallback
+    when all rate providers are down. Pairs are named like USD_ILS (1 USD = rate ILS).
+    """
+    schema = [
+        """CREATE TABLE IF NOT EXISTS exchange_rates (
+            pair TEXT NOT NULL,
+            date TEXT NOT NULL,
+            fetched_at TEXT NOT NULL,
+            rate REAL NOT NULL,
+            source TEXT,
+            UNIQUE (pair, fetched_at)
+        )""",
+        'CREATE INDEX IF NOT EXISTS idx_exchange_rates_pair_date ON exchange_rates (pair, date, fetched_at)'
+    ]
+
+    def record(self, rates, source, fetched_at):
+        """Store {pair: rate} fetched at a unix timestamp. Re-recording a cached fetch is a no-op."""
+        fetched = datetime.fromtimestamp(fetched_at)
+        rows = [(pair, fetched.strftime('%Y-%m-%d'), fetched.isoformat(), float(rate), source)
+                for pair, rate in rates.items()]
+        with closing(self.connect()) as connection, connection:
+            connection.executemany('INSERT OR IGNORE INTO exchange_rates (pair, date, fetched_at, rate, source) '
+                                   'VALUES (?, ?, ?, ?, ?)', rows)
+
+    def latest(self, pair, as_of=None):
+        """Most recent stored rate for `pair` on or before `as_of` (YYYY-MM-DD), or None."""
+        query = 'SELECT pair, date, fetched_at, rate, source FROM exchange_rates WHERE pair = ?'
+        params = [pair]
+        if as_of:
+            query += ' AND date <= ?'
+            params.append(as_of)
+        query += ' ORDER BY date DESC, fetched_at DESC LIMIT 1'
+        with closing(self.connect()) as connection:
+            row = connection.execute(query, params).fetchone()
+        return dict(row) if row else None
+
+    def history(self, pair, start=None, end=None, daily=True, limit=1000):
+        """Stored rates for `pair` between two dates (inclusive), oldest first. `daily` keeps the last fetch per day."""
+        conditions, params = ['pair = ?'], [pair]
+        if start:
+            conditions.append('date >= ?')
+            params.append(start)
+        if end:
+            conditions.append('date <= ?')
+            params.append(end)
+        where = ' AND '.join(conditions)
+        if daily:
+            # SQLite returns the other columns from the row holding MAX(fetched_at)
+            query = (f'SELECT pair, date, MAX(fetched_at) AS fetched_at, rate, source FROM exchange_rates '
+                     f'WHERE {where} GROUP BY date ORDER BY date LIMIT ?')
+        else:
+            query = (f'SELECT pair, date, fetched_at, rate, source FROM exchange_rates '
+                     f'WHERE {where} ORDER BY date, fetched_at LIMIT ?')
+        params.append(limit)
+        with closing(self.connect()) as connection:
+            return [dict(row) for row in connection.execute(query, params)]
+
+rate_store = RateStore()
+
+def record_rates(rates, source, fetched_at):
+    """Store fetched rates; a storage problem must never fail the rate request."""
+    try:
+        rate_store.record(rates, source, fetched_at)
+    except Exception as e:
+        print(f"Could not store exchange rates: {e}")
+
+def stored_rate(pair):
+    """Last stored rate for `pair`, or None if there is none (or the store is unavailable)."""
+    try:
+        return rate_store.latest(pair)
+    except Exception as e:
+        print(f"Could not read stored exchange rate: {e}")
+        return None
+
+def parse_date_arg(name):
+    """Read an optional YYYY-MM-DD query argument. Raises ValueError on a bad date."""
+    value = request.args.get(name)
+    if value:
+        datetime.strptime(value, '%Y-%m-%d')
+    return value
+
+def parse_limit_arg(default, maximum):
+    """
+    Read the optional `limit` query argument, capped at `maximum`. Raises ValueError unless it
+    is a positive integer (SQLite treats a negative LIMIT as no limit at all).
+    """
+    limit = int(request.args.get('limit', default))
+    if limit < 1:
+        raise ValueError(f"limit must be positive, got {limit}")
+    return min(limit, maximum)
+
+@app.route('/rates/history', methods=['GET'])
+def rates_history():
+    """Stored rate history for a pair: ?pair=USD_ILS&from=YYYY-MM-DD&to=YYYY-MM-DD or ?as_of=YYYY-MM-DD."""
+    pair = request.args.get('pair', 'USD_ILS').upper()
+    try:
+        start, end, as_of = parse_date_arg('from'), parse_date_arg('to'), parse_date_arg('as_of')
+        limit = parse_limit_arg(1000, 10000)
+    except ValueError:
+        return jsonify({'error': 'תאריך או מגבלה לא תקינים (YYYY-MM-DD)'}), 400
+
+    if as_of:
+        rate = rate_store.latest(pair, as_of)
+        if rate is None:
+            return jsonify({'error': f'לא נמצא שער שמור עבור {pair} עד {as_of}'}), 404
+        return jsonify({'pair': pair, 'as_of': as_of, 'rate': rate})
+
+    daily = request.args.get('granularity', 'daily') != 'all'
+    return jsonify({'pair': pair, 'rates': rate_store.history(pair, start, end, daily, limit)})
+# --- END: Exchange-rate history store ---
+
+# --- BEGIN: Calculation history store ---
+def fts_query(text):
+    """Turn free text into an FTS5 query: every word must match as a prefix."""
+    words = re.findall(r'\w+', text)
+    return ' '.join('"' + word.replace('"', '""') + '"*' for word in words)
+
+RUN_INDEX_MISSING = "NOT EXISTS (SELECT 1 FROM sqlite_master WHERE name = 'idx_calculations_run')"
+FIRST_RUNS = "SELECT MIN(id) FROM calculations GROUP BY calculation_key, IFNULL(supplier_file_hash, '')"
+
+class CalculationHistory(SQLiteStore):
+    """
+    Every /calculate run with its inputs, rates and results.
+    Indexed on date, supplier file hash and product name, with full-text search
+    over product names and descriptions.
+    """
+    schema = [
+        """CREATE TABLE IF NOT EXISTS calculations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            created_at TEXT NOT NULL,
+            calculation_key TEXT NOT NULL,
+            supplier_file_hash TEXT,
+            calculator_version TEXT NOT NULL,
+            usd_to_ils_rate REAL,
+            rmb_to_ils_rate REAL,
+            product_count INTEGER NOT NULL,
+            total_cost_ils REAL,
+            settings TEXT NOT NULL,
+            results TEXT NOT NULL,
+            summary TEXT NOT NULL
+        )""",
+        'CREATE INDEX IF NOT EXISTS idx_calculations_created_at ON calculations (created_at)',
+        'CREATE INDEX IF NOT EXISTS idx_calculations_file_hash ON calculations (supplier_file_hash)',
+        'CREATE INDEX IF NOT EXISTS idx_calculations_key ON calculations (calculation_key)',
+        """CREATE TABLE IF NOT EXISTS calculation_products (
+            calculation_id INTEGER NOT NULL REFERENCES calculations (id),
+            position INTEGER NOT NULL,
+            name TEXT,
+            description TEXT,
+            quantity INTEGER,
+            total_volume REAL,
+            cost_per_unit REAL,
+            currency TEXT,
+            final_cost_per_unit_with_vat_ils REAL
+        )""",
+        'CREATE INDEX IF NOT EXISTS idx_calculation_products_name ON calculation_products (name, calculation_id)',
+        """CREATE VIRTUAL TABLE IF NOT EXISTS calculation_products_fts USING fts5 (
+            name, description, calculation_id UNINDEXED
+        )""",
+        # One row per calculation and supplier file. Duplicates saved before the unique
+        # index existed are dropped once (keeping the first), then the index enforces it.
+        f"""DELETE FROM calculation_products WHERE {RUN_INDEX_MISSING}
+            AND calculation_id NOT IN ({FIRST_RUNS})""",
+        f"""DELETE FROM calculation_products_fts WHERE {RUN_INDEX_MISSING}
+            AND calculation_id NOT IN ({FIRST_RUNS})""",
+        f"DELETE FROM calculations WHERE {RUN_INDEX_MISSING} AND id NOT IN ({FIRST_RUNS})",
+        """CREATE UNIQUE INDEX IF NOT EXISTS idx_calculations_run
+            ON calculations (calculation_key, IFNULL(supplier_file_hash, ''))"""
+    ]
+
+    def save(self, key, settings, products, descriptions, results, summary, supplier_file_hash=None):
+        """
+        Store one calculation (products and results in request order, TOTALS row last).
+        The same calculation for the same supplier file is only stored once (idx_calculations_run,
+        so concurrent workers cannot both insert it). Returns its id.
+        """
+        with closing(self.connect()) as connection, connection:
+            cursor = connection.execute(
+                'INSERT OR IGNORE INTO calculations (created_at, calculation_key, supplier_file_hash, '
+                'calculator_version, usd_to_ils_rate, rmb_to_ils_rate, product_count, total_cost_ils, settings, '
+                'results, summary) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (datetime.now().isoformat(), key, supplier_file_hash, CALCULATOR_VERSION,
+                 settings['usd_to_ils_rate'], settings['rmb_to_ils_rate'], len(products),
+                 results[-1]['total_cost_ils'], app.json.dumps(settings), app.json.dumps(results),
+                 app.json.dumps(summary)))
+            if cursor.rowcount == 0:
+                return connection.execute(
+                    "SELECT id FROM calculations WHERE calculation_key = ? AND IFNULL(supplier_file_hash, '') = ?",
+                    (key, supplier_file_hash or '')).fetchone()['id']
+            calculation_id = cursor.lastrowid
+
+            product_rows = []
+            for position, ((name, quantity, total_volume, cost_per_unit, currency, _), description, result) in \
+                    enumerate(zip(products, descriptions, results)):
+                product_rows.append((calculation_id, position, name, description, quantity, total_volume,
+                                     cost_per_unit, currency, result['final_cost_per_unit_with_vat_ils']))
+            connection.executemany(
+                'INSERT INTO calculation_products (calculation_id, position, name, description, quantity, '
+                'total_volume, cost_per_unit, currency, final_cost_per_unit_with_vat_ils) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', product_rows)
+            connection.executemany(
+                'INSERT INTO calculation_products_fts (name, description, calculation_id) VALUES (?, ?, ?)',
+                [(row[2], row[3], calculation_id) for row in product_rows])
+            return calculation_id
+
+    def search(self, query=None, product=None, supplier_file_hash=None, start=None, end=None,
+               before=None, limit=20):
+        """
+        Newest-first page of calculation summaries matching every given filter.
+        Keyset pagination: pass the last id of a page as `before` to get the next one.
+        """
+        conditions, params = [], []
+        if before:
+            conditions.append('id < ?')
+            params.append(before)
+        if start:
+            conditions.append('created_at >= ?')
+            params.append(start)
+        if end:
+            # `end` is an inclusive date, created_at a full ISO timestamp
+            conditions.append('created_at < ?')
+            params.append((datetime.strptime(end, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d'))
+        if supplier_file_hash:
+            conditions.append('supplier_file_hash = ?')
+            params.append(supplier_file_hash)
+        if product:
+            # Name prefix as a range scan on idx_calculation_products_name
+            conditions.append('id IN (SELECT calculation_id FROM calculation_products WHERE name >= ? AND name < ?)')
+            params.extend([product, product + '\uffff'])
+        if query and fts_query(query):
+            conditions.append('id IN (SELECT calculation_id FROM calculation_products_fts '
+                              'WHERE calculation_products_fts MATCH ?)')
+            params.append(fts_query(query))
+
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        params.append(limit)
+        with closing(self.connect()) as connection:
+            rows = connection.execute(
+                'SELECT id, created_at, supplier_file_hash, calculator_version, usd_to_ils_rate, rmb_to_ils_rate, '
+                f'product_count, total_cost_ils, summary FROM calculations {where} ORDER BY id DESC LIMIT ?',
+                params).fetchall()
+        calculations = []
+        for row in rows:
+            calculation = dict(row)
+            calculation['summary'] = json.loads(calculation['summary'])
+            calculations.append(calculation)
+        return calculations
+
+    def get(self, calculation_id):
+        """Full stored calculation, or None."""
+        with closing(self.connect()) as connection:
+            row = connection.execute('SELECT * FROM calculations WHERE id = ?', (calculation_id,)).fetchone()
+            if row is None:
+                return None
+            products = connection.execute(
+                'SELECT position, name, description, quantity, total_volume, cost_per_unit, currency '
+                'FROM calculation_products WHERE calculation_id = ? ORDER BY position', (calculation_id,)).fetchall()
+        calculation = dict(row)
+        for field in ('settings', 'results', 'summary'):
+            calculation[field] = json.loads(calculation[field])
+        calculation['products'] = [dict(product) for product in products]
+        return calculation
+
+calculation_history = CalculationHistory()
+
+def save_calculation(*args, **kwargs):
+    """Store a calculation; a storage problem must never fail the calculation itself."""
+    try:
+        return calculation_history.save(*args, **kwargs)
+    except Exception as e:
+        print(f"Could not save calculation history: {e}")
+        return None
+
+@app.route('/history', methods=['GET'])
+def list_calculations():
+    """
+    Saved calculations, newest first.
+    Filters: q (full-text over product names/descriptions), product (name prefix),
+    file_hash, from/to (YYYY-MM-DD). Paging: limit, before (last id of the previous page).
+    """
+    try:
+        start, end = parse_date_arg('from'), parse_date_arg('to')
+        limit = parse_limit_arg(20, 200)
+        before = int(request.args['before']) if request.args.get('before') else None
+    except ValueError:
+        return jsonify({'error': 'פרמטרים לא תקינים'}), 400
+
+    calculations = calculation_history.search(
+        query=request.args.get('q'),
+        product=request.args.get('product'),
+        supplier_file_hash=request.args.get('file_hash'),
+        start=start, end=end, before=before, limit=limit)
+    return jsonify({
+        'calculations': calculations,
+        'next_before': calculations[-1]['id'] if len(calculations) == limit else None
+    })
+
+@app.route('/history/<int:calculation_id>', methods=['GET'])
+def get_calculation(calculation_id):
+    """One saved calculation with its inputs, rates and results."""
+    calculation = calculation_history.get(calculation_id)
+    if calculation is None:
+        return jsonify({'error': 'החישוב לא נמצא'}), 404
+    return jsonify(calculation)
+# --- END: Calculation history store ---
+
+# --- BEGIN: Excel export ---
+# Landed-cost columns written per product line: (header, result field)
+EXPORT_COLUMNS = [
+    ('מוצר', 'name'),
+    ('תיאור', 'description'),
+    ('קוד מכס', 'hs_code'),
+    ('כמות', 'quantity'),
+    ('נפח כולל (מ"ק)', 'total_volume'),
+    ('מטבע', 'currency'),
+    ('מחיר ספק ליחידה', 'cost_per_unit'),
+    ('עלות מקורית ליחידה ₪', 'original_cost_per_unit_ils'),
+    ('עלות משלוח ליחידה ₪', 'shipping_cost_per_unit_ils'),
+    ('הובלה מקומית ליחידה ₪', 'local_transportation_per_unit_ils'),
+    ('פריקה ליחידה ₪', 'unloading_per_unit_ils'),
+    ('עמלות נוספות ליחידה ₪', 'additional_fees_per_unit_ils'),
+    ('מכס ליחידה ₪', 'duty_per_unit_ils'),
+    ('עלות סופית ליחידה ₪', 'final_cost_per_unit_ils'),
+    ('מע״מ ליחידה ₪', 'vat_per_unit_ils'),
+    ('עלות סופית עם מע״מ ליחידה ₪', 'final_cost_per_unit_with_vat_ils'),
+    ('משלוח ₪', 'shipping_cost_ils'),
+    ('הובלה מקומית ₪', 'local_transportation_ils'),
+    ('מכס ₪', 'duty_ils'),
+    ('סה"כ ₪', 'total_cost_ils')
+]
+
+def write_results_xlsx(target, results, products, settings):
+    """
+    Write calculation results (request order, TOTALS row last) as an .xlsx to a path or binary file.
+    `products` are the request's product dicts (description, cost_per_unit) in the same order.
+    Uses openpyxl's write-only mode: rows are streamed to disk as they are appended, so
+    memory stays flat however many lines the calculation has.
+    """
+    from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import Font
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('עלויות נחיתה')
+    sheet.sheet_view.rightToLeft = True
+    bold = Font(bold=True)
+
+    def bold_row(values):
+        row = []
+        for value in values:
+            cell = WriteOnlyCell(sheet, value=value)
+            cell.font = bold
+            row.append(cell)
+        return row
+
+    sheet.append(bold_row(header for header, _ in EXPORT_COLUMNS))
+    for result, product in zip(results, products):
+        line = dict(result, description=product.get('description', ''), cost_per_unit=product.get('cost_per_unit'))
+        sheet.append([line.get(field) for _, field in EXPORT_COLUMNS])
+    sheet.append(bold_row('סה"כ' if field == 'name' else results[-1].get(field) if field.endswith('_ils') else None
+                          for _, field in EXPORT_COLUMNS))
+
+    settings_sheet = workbook.create_sheet('הגדרות')
+    settings_sheet.sheet_view.rightToLeft = True
+    for field, value in settings.items():
+        if isinstance(value, dict):
+            for currency, rate in value.items():
+                settings_sheet.append([f"{field}.{currency}", rate])
+        else:
+            settings_sheet.append([field, value])
+    settings_sheet.append(['calculator_version', CALCULATOR_VERSION])
+    settings_sheet.append(['exported_at', datetime.now().isoformat(timespec='seconds')])
+    workbook.save(target)
+
+def xlsx_response(results, products, settings, download_name):
+    """Send a results workbook from an anonymous temporary file, gone once the response is closed."""
+    buffer = tempfile.TemporaryFile(suffix='.xlsx', dir=app.config['UPLOAD_FOLDER'])
+    try:
+        write_results_xlsx(buffer, results, products, settings)
+        buffer.seek(0)
+    except Exception:
+        buffer.close()
+        raise
+    return send_file(buffer, as_attachment=True, download_name=download_name,
+                     mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+@app.route('/export/xlsx', methods=['POST'])
+def export_xlsx():
+    """The landed costs of a /calculate request body as an .xlsx, one line per product in the supplier's order."""
+    try:
+        data = request.get_json(silent=True)
+        if not data:
+            return jsonify({'error': 'לא סופקו נתונים'}), 400
+        settings, products, order, canonical_products, key = plan_calculation(data)
+        if not products:
+            return jsonify({'error': 'לא נמצאו מוצרים'}), 400
+
+        entry = calculation_cache.get(key)
+        if entry is not None:
+            canonical_results = entry['canonical_results']
+        else:
+            canonical_results = calculator_for(settings, canonical_products).calculate_costs()
+        results = in_request_order(canonical_results, order)
+        lines = [{'description': product.get('description', ''), 'cost_per_unit': parsed[3]}
+                 for product, parsed in zip(data['products'], products)]
+        return xlsx_response(results, lines, settings, f"landed-costs-{key[:8]}.xlsx")
     except KeyError as e:
         return jsonify({'error': f'שדה חסר: {str(e)}'}), 400
     except ValueError as e:
@@ -1116,131 +2732,1032 @@ def calculate():
     except Exception as e:
         return jsonify({'error': f'אירעה שגיאה: {str(e)}'}), 500
 
+@app.route('/history/<int:calculation_id>/export.xlsx', methods=['GET'])
+def export_calculation_xlsx(calculation_id):
+    """A saved calculation as an .xlsx."""
+    calculation = calculation_history.get(calculation_id)
+    if calculation is None:
+        return jsonify({'error': 'החישוב לא נמצא'}), 404
+    return xlsx_response(calculation['results'], calculation['products'], calculation['settings'],
+                         f"landed-costs-{calculation_id}.xlsx")
+# --- END: Excel export ---
+
+# --- BEGIN: Columnar export (Arrow / Parquet) ---
+# format -> (file extension, mimetype)
+COLUMNAR_FORMATS = {
+    'arrow': ('arrows', 'application/vnd.apache.arrow.stream'),
+    'parquet': ('parquet', 'application/vnd.apache.parquet')
+}
+
+def pyarrow_available():
+    """pyarrow is optional; without it the Arrow/Parquet exports answer 501."""
+    try:
+        pa.__version__
+    except ImportError:
+        return False
+    return True
+
+def currency_array(indices):
+    """Currency column as an Arrow dictionary (categorical) over CURRENCIES."""
+    return pa.DictionaryArray.from_arrays(pa.array(indices, type=pa.int8()), pa.array(CURRENCIES, type=pa.string()))
+
+def calculation_schema(batch=False):
+    fields = [
+        ('sku', pa.string()),
+        ('description', pa.string()),
+        ('hs_code', pa.string()),
+        ('currency', pa.dictionary(pa.int8(), pa.string())),
+        ('quantity', pa.int64()),
+        ('total_volume', pa.float64()),
+        ('cost_per_unit', pa.float64()),
+        ('duty_rate', pa.float64())
+    ] + [(name, pa.float64()) for name in ContainerCalculator.COST_COLUMNS]
+    if batch:
+        fields = [('calculation_id', pa.int64()), ('created_at', pa.timestamp('us'))] + fields
+    return pa.schema(fields)
+
+def products_schema():
+    return pa.schema([
+        ('sku', pa.string()),
+        ('description', pa.string()),
+        ('hs_code', pa.string()),
+        ('currency', pa.dictionary(pa.int8(), pa.string())),
+        ('quantity', pa.float64()),
+        ('total_volume', pa.float64()),
+        ('unit_price', pa.float64()),
+        ('sheet', pa.string())
+    ])
+
+def calculation_table(settings, products, order, canonical_products, descriptions):
+    """
+    A calculation in request order as an Arrow table, built straight from the calculator's
+    arrays: full precision and no TOTALS row.
+    """
+    arrays = calculator_for(settings, canonical_products).calculate_columns()
+    rows = np.argsort(np.array(order, dtype=np.int64))   # canonical row of each request row
+    columns = {
+        'sku': pa.array([product[0] or '' for product in products], type=pa.string()),
+        'description': pa.array(descriptions, type=pa.string()),
+        'hs_code': pa.array([product[5] for product in products], type=pa.string()),
+        'currency': currency_array(arrays['currency_index'][rows]),
+        'quantity': pa.array(arrays['quantity'][rows].astype(np.int64))
+    }
+    for name in ['total_volume', 'cost_per_unit', 'duty_rate'] + ContainerCalculator.COST_COLUMNS:
+        columns[name] = pa.array(arrays[name][rows])
+    return pa.table(columns, schema=calculation_schema())
+
+def history_table(calculations):
+    """Saved calculations (stored, rounded results; TOTALS rows left out) as one Arrow table."""
+    columns = defaultdict(list)
+    for calculation in calculations:
+        created_at = datetime.fromisoformat(calculation['created_at'])
+        for result, product in zip(calculation['results'], calculation['products']):
+            columns['calculation_id'].append(calculation['id'])
+            columns['created_at'].append(created_at)
+            columns['sku'].append(product['name'] or '')
+            columns['description'].append(product['description'] or '')
+            columns['hs_code'].append(result.get('hs_code', ''))
+            columns['currency'].append(currency_index(product['currency'] or 'USD'))
+            columns['quantity'].append(product['quantity'])
+            columns['total_volume'].append(product['total_volume'])
+            columns['cost_per_unit'].append(product['cost_per_unit'])
+            columns['duty_rate'].append(result.get('duty_rate', 0.0))
+            # Calculations saved before customs duty existed have no duty columns
+            for name in ContainerCalculator.COST_COLUMNS:
+                columns[name].append(result.get(name, 0.0))
+    schema = calculation_schema(batch=True)
+    return pa.table([currency_array(columns['currency']) if field.name == 'currency'
+                     else pa.array(columns[field.name], type=field.type) for field in schema], schema=schema)
+
+def products_table(products):
+    """Parsed upload products from either pipeline as an Arrow table."""
+    columns = defaultdict(list)
+    for product in products:
+        if 'item' in product:
+            # Robust pipeline
+            sku, total_volume, unit_price = product['item'], product['cbm'], product['price']
+        else:
+            sku, total_volume, unit_price = product['name'], product['total_volume'], product['cost_per_unit_usd']
+        columns['sku'].append(sku)
+        columns['description'].append(product.get('description', ''))
+        columns['hs_code'].append(product.get('hs_code', ''))
+        columns['currency'].append(currency_index(product.get('currency', 'USD')))
+        columns['quantity'].append(product['quantity'])
+        columns['total_volume'].append(total_volume)
+        columns['unit_price'].append(unit_price)
+        columns['sheet'].append(product.get('sheet'))
+    schema = products_schema()
+    return pa.table([currency_array(columns['currency']) if field.name == 'currency'
+                     else pa.array(columns[field.name], type=field.type) for field in schema], schema=schema)
+
+def columnar_response(table, export_format, download_name):
+    """Send an Arrow table as an Arrow IPC stream or a Parquet file."""
+    extension, mimetype = COLUMNAR_FORMATS[export_format]
+    buffer = tempfile.TemporaryFile(suffix=f'.{extension}', dir=app.config['UPLOAD_FOLDER'])
+    try:
+        if export_format == 'parquet':
+            pq.write_table(table, buffer)
+        else:
+            writer = pa.ipc.new_stream(buffer, table.schema)
+            writer.write_table(table)
+            writer.close()
+        buffer.seek(0)
+    except Exception:
+        buffer.close()
+        raise
+    return send_file(buffer, as_attachment=True, download_name=f'{download_name}.{extension}', mimetype=mimetype)
+
+def export_format_arg(value):
+    """'json' (the default) or a COLUMNAR_FORMATS key; raises ValueError otherwise."""
+    value = (value or 'json').lower()
+    if value != 'json' and value not in COLUMNAR_FORMATS:
+        raise ValueError(f"Unsupported export format {value}")
+    return value
+
+PYARROW_MISSING = 'ייצוא Arrow/Parquet דורש את החבילה pyarrow'
+
+@app.route('/export/<any(arrow, parquet):export_format>', methods=['POST'])
+def export_columnar(export_format):
+    """The results of a /calculate request body as an Arrow IPC stream or Parquet file."""
+    if not pyarrow_available():
+        return jsonify({'error': PYARROW_MISSING}), 501
+    try:
+        data = request.get_json(silent=True)
+        if not data:
+            return jsonify({'error': 'לא סופקו נתונים'}), 400
+        settings, products, order, canonical_products, key = plan_calculation(data)
+        if not products:
+            return jsonify({'error': 'לא נמצאו מוצרים'}), 400
+        descriptions = [product.get('description', '') for product in data['products']]
+        table = calculation_table(settings, products, order, canonical_products, descriptions)
+        return columnar_response(table, export_format, f"landed-costs-{key[:8]}")
+    except KeyError as e:
+        return jsonify({'error': f'שדה חסר: {str(e)}'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'אירעה שגיאה: {str(e)}'}), 500
+
+@app.route('/history/export.<any(arrow, parquet):export_format>', methods=['GET'])
+def export_history_columnar(export_format):
+    """
+    Many saved calculations as one Arrow/Parquet file, one row per product line tagged with
+    calculation_id. Either ids=1,2,3 or the /history filters (q, product, file_hash, from, to, limit).
+    """
+    if not pyarrow_available():
+        return jsonify({'error': PYARROW_MISSING}), 501
+    try:
+        if request.args.get('ids'):
+            ids = [int(value) for value in request.args['ids'].split(',') if value.strip()]
+        else:
+            start, end = parse_date_arg('from'), parse_date_arg('to')
+            limit = parse_limit_arg(100, app.config['HISTORY_EXPORT_LIMIT'])
+            ids = [calculation['id'] for calculation in calculation_history.search(
+                query=request.args.get('q'),
+                product=request.args.get('product'),
+                supplier_file_hash=request.args.get('file_hash'),
+                start=start, end=end, limit=limit)]
+    except ValueError:
+        return jsonify({'error': 'פרמטרים לא תקינים'}), 400
+    if len(ids) > app.config['HISTORY_EXPORT_LIMIT']:
+        return jsonify({'error': 'יותר מדי חישובים לייצוא'}), 400
+
+    calculations = [calculation for calculation in map(calculation_history.get, ids) if calculation is not None]
+    if not calculations:
+        return jsonify({'error': 'החישוב לא נמצא'}), 404
+    return columnar_response(history_table(calculations), export_format, 'landed-costs-history')
+# --- END: Columnar export ---
+
+# --- BEGIN: FX risk simulation ---
+def simulation_currencies(settings, products):
+    """Currencies whose ILS rate moves the landed cost: the products' (but ILS) plus USD for shipping."""
+    used = {CURRENCIES[currency_index(product[4])] for product in products} | {'USD'}
+    return [code for code in CURRENCIES if code in used and code != 'ILS']
+
+def spot_rates(settings):
+    """ILS per unit of each currency as the calculator sees it."""
+    rates = dict(settings.get('exchange_rates', {}))
+    rates.update(ILS=1.0, USD=settings['usd_to_ils_rate'], CNY=settings['rmb_to_ils_rate'])
+    return rates
+
+def correlation_matrix(currencies, correlation):
+    """A scalar (every pair) or {"USD/CNY": 0.8} as a correlation matrix over `currencies`."""
+    size = len(currencies)
+    if isinstance(correlation, dict):
+        matrix = np.eye(size)
+        for pair, value in correlation.items():
+            first, _, second = pair.upper().partition('/')
+            first, second = CURRENCIES[currency_index(first)], CURRENCIES[currency_index(second)]
+            if first in currencies and second in currencies and first != second:
+                i, j = currencies.index(first), currencies.index(second)
+                matrix[i, j] = matrix[j, i] = float(value)
+    else:
+        matrix = np.full((size, size), float(correlation or 0))
+        np.fill_diagonal(matrix, 1.0)
+    return matrix
+
+def historical_returns(currencies, lookback_days):
+    """Daily log returns of the stored {code}_ILS rates on the dates all currencies share (dates x currencies)."""
+    start = (datetime.now() - timedelta(days=lookback_days)).strftime('%Y-%m-%d')
+    series = [{row['date']: row['rate'] for row in rate_store.history(f"{code}_ILS", start=start, limit=lookback_days + 1)}
+              for code in currencies]
+    dates = sorted(set.intersection(*(set(rates) for rates in series)))
+    levels = np.array([[rates[date] for rates in series] for date in dates], dtype=float).reshape(len(dates), len(currencies))
+    return np.diff(np.log(levels), axis=0)
+
+def simulate_rate_ratios(currencies, model, paths, horizon_days, rng):
+    """
+    Simulated rate at the horizon divided by today's, per path (paths x currencies).
+    model['returns'] (daily log returns, days x currencies) is bootstrapped: each path sums
+    `horizon_days` whole days drawn with replacement, keeping the currencies' co-movement
+    (in blocks of paths to bound memory). Otherwise a driftless correlated lognormal from
+    model['volatility'] (annualized, per currency) and model['correlation'].
+    """
+    if 'returns' in model:
+        returns = model['returns']
+        ratios = np.empty((paths, len(currencies)))
+        # The drawn days are paths x horizon x currencies before summing, so a block of paths at a time
+        block = max(1, app.config['SIMULATION_BLOCK_SIZE'] // (horizon_days * len(currencies)))
+        for start in range(0, paths, block):
+            rows = slice(start, start + block)
+            days = rng.integers(0, len(returns), size=(len(ratios[rows]), horizon_days))
+            ratios[rows] = np.exp(returns[days].sum(axis=1))
+        return ratios
+
+    volatility = model['volatility']
+    try:
+        cholesky = np.linalg.cholesky(model['correlation'])
+    except np.linalg.LinAlgError:
+        raise ValueError("Correlation matrix is not positive definite")
+    years = horizon_days / 365
+    shocks = rng.standard_normal((paths, len(currencies))) @ cholesky.T
+    return np.exp(volatility * np.sqrt(years) * shocks - 0.5 * volatility ** 2 * years)
+
+def simulation_model(spec, currencies):
+    """Validate a request's simulation model; returns the model and its description for the response."""
+    if spec.get('returns') is not None:
+        if spec['returns'] == 'history':
+            lookback_days = int(spec.get('lookback_days', 365))
+            returns = historical_returns(currencies, lookback_days)
+            source = f"stored rates, last {lookback_days} days"
+        else:
+            requested = {CURRENCIES[currency_index(code)]: values for code, values in spec['returns'].items()}
+            missing = [code for code in currencies if code not in requested]
+            if missing:
+                raise ValueError(f"No returns given for {', '.join(missing)}")
+            returns = np.array([requested[code] for code in currencies], dtype=float).T
+            source = 'request'
+        if returns.ndim != 2 or len(returns) < app.config['SIMULATION_MIN_RETURNS']:
+            raise ValueError(f"At least {app.config['SIMULATION_MIN_RETURNS']} daily returns per currency are needed")
+        annualized = returns.std(axis=0, ddof=1) * np.sqrt(365)
+        # Without "drift": true the sample's trend is removed, as in the lognormal model
+        if not spec.get('drift'):
+            returns = returns - returns.mean(axis=0)
+        return {'returns': returns}, {
+            'type': 'historical bootstrap',
+            'source': source,
+            'days': len(returns),
+            'drift': bool(spec.get('drift')),
+            'volatility': dict(zip(currencies, np.round(annualized, 6).tolist())),
+            'correlation': np.round(np.corrcoef(returns, rowvar=False).reshape(len(currencies), -1), 6).tolist()
+        }
+
+    requested = {CURRENCIES[currency_index(code)]: value for code, value in (spec.get('volatility') or {}).items()}
+    missing = [code for code in currencies if code not in requested]
+    if missing:
+        raise ValueError(f"No volatility given for {', '.join(missing)}")
+    volatility = np.array([float(requested[code]) for code in currencies])
+    if (volatility < 0).any():
+        raise ValueError("Volatility cannot be negative")
+    correlation = correlation_matrix(currencies, spec.get('correlation', 0))
+    return {'volatility': volatility, 'correlation': correlation}, {
+        'type': 'lognormal',
+        'volatility': dict(zip(currencies, volatility.tolist())),
+        'correlation': correlation.tolist()
+    }
+
+def percentile_summary(values, percentiles, axis=0, digits=2):
+    """{'p5': ..., 'p50': ..., 'mean': ...} along `axis`; one dict per column for 2-D input."""
+    points = np.round(np.percentile(values, percentiles, axis=axis), digits)
+    means = np.round(values.mean(axis=axis), digits)
+    if np.ndim(means) == 0:
+        summary = {f"p{q:g}": value for q, value in zip(percentiles, points.tolist())}
+        summary['mean'] = float(means)
+        return summary
+    return [dict({f"p{q:g}": value for q, value in zip(percentiles, column)}, mean=mean)
+            for column, mean in zip(points.T.tolist(), means.tolist())]
+
+def simulate_landed_costs(settings, products, spec):
+    """
+    Distribution of the landed cost under simulated exchange rates. Costs are linear in the
+    rates, so the calculator's spot results are split into goods (moving with the product's
+    currency), shipping (moving with USD, duty on both) and fixed ILS costs, and re-priced for
+    every path in one broadcast (in blocks of products to bound memory).
+    """
+    paths = int(spec.get('paths', 10000))
+    horizon_days = int(spec.get('horizon_days', 60))
+    percentiles = [float(q) for q in spec.get('percentiles', [5, 50, 95])]
+    if not 1 <= paths <= app.config['SIMULATION_MAX_PATHS']:
+        raise ValueError(f"paths must be between 1 and {app.config['SIMULATION_MAX_PATHS']}")
+    if not 1 <= horizon_days <= app.config['SIMULATION_MAX_HORIZON_DAYS']:
+        raise ValueError(f"horizon_days must be between 1 and {app.config['SIMULATION_MAX_HORIZON_DAYS']}")
+    if not percentiles or not all(0 <= q <= 100 for q in percentiles):
+        raise ValueError("percentiles must be between 0 and 100")
+
+    currencies = simulation_currencies(settings, products)
+    model, description = simulation_model(spec, currencies)
+    # A seed is always reported, so any run can be repeated exactly
+    seed = int(spec['seed']) if spec.get('seed') is not None else int(np.random.SeedSequence().entropy % 2 ** 32)
+    rng = np.random.default_rng(seed)
+
+    # Rate of each CURRENCIES entry relative to today, per path (ILS and unused currencies stay at 1)
+    ratios = np.ones((paths, len(CURRENCIES)))
+    ratios[:, [currency_index(code) for code in currencies]] = simulate_rate_ratios(
+        currencies, model, paths, horizon_days, rng)
+    usd_ratio = ratios[:, currency_index('USD')]
+
+    arrays = calculator_for(settings, products).calculate_columns()
+    duty_factor = 1 + arrays['duty_rate']
+    goods = arrays['original_cost_per_unit_ils'] * arrays['quantity'] * duty_factor
+    shipping = arrays['shipping_cost_ils'] * duty_factor
+    fixed = arrays['local_transportation_ils'] + arrays['unloading_cost_ils'] + arrays['additional_fees_ils']
+    # Per unit with VAT, as final_cost_per_unit_with_vat_ils (also defined for zero-quantity lines)
+    vat_factor = 1 + settings['import_tax_rate']
+    unit_goods = arrays['original_cost_per_unit_ils'] * duty_factor * vat_factor
+    unit_shipping = arrays['shipping_cost_per_unit_ils'] * duty_factor * vat_factor
+    unit_fixed = (arrays['local_transportation_per_unit_ils'] + arrays['unloading_per_unit_ils'] +
+                  arrays['additional_fees_per_unit_ils']) * vat_factor
+    currency_indices = arrays['currency_index']
+
+    # Shipment total: goods grouped by currency, so this is paths x currencies
+    goods_by_currency = np.bincount(currency_indices, weights=goods, minlength=len(CURRENCIES))
+    totals = ratios @ goods_by_currency + usd_ratio * shipping.sum() + fixed.sum()
+
+    # Per product: paths x products, a block of products at a time
+    results = []
+    block = max(1, app.config['SIMULATION_BLOCK_SIZE'] // paths)
+    for start in range(0, len(products), block):
+        lines = slice(start, start + block)
+        goods_ratios = ratios[:, currency_indices[lines]]
+        usd_ratios = usd_ratio[:, None]
+        line_totals = percentile_summary(
+            goods_ratios * goods[lines] + usd_ratios * shipping[lines] + fixed[lines], percentiles)
+        unit_costs = percentile_summary(
+            goods_ratios * unit_goods[lines] + usd_ratios * unit_shipping[lines] + unit_fixed[lines], percentiles)
+        results.extend({
+            'name': product[0],
+            'total_cost_ils': line_total,
+            'final_cost_per_unit_with_vat_ils': unit_cost
+        } for product, line_total, unit_cost in zip(products[lines], line_totals, unit_costs))
+
+    spot = spot_rates(settings)
+    return {
+        'paths': paths,
+        'horizon_days': horizon_days,
+        'seed': seed,
+        'percentiles': percentiles,
+        'currencies': currencies,
+        'model': description,
+        'spot_rates': {code: spot[code] for code in currencies},
+        'rates': dict(zip(currencies, percentile_summary(
+            ratios[:, [currency_index(code) for code in currencies]] * [spot[code] for code in currencies],
+            percentiles, digits=6))),
+        'total_cost_ils': dict(percentile_summary(totals, percentiles),
+                               spot=round(float(arrays['total_cost_ils'].sum()), 2)),
+        'products': results
+    }
+
+@app.route('/simulate', methods=['POST'])
+def simulate():
+    """
+    Landed-cost distribution under exchange-rate moves until payment: a /calculate body plus
+    "simulation": {"paths", "horizon_days", "percentiles", "seed", and either "volatility"
+    ({"USD": 0.07, "RMB": 0.09}, annualized) with "correlation" (a number or {"USD/RMB": 0.8}),
+    or "returns" ("history" with "lookback_days" for the stored rates, or {"USD": [daily log
+    returns], ...}) bootstrapped, optionally keeping their "drift"}.
+    """
+    try:
+        data = request.get_json(silent=True)
+        if not data:
+            return jsonify({'error': 'לא סופקו נתונים'}), 400
+        settings, products = parse_calculation_request(data)
+        if not products:
+            return jsonify({'error': 'לא נמצאו מוצרים'}), 400
+        return jsonify(simulate_landed_costs(settings, products, data.get('simulation') or {}))
+    except KeyError as e:
+        return jsonify({'error': f'שדה חסר: {str(e)}'}), 400
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': f'אירעה שגיאה: {str(e)}'}), 500
+# --- END: FX risk simulation ---
+
+# --- BEGIN: SKU catalog ---
+class SkuIndex:
+    """
+    In-memory prefix index over SKU records: a sorted array of upper-cased keys
+    (product code and item number) searched with bisect.
+    """
+    def __init__(self):
+        self.keys = []      # sorted (key, sku) pairs
+        self.records = {}   # sku -> record
+
+    def record_keys(self, record):
+        keys = {record['product_code'].upper(), (record['item_number'] or '').upper()}
+        return [(key, record['sku']) for key in keys if key]
+
+    def add(self, record):
+        if record['sku'] not in self.records:
+            for key in self.record_keys(record):
+                bisect.insort(self.keys, key)
+        self.records[record['sku']] = record
+
+    def add_many(self, records):
+        """Bulk add: one sort instead of an insort per key (loading 100k SKUs takes well under a second)."""
+        new_keys = []
+        for record in records:
+            if record['sku'] not in self.records:
+                new_keys.extend(self.record_keys(record))
+            self.records[record['sku']] = record
+        if new_keys:
+            self.keys.extend(new_keys)
+            self.keys.sort()
+
+    def suggest(self, prefix, limit=10):
+        """Records whose product code or item number starts with `prefix` (case-insensitive)."""
+        prefix = prefix.strip().upper()
+        if not prefix:
+            return []
+        suggestions, seen = [], set()
+        position = bisect.bisect_left(self.keys, (prefix, ''))
+        while position < len(self.keys) and len(suggestions) < limit:
+            key, sku = self.keys[position]
+            if not key.startswith(prefix):
+                break
+            if sku not in seen:
+                seen.add(sku)
+                suggestions.append(self.records[sku])
+            position += 1
+        return suggestions
+
+class NgramIndex:
+    """
+    Character n-gram inverted index over SKU product codes and descriptions, for
+    matching spellings like "HD-808 A" and "HD808A". Candidates come only from the
+    posting lists of the query's n-grams, so a lookup never scans the whole catalog.
+    """
+    def __init__(self, n=3, max_postings=2000):
+        self.n = n
+        self.max_postings = max_postings    # n-grams shared by more SKUs than this are too common to rank by
+        self.postings = defaultdict(set)    # ('c' | 'd', gram) -> skus
+        self.code_grams = {}                # sku -> frozenset of code grams
+        self.description_grams = {}         # sku -> frozenset of description grams
+
+    @staticmethod
+    def normalize_code(text):
+        return re.sub(r'[^0-9A-Z]', '', str(text or '').upper())
+
+    def grams(self, text):
+        if not text:
+            return frozenset()
+        padded = f"^{text}$"
+        if len(padded) <= self.n:
+            return frozenset([padded])
+        return frozenset(padded[i:i + self.n] for i in range(len(padded) - self.n + 1))
+
+    def description_text(self, description):
+        return ' '.join(re.findall(r'[0-9a-z]+', str(description or '').lower()))
+
+    def add(self, sku, product_code, description=''):
+        if sku in self.code_grams:
+            self.remove(sku)
+        code_grams = self.grams(self.normalize_code(product_code))
+        description_grams = self.grams(self.description_text(description))
+        self.code_grams[sku] = code_grams
+        self.description_grams[sku] = description_grams
+        for gram in code_grams:
+            self.postings[('c', gram)].add(sku)
+        for gram in description_grams:
+            self.postings[('d', gram)].add(sku)
+
+    def remove(self, sku):
+        for gram in self.code_grams.pop(sku, ()):
+            self.postings[('c', gram)].discard(sku)
+        for gram in self.description_grams.pop(sku, ()):
+            self.postings[('d', gram)].discard(sku)
+
+    @staticmethod
+    def dice(a, b):
+        return 2 * len(a & b) / (len(a) + len(b)) if a and b else 0
+
+    def match(self, product_code, description='', k=5, candidates=50):
+        """
+        Top-k (sku, score) pairs for a product code (and optional description).
+        Score is the Dice coefficient of code n-grams, blended 80/20 with the
+        description's when both sides have one.
+        """
+        query_code = self.grams(self.normalize_code(product_code))
+        query_description = self.grams(self.description_text(description))
+
+        # Count shared n-grams per SKU, skipping grams too common to discriminate
+        posting_lists = [self.postings[key] for key in
+                         [('c', gram) for gram in query_code] + [('d', gram) for gram in query_description]
+                         if self.postings.get(key)]
+        selective = [skus for skus in posting_lists if len(skus) <= self.max_postings]
+        if not selective:
+            # Only common grams (e.g. a very short code) - fall back to the rarest few
+            selective = sorted(posting_lists, key=len)[:2]
+        overlap = Counter()
+        for skus in selective:
+            overlap.update(skus)
+
+        scored = []
+        for sku, _ in overlap.most_common(candidates):
+            score = self.dice(query_code, self.code_grams[sku])
+            if query_description and self.description_grams[sku]:
+                score = 0.8 * score + 0.2 * self.dice(query_description, self.description_grams[sku])
+            scored.append((sku, round(score, 4)))
+        scored.sort(key=lambda pair: pair[1], reverse=True)
+        return scored[:k]
+
+def add_sku_sequence(connection):
+    """
+    sku_catalog.seq: numbers every insert or update in commit order, so a worker's refresh never
+    skips a row another worker committed after it (updated_at is taken before the commit).
+    Existing rows are numbered in rowid order.
+    """
+    if 'seq' not in {row['name'] for row in connection.execute('PRAGMA table_info(sku_catalog)')}:
+        connection.execute('ALTER TABLE sku_catalog ADD COLUMN seq INTEGER')
+        connection.execute('UPDATE sku_catalog SET seq = rowid')
+
+class SkuCatalog(SQLiteStore):
+    """
+    Every product seen in a parsed invoice with its last known unit CBM, unit price,
+    currency and supplier. Persisted in SQLite, served from an in-memory SkuIndex that
+    picks up rows written by other workers every SKU_REFRESH_SECONDS. Lookups hold `lock`
+    like refresh() does, since a refresh changes the indexes in place.
+    """
+    schema = [
+        """CREATE TABLE IF NOT EXISTS sku_catalog (
+            sku TEXT PRIMARY KEY,
+            product_code TEXT NOT NULL,
+            item_number TEXT,
+            description TEXT,
+            unit_cbm REAL,
+            unit_price REAL,
+            currency TEXT,
+            supplier TEXT,
+            updated_at TEXT NOT NULL
+        )""",
+        'CREATE INDEX IF NOT EXISTS idx_sku_catalog_updated_at ON sku_catalog (updated_at)',
+        add_sku_sequence,
+        'CREATE INDEX IF NOT EXISTS idx_sku_catalog_seq ON sku_catalog (seq)'
+    ]
+    columns = ['sku', 'product_code', 'item_number', 'description', 'unit_cbm', 'unit_price',
+               'currency', 'supplier', 'updated_at']
+
+    def __init__(self):
+        super().__init__()
+        self.index = SkuIndex()
+        self.fuzzy = None   # NgramIndex, built on the first match() so /sku/suggest stays cheap to warm
+        self.loaded_seq = 0      # seq of the last row written into the index
+        self.refreshed_at = 0
+        self.lock = threading.Lock()
+
+    def refresh(self, force=False):
+        if not force and time.time() - self.refreshed_at < app.config['SKU_REFRESH_SECONDS']:
+            return
+        with self.lock, closing(self.connect()) as connection:
+            rows = connection.execute(
+                f"SELECT {', '.join(self.columns)}, seq FROM sku_catalog WHERE seq > ? ORDER BY seq",
+                (self.loaded_seq,)).fetchall()
+            records = [{column: row[column] for column in self.columns} for row in rows]
+            self.index.add_many(records)
+            if self.fuzzy is not None:
+                for record in records:
+                    self.fuzzy.add(record['sku'], record['product_code'], record['description'])
+            if rows:
+                self.loaded_seq = rows[-1]['seq']
+            self.refreshed_at = time.time()
+
+    def record(self, records):
+        """Insert or update catalog records (dicts with `columns` minus updated_at)."""
+        now = datetime.now().isoformat()
+        rows = [tuple(record.get(column) for column in self.columns[:-1]) + (now,) for record in records]
+        with closing(self.connect()) as connection, connection:
+            # seq is numbered inside the write transaction, so it follows commit order across workers
+            connection.executemany(
+                f"INSERT INTO sku_catalog ({', '.join(self.columns)}, seq) VALUES ({', '.join('?' * len(self.columns))}, "
+                "(SELECT IFNULL(MAX(seq), 0) + 1 FROM sku_catalog)) "
+                "ON CONFLICT (sku) DO UPDATE SET product_code = excluded.product_code, "
+                "item_number = excluded.item_number, description = excluded.description, "
+                "unit_cbm = excluded.unit_cbm, unit_price = excluded.unit_price, currency = excluded.currency, "
+                "supplier = excluded.supplier, updated_at = excluded.updated_at, seq = excluded.seq", rows)
+        self.refresh(force=True)
+
+    def suggest(self, prefix, limit=10):
+        self.refresh()
+        with self.lock:
+            return self.index.suggest(prefix, limit)
+
+    def match(self, queries, k=5):
+        """Top-k similar catalogued SKUs (records with a `score`) for each (product_code, description)."""
+        self.refresh()
+        with self.lock:
+            if self.fuzzy is None:
+                self.fuzzy = NgramIndex()
+                for record in self.index.records.values():
+                    self.fuzzy.add(record['sku'], record['product_code'], record['description'])
+            return [[dict(self.index.records[sku], score=score)
+                     for sku, score in self.fuzzy.match(product_code, description, k)]
+                    for product_code, description in queries]
+
+sku_catalog = SkuCatalog()
+
+def catalog_records(products, supplier):
+    """Catalog records for parsed products from either upload pipeline."""
+    records = []
+    for product in products:
+        if 'item' in product:
+            # Robust pipeline: item code, unit price and total CBM
+            product_code, item_number = product['item'], ''
+            unit_price, total_volume = product['price'], product['cbm']
+            currency = product.get('currency', 'USD')
+        else:
+            product_code, item_number = product['product_code'], product['item_number']
+            unit_price, total_volume = product['cost_per_unit_usd'], product['total_volume']
+            currency = 'USD'
+        if not product_code:
+            continue
+        quantity = product['quantity']
+        records.append({
+            'sku': f"{product_code} - {item_number}" if item_number else product_code,
+            'product_code': product_code,
+            'item_number': item_number,
+            'description': product.get('description', ''),
+            'unit_cbm': total_volume / quantity if quantity else None,
+            'unit_price': unit_price,
+            'currency': currency,
+            'supplier': supplier
+        })
+    return records
+
+def record_skus(products, supplier):
+    """Add parsed products to the SKU catalog; never fails the upload."""
+    try:
+        sku_catalog.record(catalog_records(products, supplier))
+    except Exception as e:
+        print(f"Could not update SKU catalog: {e}")
+
+@app.route('/sku/suggest', methods=['GET'])
+def suggest_skus():
+    """Prefix autocomplete over catalogued product codes and item numbers: ?q=HD08&limit=10."""
+    try:
+        limit = parse_limit_arg(10, 50)
+    except ValueError:
+        return jsonify({'error': 'מגבלה לא תקינה'}), 400
+    return jsonify({'suggestions': sku_catalog.suggest(request.args.get('q', ''), limit)})
+
+@app.route('/sku/match', methods=['POST'])
+def match_skus():
+    """
+    Reconcile a batch of products against the catalog in one call.
+    Body: {"products": [{"product_code" | "item" | "name": ..., "description": ...}], "k": 5}
+    """
+    data = request.get_json(silent=True) or {}
+    products = data.get('products')
+    if not isinstance(products, list):
+        return jsonify({'error': 'לא סופקו מוצרים'}), 400
+    try:
+        k = int(data.get('k', 5))
+        if k < 1:
+            raise ValueError(f"k must be positive, got {k}")
+        k = min(k, 20)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'k לא תקין'}), 400
+
+    queries = [(product.get('product_code') or product.get('item') or product.get('name') or '',
+                product.get('description') or '') for product in products]
+    matches = sku_catalog.match(queries, k)
+    return jsonify({'matches': [{'query': code, 'matches': product_matches}
+                                for (code, _), product_matches in zip(queries, matches)]})
+# --- END: SKU catalog ---
+
+# --- BEGIN: HS-code tariff table ---
+def normalize_hs_code(code):
+    """
+    An HS code as bare digits, so '8712.00.10' and '871200 10' are the same code.
+    Numeric Excel cells drop the leading zero of chapters 01-09, and the trailing zeros
+    of a subheading typed as a decimal (8712.0010 is read as 8712.001); HS codes always
+    have an even number of digits, so both are put back.
+    """
+    if isinstance(code, str) and code.isdigit():
+        return code
+    if isinstance(code, (int, float)) and not isinstance(code, bool):
+        if code != code:  # NaN
+            return ''
+        whole, _, fraction = f"{code:.10f}".rstrip('0').partition('.')
+        whole = '0' + whole if len(whole) % 2 else whole
+        return whole + (fraction + '0' if len(fraction) % 2 else fraction)
+    return re.sub(r'\D', '', str(code or ''))
+
+class TariffTable(SQLiteStore):
+    """
+    Customs duty rates by HS code, imported from a CSV tariff schedule.
+    A product takes the rate of the longest schedule line its code starts with, so
+    heading 8712 covers 8712.00.10 unless the schedule has a more specific line.
+    Served from an in-memory dict, probed once per code length present in the
+    schedule (a handful: 2, 4, 6, 8, 10 digits) from longest to shortest.
+    """
+    schema = [
+        """CREATE TABLE IF NOT EXISTS tariffs (
+            hs_code TEXT PRIMARY KEY,
+            duty_rate REAL NOT NULL,
+            description TEXT,
+            imported_at TEXT NOT NULL
+        )"""
+    ]
+    min_code_length = 2  # an HS chapter
+
+    def __init__(self):
+        super().__init__()
+        # (hs_code -> (duty_rate, description), distinct code lengths longest first), replaced
+        # as a whole by refresh() so a lookup reads one consistent snapshot without the lock
+        self.schedule = ({}, [])
+        self.version = ''      # changes with every import; part of the /calculate cache key
+        self.refreshed_at = 0
+        self.lock = threading.Lock()
+
+    def refresh(self, force=False):
+        if not force and time.time() - self.refreshed_at < app.config['TARIFF_REFRESH_SECONDS']:
+            return
+        with self.lock, closing(self.connect()) as connection:
+            count, imported_at = connection.execute('SELECT COUNT(*), MAX(imported_at) FROM tariffs').fetchone()
+            version = f"{count}:{imported_at or ''}"
+            if version != self.version:
+                rates = {row['hs_code']: (row['duty_rate'], row['description'])
+                         for row in connection.execute('SELECT hs_code, duty_rate, description FROM tariffs')}
+                self.schedule = (rates, sorted({len(hs_code) for hs_code in rates}, reverse=True))
+                self.version = version
+            self.refreshed_at = time.time()
+
+    @staticmethod
+    def longest_prefix(digits, schedule):
+        """The most specific line of `schedule` covering `digits`, or None."""
+        rates, lengths = schedule
+        for length in lengths:
+            if length <= len(digits) and digits[:length] in rates:
+                return digits[:length]
+        return None
+
+    def lookup(self, hs_code):
+        """Schedule line for one HS code: {hs_code, matched_code, duty_rate, description}, or None."""
+        self.refresh()
+        schedule = self.schedule
+        digits = normalize_hs_code(hs_code)
+        matched = self.longest_prefix(digits, schedule)
+        if matched is None:
+            return None
+        duty_rate, description = schedule[0][matched]
+        return {'hs_code': digits, 'matched_code': matched, 'duty_rate': duty_rate, 'description': description}
+
+    def duty_rates(self, hs_codes):
+        """Duty rate (fraction) for each HS code, 0 for codes the schedule does not cover."""
+        self.refresh()
+        schedule = self.schedule
+        resolved = {}
+        rates = []
+        for hs_code in hs_codes:
+            if hs_code not in resolved:
+                matched = self.longest_prefix(normalize_hs_code(hs_code), schedule)
+                resolved[hs_code] = schedule[0][matched][0] if matched else 0.0
+            rates.append(resolved[hs_code])
+        return rates
+
+    def import_csv(self, text, replace=True):
+        """
+        Load a tariff schedule from CSV text with hs_code and duty_rate (percent, e.g. 12 or 12%)
+        columns and an optional description column. `replace` drops the previous schedule,
+        otherwise lines are added or updated. Returns the number of lines imported. Raises ValueError.
+        """
+        reader = csv.DictReader(io.StringIO(text))
+        fields = {(name or '').strip().lower(): name for name in reader.fieldnames or []}
+        if 'hs_code' not in fields or 'duty_rate' not in fields:
+            raise ValueError("Tariff CSV needs hs_code and duty_rate columns")
+
+        now = datetime.now().isoformat()
+        rows = {}
+        for line_number, row in enumerate(reader, start=2):
+            hs_code = normalize_hs_code(row[fields['hs_code']])
+            if not hs_code:
+                continue
+            if len(hs_code) < self.min_code_length:
+                raise ValueError(f"Invalid HS code on line {line_number}: {row[fields['hs_code']]!r}")
+            raw_rate = (row[fields['duty_rate']] or '').strip().rstrip('%').strip()
+            try:
+                duty_rate = float(raw_rate or 0) / 100
+            except ValueError:
+                raise ValueError(f"Invalid duty_rate on line {line_number}: {raw_rate!r}")
+            description = (row.get(fields['description']) or '').strip() if 'description' in fields else ''
+            rows[hs_code] = (hs_code, duty_rate, description, now)
+
+        with closing(self.connect()) as connection, connection:
+            if replace:
+                connection.execute('DELETE FROM tariffs')
+            connection.executemany(
+                'INSERT INTO tariffs (hs_code, duty_rate, description, imported_at) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (hs_code) DO UPDATE SET duty_rate = excluded.duty_rate, '
+                'description = excluded.description, imported_at = excluded.imported_at', list(rows.values()))
+        self.refresh(force=True)
+        return len(rows)
+
+tariff_table = TariffTable()
+
+@app.route('/tariffs/import', methods=['POST'])
+def import_tariffs():
+    """
+    Upload a CSV tariff schedule (hs_code, duty_rate in percent, description).
+    Replaces the current schedule unless mode=merge.
+    """
+    if 'file' not in request.files or not request.files['file'].filename:
+        return jsonify({'error': 'לא נבחר קובץ'}), 400
+    try:
+        text = request.files['file'].read().decode('utf-8-sig')
+        imported = tariff_table.import_csv(text, replace=request.form.get('mode', 'replace') != 'merge')
+    except UnicodeDecodeError:
+        return jsonify({'error': 'הקובץ חייב להיות CSV בקידוד UTF-8'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'imported': imported, 'total': len(tariff_table.schedule[0])})
+
+@app.route('/tariffs/lookup', methods=['GET'])
+def lookup_tariff():
+    """Duty rate for an HS code: ?hs_code=8712.00.10"""
+    tariff = tariff_table.lookup(request.args.get('hs_code', ''))
+    if tariff is None:
+        return jsonify({'error': 'קוד המכס לא נמצא בטבלת התעריפים'}), 404
+    return jsonify(tariff)
+# --- END: HS-code tariff table ---
+
+FALLBACK_RATES = {
+    'USD_ILS': 3.65,
+    'CNY_USD': 0.14,
+    'CNY_ILS': 0.51
+}
+
+def usd_ils_result(api, data, fetched_at):
+    """/get-exchange-rate body for a provider's response; records the rate. Raises on a malformed response."""
+    rate = api['extract'](data)
+    record_rates({'USD_ILS': rate}, api['url'], fetched_at)
+    return {
+        'success': True,
+        'rate': round(rate, 4),
+        'timestamp': datetime.now().isoformat(),
+        'source': api['url'],
+        'providers': provider_health.states()
+    }
+
+def usd_ils_fallback():
+    """/get-exchange-rate body when no provider answered: the last stored rate, else a default."""
+    stored = stored_rate('USD_ILS')
+    if stored:
+        return {
+            'success': False,
+            'rate': round(stored['rate'], 4),
+            'message': f"לא ניתן לקבל שער עדכני, מוצג השער האחרון שנשמר ({stored['date']})",
+            'timestamp': datetime.now().isoformat(),
+            'stored_at': stored['fetched_at'],
+            'source': stored['source'],
+            'providers': provider_health.states()
+        }
+
+    # Nothing stored yet - return a fallback rate (you can update this manually)
+    return {
+        'success': False,
+        'rate': FALLBACK_RATES['USD_ILS'],
+        'message': 'לא ניתן לקבל שער עדכני, מוצג שער ברירת מחדל',
+        'timestamp': datetime.now().isoformat(),
+        'providers': provider_health.states()
+    }
+
+def currency_rates_result(url, data, fetched_at):
+    """/get-currency-rates body for a provider's response; records the rates. Raises on a malformed response."""
+    # Every pair comes from the fetch's cross-rate matrix (CNY/ILS = USD/ILS / USD/CNY etc.)
+    cross_rates = cross_rates_for(data, url, fetched_at)
+    rates = cross_rates.pairs(targets=('ILS', 'USD'))
+    if not all(pair in rates for pair in ('USD_ILS', 'CNY_USD', 'CNY_ILS')):
+        raise KeyError('ILS/CNY')
+    record_rates(dict(rates, USD_CNY=cross_rates.rate('USD', 'CNY')), url, fetched_at)
+    return {
+        'success': True,
+        'rates': {pair: round(rate, 4) for pair, rate in rates.items()},
+        'timestamp': datetime.now().isoformat(),
+        'source': url,
+        'providers': provider_health.states()
+    }
+
+def currency_rates_fallback():
+    """/get-currency-rates body when no provider answered: the last stored rates, else defaults."""
+    stored = {pair: stored_rate(pair) for pair in ('USD_ILS', 'CNY_USD', 'CNY_ILS')}
+    if all(stored.values()):
+        for code in CURRENCIES:
+            for target in ('ILS', 'USD'):
+                pair = f"{code}_{target}"
+                if code != target and pair not in stored:
+                    row = stored_rate(pair)
+                    if row:
+                        stored[pair] = row
+        return {
+            'success': False,
+            'rates': {pair: round(row['rate'], 4) for pair, row in stored.items()},
+            'message': f"לא ניתן לקבל שערים עדכניים, מוצגים השערים האחרונים שנשמרו ({stored['USD_ILS']['date']})",
+            'timestamp': datetime.now().isoformat(),
+            'stored_at': stored['USD_ILS']['fetched_at'],
+            'providers': provider_health.states()
+        }
+
+    # Nothing stored yet - fallback rates
+    return {
+        'success': False,
+        'rates': dict(FALLBACK_RATES),
+        'message': 'לא ניתן לקבל שערים עדכניים, מוצגים שערי ברירת מחדל',
+        'timestamp': datetime.now().isoformat(),
+        'providers': provider_health.states()
+    }
+
 @app.route('/get-exchange-rate', methods=['GET'])
 def get_exchange_rate():
     """Fetch the latest USD/ILS exchange rate from a reliable API."""
     try:
-        # Try multiple APIs for reliability
-        apis = [
-            {
-                'url': 'https://api.exchangerate-api.com/v4/latest/USD',
-                'extract': lambda data: data['rates']['ILS']
-            },
-            {
-                'url': 'https://open.er-api.com/v6/latest/USD',
-                'extract': lambda data: data['rates']['ILS']
-            },
-            {
-                'url': 'https://api.frankfurter.app/latest?from=USD&to=ILS',
-                'extract': lambda data: data['rates']['ILS']
-            }
-        ]
-        
-        for api in apis:
+        # Try multiple APIs for reliability, healthiest first
+        for api in usd_ils_providers():
             try:
-                response = requests.get(api['url'], timeout=5)
-                if response.status_code == 200:
-                    data = response.json()
-                    rate = api['extract'](data)
-                    return jsonify({
-                        'success': True,
-                        'rate': round(rate, 4),
-                        'timestamp': datetime.now().isoformat(),
-                        'source': api['url']
-                    })
+                data, fetched_at = fetch_rates_json(api['url'], api['extract'])
+                if data is not None:
+                    return jsonify(usd_ils_result(api, data, fetched_at))
+            except ProviderUnavailable:
+                continue
             except Exception as e:
                 print(f"API {api['url']} failed: {str(e)}")
                 continue
-        
-        # If all APIs fail, return a fallback rate (you can update this manually)
-        fallback_rate = 3.65  # Approximate current rate
-        return jsonify({
-            'success': False,
-            'rate': fallback_rate,
-            'message': 'לא ניתן לקבל שער עדכני, מוצג שער ברירת מחדל',
-            'timestamp': datetime.now().isoformat()
-        })
-        
+
+        # If all APIs fail, use the last rate we stored
+        return jsonify(usd_ils_fallback())
+
     except Exception as e:
         return jsonify({
             'success': False,
             'error': f'שגיאה בקבלת שער חליפין: {str(e)}',
-            'rate': 3.65  # Fallback rate
+            'rate': FALLBACK_RATES['USD_ILS']
         }), 500
 
 @app.route('/get-currency-rates', methods=['GET'])
 def get_currency_rates():
     """Fetch multiple currency exchange rates for the converter."""
     try:
-        # Try to get rates from a comprehensive API
-        apis = [
-            {
-                'url': 'https://api.exchangerate-api.com/v4/latest/USD',
-                'extract': lambda data: {
-                    'USD_ILS': data['rates']['ILS'],
-                    'USD_CNY': data['rates']['CNY']
-                }
-            },
-            {
-                'url': 'https://open.er-api.com/v6/latest/USD',
-                'extract': lambda data: {
-                    'USD_ILS': data['rates']['ILS'],
-                    'USD_CNY': data['rates']['CNY']
-                }
-            }
-        ]
-        
-        for api in apis:
+        # Try to get rates from a comprehensive API, healthiest first
+        for url in currency_rate_providers():
             try:
-                response = requests.get(api['url'], timeout=5)
-                if response.status_code == 200:
-                    data = response.json()
-                    rates = api['extract'](data)
-                    
-                    # Calculate CNY/ILS rate (USD/ILS / USD/CNY)
-                    cny_ils_rate = rates['USD_ILS'] / rates['USD_CNY']
-                    cny_usd_rate = 1 / rates['USD_CNY']  # Convert USD/CNY to CNY/USD
-                    
-                    return jsonify({
-                        'success': True,
-                        'rates': {
-                            'USD_ILS': round(rates['USD_ILS'], 4),
-                            'CNY_USD': round(cny_usd_rate, 4),
-                            'CNY_ILS': round(cny_ils_rate, 4)
-                        },
-                        'timestamp': datetime.now().isoformat(),
-                        'source': api['url']
-                    })
+                data, fetched_at = fetch_rates_json(url, usd_rate_table)
+                if data is not None:
+                    return jsonify(currency_rates_result(url, data, fetched_at))
+            except ProviderUnavailable:
+                continue
             except Exception as e:
-                print(f"API {api['url']} failed: {str(e)}")
+                print(f"API {url} failed: {str(e)}")
                 continue
-        
-        # Fallback rates if all APIs fail
-        fallback_rates = {
-            'USD_ILS': 3.65,
-            'CNY_USD': 0.14,
-            'CNY_ILS': 0.51
-        }
-        
-        return jsonify({
-            'success': False,
-            'rates': fallback_rates,
-            'message': 'לא ניתן לקבל שערים עדכניים, מוצגים שערי ברירת מחדל',
-            'timestamp': datetime.now().isoformat()
-        })
-        
+
+        # If all APIs fail, use the last rates we stored
+        return jsonify(currency_rates_fallback())
+
     except Exception as e:
         return jsonify({
             'success': False,
             'error': f'שגיאה בקבלת שערי חליפין: {str(e)}',
-            'rates': {
-                'USD_ILS': 3.65,
-                'CNY_USD': 0.14,
-                'CNY_ILS': 0.51
-            }
+            'rates': dict(FALLBACK_RATES)
         }), 500
 
 # --- BEGIN: Robust Excel Extraction Logic (from analyze_excel.py) ---
+# Currency markers in price headers, checked in order (HK$ before $)
+CURRENCY_MARKERS = [
+    ('HKD', ['hkd', 'hk$']),
+    ('RMB', ['rmb', 'cny', '¥', '￥', '元']),
+    ('EUR', ['eur', '€']),
+    ('USD', ['usd', '$'])
+]
+
+def detect_currency(header):
+    """Currency code named in a price column header ("FOB PRICE (RMB)", "Unit Price €"), or None."""
+    header = header.lower()
+    for currency, markers in CURRENCY_MARKERS:
+        if any(marker in header for marker in markers):
+            return currency
+    return None
+
+def is_hs_code_header(val_str):
+    """Header of a customs HS code column: "HS Code", "H.S. No.", "Tariff code"..."""
+    return bool(re.search(r'\bh\.?\s?s\.?(\s|$|code|no)', val_str)) or 'tariff' in val_str or 'customs code' in val_str
+
 def find_header_and_columns(df):
     # Strict quantity keywords
     strict_quantity_keywords = ['quantity', 'qty', 'pcs', 'pieces', 'units', 'sets/ctn', 'ctn']
@@ -1268,6 +3785,8 @@ def find_header_and_columns(df):
             for key, keywords in header_keywords.items():
                 if key == 'quantity':
                     continue  # Already handled strictly above
+                if key == 'item' and is_hs_code_header(val_str):
+                    continue  # "HS Code" is not the product code
                 if any(k in val_str for k in keywords):
                     column_map[key] = col_idx
                     print(f"Found {key} column at index {col_idx}: '{val}'")
@@ -1295,6 +3814,8 @@ def find_header_and_columns(df):
                 for key, keywords in header_keywords.items():
                     if key == 'quantity':
                         continue
+                    if key == 'item' and is_hs_code_header(val_str):
+                        continue
                     if any(k in val_str for k in keywords):
                         temp_column_map[key] = col_idx
                 if any(word in val_str for word in ['qty', 'quantity', 'pcs', 'price', 'cost', 'cbm', 'volume', 'amount', 'total']):
@@ -1330,14 +3851,38 @@ def find_header_and_columns(df):
             print(f"Using price column {price_col} for unit_price")
         else:
             print("No price column found - will not set unit_price")
+
+        # HS code column (customs tariff lookup)
+        for col_idx, val in enumerate(header_row):
+            if pd.isna(val):
+                continue
+            if is_hs_code_header(str(val).strip().lower()) and column_map.get('item') != col_idx:
+                column_map['hs_code'] = col_idx
+                print(f"Found HS code column at {col_idx}: '{val}'")
+                break
     else:
         print("No header row found - cannot detect price columns")
     
     return header_row_idx, column_map
 
-def extract_products_from_excel(filepath):
-    df = pd.read_excel(filepath, header=None)
+def extract_products_from_excel(filepath, timings=None, failures=None):
+    # Stage timings (seconds) are recorded into `timings` as each stage finishes,
+    # so a failed parse still reports how far it got.
+    if timings is None:
+        timings = {}
+    stage_start = time.perf_counter()
+    df = read_table(filepath)
+    timings['read_excel'] = time.perf_counter() - stage_start
+    return extract_products_from_sheet(df, timings, failures)
+
+def extract_products_from_sheet(df, timings, failures=None):
+    """
+    Header detection and row extraction for one worksheet read with header=None.
+    Cells that are not numbers are counted per column into `failures` ({'quantity': 2}).
+    """
+    stage_start = time.perf_counter()
     header_row_idx, column_map = find_header_and_columns(df)
+    timings['find_header'] = time.perf_counter() - stage_start
     if header_row_idx is None:
         raise ValueError("Could not find a suitable header row.")
     
@@ -1366,70 +3911,324 @@ def extract_products_from_excel(filepath):
     
     print(f"Found columns: {column_map}")
     
-    # Determine currency type for price column
+    # Determine currency type for the price (or amount) column
     price_currency = 'USD'
-    if 'unit_price' in column_map:
-        header_row = df.iloc[header_row_idx]
-        price_header = str(header_row[column_map['unit_price']]).strip()
-        # Check if header contains 'RMB' or 'rmb' (case-insensitive)
-        if 'rmb' in price_header.lower():
-            price_currency = 'RMB'
-            print(f"Detected RMB currency from header: '{price_header}'")
-        elif 'usd' in price_header.lower() or '$' in price_header:
-            price_currency = 'USD'
-            print(f"Detected USD currency from header: '{price_header}'")
-        else:
-            print(f"No specific currency detected in header: '{price_header}', defaulting to USD")
+    price_header = str(df.iloc[header_row_idx][column_map.get('unit_price', column_map.get('total_amount'))]).strip()
+    detected_currency = detect_currency(price_header)
+    if detected_currency:
+        price_currency = detected_currency
+        print(f"Detected {price_currency} currency from header: '{price_header}'")
+    else:
+        print(f"No specific currency detected in header: '{price_header}', defaulting to USD")
     
+    stage_start = time.perf_counter()
+    # Product rows run from below the header to the first row without an item (or a totals row)
+    items = df.iloc[header_row_idx + 1:, column_map['item']]
+    stops = (items.isna() | items.map(lambda value: isinstance(value, str) and 'total' in value.lower())).to_numpy()
+    end_row = header_row_idx + 1 + (int(stops.argmax()) if stops.any() else len(items))
+
+    # Numeric columns are parsed once each, with the column's own decimal separator, or the
+    # one the numeric columns show together when a column alone doesn't tell ("2.500")
+    numeric_fields = [field for field in ('quantity', 'cbm', 'unit_price', 'total_amount') if field in column_map]
+    columns = {field: df.iloc[header_row_idx + 1:end_row, column_map[field]] for field in numeric_fields}
+    decimal = sheet_decimal_separator(list(columns.values()))
+    numbers, failed = {}, {}
+    for field in numeric_fields:
+        column, column_failed = coerce_numeric(columns[field], decimal)
+        numbers[field], failed[field] = column.to_numpy(), column_failed.to_numpy()
+        if column_failed.any():
+            print(f"Could not parse {int(column_failed.sum())} {field} values (col {column_map[field]})")
+            if failures is not None:
+                failures[field] = failures.get(field, 0) + int(column_failed.sum())
+
+    def number(field, position):
+        value = numbers[field][position] if field in numbers else float('nan')
+        return None if value != value else float(value)
+
     products = []
-    for idx in range(header_row_idx + 1, len(df)):
+    for idx in range(header_row_idx + 1, end_row):
+        position = idx - header_row_idx - 1
         row = df.iloc[idx]
-        item_val = row[column_map['item']] if 'item' in column_map else None
-        if pd.isna(item_val) or (isinstance(item_val, str) and 'total' in item_val.lower()):
-            break
-        
-        # Extract values with better error handling
-        try:
-            quantity = float(row[column_map['quantity']]) if 'quantity' in column_map and pd.notna(row[column_map['quantity']]) else 0
-            cbm = float(row[column_map['cbm']]) if 'cbm' in column_map and pd.notna(row[column_map['cbm']]) else 0
-            description = str(row[column_map['description']]).strip() if 'description' in column_map and pd.notna(row[column_map['description']]) else ''
-            
-            # Handle price/amount extraction
-            unit_price = 0
-            if 'unit_price' in column_map and pd.notna(row[column_map['unit_price']]):
-                unit_price = float(row[column_map['unit_price']])
-                print(f"Found unit price: {unit_price}")
-            elif 'total_amount' in column_map and pd.notna(row[column_map['total_amount']]):
-                total_amount = float(row[column_map['total_amount']])
-                if quantity > 0:
-                    unit_price = total_amount / quantity
-                    print(f"Found total amount: {total_amount}, calculated unit price: {unit_price:.2f}")
-                else:
-                    unit_price = total_amount  # If no quantity, treat as unit price
-                    print(f"No quantity found, treating amount as unit price: {unit_price}")
-            
-            product = {
-                'item': str(item_val).strip() if item_val is not None else '',
-                'description': description,
-                'price': unit_price,
-                'quantity': quantity,
-                'cbm': cbm,
-                'currency': price_currency
-            }
-            
-            # Only add product if it has valid data
-            if product['item'] and (quantity > 0 or unit_price > 0):
-                products.append(product)
-                print(f"Added product: {product['item']} - Qty: {quantity}, Unit Price: {unit_price:.2f}, CBM: {cbm}, Currency: {price_currency}")
-            
-        except (ValueError, TypeError) as e:
-            print(f"Error processing row {idx}: {e}")
+        item_val = row[column_map['item']]
+
+        # A row with a cell that is not a number is skipped, as a whole
+        unparsed = [field for field in failed if failed[field][position] and
+                    (field != 'total_amount' or number('unit_price', position) is None)]
+        if unparsed:
+            print(f"Error processing row {idx}: could not parse {', '.join(unparsed)}")
             continue
+
+        quantity = number('quantity', position) or 0
+        cbm = number('cbm', position) or 0
+        description = str(row[column_map['description']]).strip() if 'description' in column_map and pd.notna(row[column_map['description']]) else ''
+        hs_code = normalize_hs_code(row[column_map['hs_code']]) if 'hs_code' in column_map and pd.notna(row[column_map['hs_code']]) else ''
+
+        # Handle price/amount extraction
+        unit_price = 0
+        if number('unit_price', position) is not None:
+            unit_price = number('unit_price', position)
+            print(f"Found unit price: {unit_price}")
+        elif number('total_amount', position) is not None:
+            total_amount = number('total_amount', position)
+            if quantity > 0:
+                unit_price = total_amount / quantity
+                print(f"Found total amount: {total_amount}, calculated unit price: {unit_price:.2f}")
+            else:
+                unit_price = total_amount  # If no quantity, treat as unit price
+                print(f"No quantity found, treating amount as unit price: {unit_price}")
+
+        product = {
+            'item': str(item_val).strip() if item_val is not None else '',
+            'description': description,
+            'price': unit_price,
+            'quantity': quantity,
+            'cbm': cbm,
+            'currency': price_currency,
+            'hs_code': hs_code
+        }
+
+        # Only add product if it has valid data
+        if product['item'] and (quantity > 0 or unit_price > 0):
+            products.append(product)
+            print(f"Added product: {product['item']} - Qty: {quantity}, Unit Price: {unit_price:.2f}, CBM: {cbm}, Currency: {price_currency}")
     
+    timings['extract_rows'] = time.perf_counter() - stage_start
     print(f"Total products extracted: {len(products)}")
     return products
+
+# find_header_and_columns only looks at this many rows
+HEADER_SCAN_ROWS = 15
+
+sheet_pool = None
+
+def sheet_executor():
+    """Process pool for parsing worksheets in parallel, started on first multi-sheet upload."""
+    global sheet_pool
+    if sheet_pool is None:
+        sheet_pool = ProcessPoolExecutor(max_workers=app.config['SHEET_WORKERS'])
+    return sheet_pool
+
+def map_in_pool(function, *iterables):
+    """list(map()) over the parse worker pool; in-process when SHEET_WORKERS is 1 or the pool breaks."""
+    global sheet_pool
+    if app.config['SHEET_WORKERS'] > 1:
+        try:
+            return list(sheet_executor().map(function, *iterables))
+        except BrokenExecutor as e:
+            print(f"Parse worker pool failed, parsing in-process: {e}")
+            sheet_pool = None
+    return list(map(function, *iterables))
+
+def extract_sheet(filepath, sheet_name, workbook=None):
+    """
+    Robust extraction of one worksheet, read from `workbook` when the file is already open.
+    Sheets without a header in their first rows are skipped.
+    Returns {'sheet', 'products', 'seconds'} plus 'skipped' or 'error' when it has no products,
+    and 'parse_failures' when some numeric cells could not be parsed.
+    """
+    start = time.perf_counter()
+    report = {'sheet': sheet_name, 'products': []}
+    failures = {}
+    try:
+        df = read_table(filepath, sheet_name, workbook=workbook)
+        if find_header_and_columns(df.head(HEADER_SCAN_ROWS))[0] is None:
+            report['skipped'] = 'no header row'
+        else:
+            report['products'] = extract_products_from_sheet(df, {}, failures)
+    except Exception as e:
+        report['error'] = str(e)
+    if failures:
+        report['parse_failures'] = failures
+    report['seconds'] = round(time.perf_counter() - start, 4)
+    return report
+
+def extract_sheets(filepath, sheet_names):
+    """Reports of a group of worksheets (runs in a pool worker), opening the workbook once."""
+    with open_workbook(filepath) as workbook:
+        return [extract_sheet(filepath, sheet_name, workbook) for sheet_name in sheet_names]
+
+def extract_products_from_workbook(filepath, timings=None, parallel=True, failures=None):
+    """
+    Products from every worksheet with a recognizable header, each tagged with its `sheet`.
+    Sheets are split among SHEET_WORKERS processes, each opening the workbook once, so
+    the wall time is about that of the largest group; parallel=False parses them one after
+    another from one open workbook (inside a pool worker). Returns (products, per-sheet
+    reports). Raises ValueError if no sheet has products. Unparseable numeric cells of all
+    sheets are counted into `failures`.
+    """
+    if timings is None:
+        timings = {}
+    stage_start = time.perf_counter()
+    with open_workbook(filepath) as workbook:
+        sheet_names = list_sheets(filepath, workbook)
+        timings['list_sheets'] = time.perf_counter() - stage_start
+        stage_start = time.perf_counter()
+        workers = min(app.config['SHEET_WORKERS'], len(sheet_names)) if parallel else 1
+        if workers == 1:
+            reports = [extract_sheet(filepath, sheet_name, workbook) for sheet_name in sheet_names]
+    if workers > 1:
+        # One group of sheets per worker (round-robin), reports put back in sheet order
+        groups = [sheet_names[idx::workers] for idx in range(workers)]
+        order = {sheet_name: idx for idx, sheet_name in enumerate(sheet_names)}
+        reports = sorted(itertools.chain.from_iterable(map_in_pool(extract_sheets, [filepath] * workers, groups)),
+                         key=lambda report: order[report['sheet']])
+    timings['extract_sheets'] = time.perf_counter() - stage_start
+
+    products = []
+    for report in reports:
+        for product in report['products']:
+            product['sheet'] = report['sheet']
+            products.append(product)
+        report['products'] = len(report['products'])
+        if failures is not None:
+            for field, count in report.get('parse_failures', {}).items():
+                failures[field] = failures.get(field, 0) + count
+    if not products:
+        errors = [f"{report['sheet']}: {report['error']}" for report in reports if 'error' in report]
+        raise ValueError('; '.join(errors) or "Could not find a suitable header row on any sheet.")
+    return products, reports
 # --- END: Robust Excel Extraction Logic ---
 
+def file_sha256(filepath):
+    """Hex SHA-256 of a file, used to link calculations to the supplier file they came from."""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# --- BEGIN: Slow/failed upload capture ---
+# Uploads that fail or exceed CAPTURE_LATENCY_THRESHOLD are kept in CAPTURE_FOLDER
+# (workbook bytes + <id>.json with stage timings and parsed output) so they can be
+# replayed offline with replay_captures.py.
+
+CAPTURE_LABEL_SEPARATORS = (':', '：')
+
+def scrub_description_text(text):
+    """Mask the letters of a description, keeping line layout, digits and field labels."""
+    scrubbed_lines = []
+    for line in str(text).split('\n'):
+        # Item numbers are identifiers, not descriptions - keep them so names still match
+        if 'Item No.' in line:
+            scrubbed_lines.append(line)
+            continue
+        label, value = '', line
+        for separator in CAPTURE_LABEL_SEPARATORS:
+            if separator in line:
+                label, value = line.split(separator, 1)
+                label += separator
+                break
+        scrubbed_lines.append(label + re.sub(r'[^\W\d_]', 'x', value))
+    return '\n'.join(scrubbed_lines)
+
+def scrub_workbook(source_path, target_path):
+    """
+    Write a copy of the workbook with description text masked.
+    The copy is always written as .xlsx since xlrd cannot write .xls files.
+    """
+    df = read_table(source_path)
+    header_row_idx, column_map = find_header_and_columns(df)
+    first_data_row = header_row_idx + 1 if header_row_idx is not None else 0
+    description_col = column_map.get('description')
+
+    for row_idx in range(first_data_row, len(df)):
+        for col_idx in range(len(df.columns)):
+            value = df.iat[row_idx, col_idx]
+            if not isinstance(value, str):
+                continue
+            if col_idx == description_col:
+                df.iat[row_idx, col_idx] = scrub_description_text(value)
+            elif '\n' in value:
+                # Multi-line product cells: keep the first line (product code)
+                first_line, rest = value.split('\n', 1)
+                df.iat[row_idx, col_idx] = first_line + '\n' + scrub_description_text(rest)
+
+    df.to_excel(target_path, header=False, index=False, engine='openpyxl')
+
+def prune_captures(capture_folder, max_files, max_bytes):
+    """Delete the oldest captures until the folder is within its file and size caps."""
+    captures = []
+    for name in os.listdir(capture_folder):
+        if not name.endswith('.json'):
+            continue
+        capture_id = name[:-len('.json')]
+        paths = [os.path.join(capture_folder, n) for n in os.listdir(capture_folder)
+                 if n.startswith(capture_id + '.')]
+        size = sum(os.path.getsize(path) for path in paths)
+        mtime = os.path.getmtime(os.path.join(capture_folder, name))
+        captures.append((mtime, size, paths))
+
+    captures.sort()
+    total_bytes = sum(size for _, size, _ in captures)
+    while captures and (len(captures) > max_files or total_bytes > max_bytes):
+        _, size, paths = captures.pop(0)
+        for path in paths:
+            os.remove(path)
+        total_bytes -= size
+
+def maybe_capture_upload(filepath, route, timings, products=None, error=None, options=None):
+    """
+    Keep the uploaded workbook and its stage timings (and parser `options`) if the upload failed or was slow.
+    Capturing never affects the response - any problem here is only logged.
+    """
+    total_seconds = sum(timings.values())
+    if not app.config['CAPTURE_ENABLED']:
+        return None
+    if error is None and total_seconds < app.config['CAPTURE_LATENCY_THRESHOLD']:
+        return None
+
+    try:
+        capture_folder = app.config['CAPTURE_FOLDER']
+        os.makedirs(capture_folder, exist_ok=True)
+        if os.path.getsize(filepath) > app.config['CAPTURE_MAX_BYTES']:
+            print(f"Upload too large to capture: {filepath}")
+            return None
+
+        capture_id = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        scrub = app.config['CAPTURE_SCRUB_DESCRIPTIONS']
+        extension = '.xlsx' if scrub else os.path.splitext(filepath)[1].lower()
+        workbook_path = os.path.join(capture_folder, capture_id + extension)
+
+        if scrub:
+            try:
+                scrub_workbook(filepath, workbook_path)
+            except Exception as e:
+                # Never store unscrubbed bytes when scrubbing was requested
+                print(f"Could not scrub workbook, capturing timings only: {e}")
+                workbook_path = None
+        else:
+            with open(filepath, 'rb') as src, open(workbook_path, 'wb') as dst:
+                dst.write(src.read())
+
+        if products is not None and scrub:
+            products = [dict(p, description=scrub_description_text(p.get('description', '')))
+                        for p in products]
+
+        meta = {
+            'id': capture_id,
+            'route': route,
+            'options': options or {},
+            'original_filename': os.path.basename(filepath),
+            'workbook': os.path.basename(workbook_path) if workbook_path else None,
+            'captured_at': datetime.now().isoformat(),
+            'reason': 'error' if error is not None else 'slow',
+            'error': str(error) if error is not None else None,
+            'timings': timings,
+            'total_seconds': total_seconds,
+            'scrubbed': scrub,
+            'products': products
+        }
+        with open(os.path.join(capture_folder, capture_id + '.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=2, default=str)
+
+        prune_captures(capture_folder, app.config['CAPTURE_MAX_FILES'], app.config['CAPTURE_MAX_BYTES'])
+        print(f"Captured {meta['reason']} upload as {capture_id} ({total_seconds:.2f}s)")
+        return capture_id
+    except Exception as e:
+        print(f"Upload capture failed: {e}")
+        return None
+# --- END: Slow/failed upload capture ---
+
 @app.route('/upload-robust', methods=['POST'])
 def upload_file_robust():
     if 'file' not in request.files:
@@ -1437,25 +4236,219 @@ def upload_file_robust():
     file = request.files['file']
     if file.filename == '':
         return jsonify({'error': 'לא נבחר קובץ'}), 400
-    if not file.filename.endswith(('.xls', '.xlsx')):
-        return jsonify({'error': 'הקובץ חייב להיות בפורמט אקסל (.xls או .xlsx)'}), 400
+    if not file.filename.lower().endswith(UPLOAD_EXTENSIONS):
+        return jsonify({'error': 'הקובץ חייב להיות בפורמט אקסל (.xls או .xlsx), ODS או CSV/TSV'}), 400
+    try:
+        export_format = export_format_arg(request.form.get('format'))
+    except ValueError:
+        return jsonify({'error': 'פורמט ייצוא לא נתמך'}), 400
+    if export_format != 'json' and not pyarrow_available():
+        return jsonify({'error': PYARROW_MISSING}), 501
     try:
-        filename = secure_filename(file.filename)
+        filename = upload_filename(file.filename)
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
         file.save(filepath)
+        timings = {}
+        failures = {}
+        options = {'all_sheets': request.form.get('sheets', app.config['UPLOAD_SHEETS']) == 'all'}
+        export = None
         try:
-            products = extract_products_from_excel(filepath)
+            sheets = None
+            if options['all_sheets']:
+                products, sheets = extract_products_from_workbook(filepath, timings=timings, failures=failures)
+            else:
+                products = extract_products_from_excel(filepath, timings=timings, failures=failures)
             message = f"הקובץ עובד בהצלחה! נמצאו {len(products)} מוצרים. (שיטה רובסטית)"
-            response = {'message': message, 'products': products, 'total_products': len(products)}
+            response = {'message': message, 'products': products, 'total_products': len(products),
+                        'file_hash': file_sha256(filepath), 'parse_failures': failures}
+            if sheets is not None:
+                response['sheets'] = sheets
+            maybe_capture_upload(filepath, 'upload-robust', timings, products=products, options=options)
+            record_skus(products, supplier=filename)
+            if export_format != 'json':
+                export = products_table(products)
         except Exception as e:
             response = {'error': f'שגיאה בעיבוד הקובץ: {str(e)}'}
+            maybe_capture_upload(filepath, 'upload-robust', timings, error=e, options=options)
         os.remove(filepath)
+        if export is not None:
+            return columnar_response(export, export_format, os.path.splitext(filename)[0])
         return jsonify(response)
     except Exception as e:
         if 'filepath' in locals() and os.path.exists(filepath):
             os.remove(filepath)
         return jsonify({'error': f'שגיאה בעיבוד הקובץ: {str(e)}'}), 500
 
+# --- BEGIN: Batch upload ---
+def extract_file(filepath, all_sheets=False):
+    """
+    Robust extraction of one file of a batch (runs in a pool worker; with all_sheets its
+    worksheets are parsed one after another in that worker).
+    Returns {'products', 'file_hash', 'timings', 'parse_failures', 'seconds'} plus 'sheets'
+    and/or 'error'.
+    """
+    start = time.perf_counter()
+    report = {'products': [], 'timings': {}, 'parse_failures': {}}
+    try:
+        report['file_hash'] = file_sha256(filepath)
+        if all_sheets:
+            report['products'], report['sheets'] = extract_products_from_workbook(
+                filepath, timings=report['timings'], parallel=False, failures=report['parse_failures'])
+        else:
+            report['products'] = extract_products_from_excel(filepath, timings=report['timings'],
+                                                             failures=report['parse_failures'])
+    except Exception as e:
+        report['error'] = str(e)
+    report['seconds'] = round(time.perf_counter() - start, 4)
+    return report
+
+def consolidate_products(file_products):
+    """
+    Merge the products of several files, given as (file name, products) pairs in upload order.
+    Lines with the same item code and currency become one product with summed quantity and
+    CBM and the quantity-weighted unit price; each source line is kept under 'sources',
+    tagged with its file (and sheet).
+    """
+    consolidated = {}
+    for file_name, products in file_products:
+        for product in products:
+            source = {'file': file_name, 'quantity': product['quantity'], 'cbm': product['cbm'],
+                      'price': product['price']}
+            if 'sheet' in product:
+                source['sheet'] = product['sheet']
+            key = (product['item'].strip().upper(), product['currency'])
+            merged = consolidated.get(key)
+            if merged is None:
+                merged = consolidated[key] = {field: value for field, value in product.items() if field != 'sheet'}
+                merged['sources'] = [source]
+                continue
+            merged['sources'].append(source)
+            merged['quantity'] += product['quantity']
+            merged['cbm'] += product['cbm']
+            merged['description'] = merged['description'] or product['description']
+            merged['hs_code'] = merged['hs_code'] or product['hs_code']
+
+    for merged in consolidated.values():
+        if len(merged['sources']) > 1 and merged['quantity'] > 0:
+            value = sum(source['quantity'] * source['price'] for source in merged['sources'])
+            merged['price'] = value / merged['quantity']
+    return list(consolidated.values())
+
+@app.route('/upload-batch', methods=['POST'])
+def upload_batch():
+    """
+    All the supplier files of one container (form field `files`, repeated) parsed in parallel,
+    one pool worker per file, and merged into a single product list (see consolidate_products).
+    """
+    files = [file for file in request.files.getlist('files') if file.filename]
+    if not files:
+        return jsonify({'error': 'לא נבחר קובץ'}), 400
+    if len(files) > app.config['BATCH_MAX_FILES']:
+        return jsonify({'error': f"ניתן להעלות עד {app.config['BATCH_MAX_FILES']} קבצים בבת אחת"}), 400
+    if not all(file.filename.lower().endswith(UPLOAD_EXTENSIONS) for file in files):
+        return jsonify({'error': 'הקובץ חייב להיות בפורמט אקסל (.xls או .xlsx), ODS או CSV/TSV'}), 400
+
+    all_sheets = request.form.get('sheets', app.config['UPLOAD_SHEETS']) == 'all'
+    filepaths = []
+    try:
+        for file in files:
+            # Prefixed: two suppliers' files are often both called "PI.xlsx"
+            filepath = os.path.join(app.config['UPLOAD_FOLDER'], f"{uuid.uuid4().hex}_{upload_filename(file.filename)}")
+            file.save(filepath)
+            filepaths.append(filepath)
+
+        start = time.perf_counter()
+        reports = map_in_pool(extract_file, filepaths, [all_sheets] * len(filepaths))
+        seconds = round(time.perf_counter() - start, 4)
+
+        file_products = []
+        for file, report in zip(files, reports):
+            file_products.append((file.filename, report['products']))
+            record_skus(report['products'], supplier=upload_filename(file.filename))
+            report['file'] = file.filename
+            report['products'] = len(report['products'])
+        products = consolidate_products(file_products)
+        if not products:
+            errors = [f"{report['file']}: {report['error']}" for report in reports if 'error' in report]
+            return jsonify({'error': f"שגיאה בעיבוד הקבצים: {'; '.join(errors)}", 'files': reports})
+
+        # One hash for the set of files, linking calculations to the batch
+        batch_hash = hashlib.sha256(''.join(sorted(report.get('file_hash', '') for report in reports)).encode()).hexdigest()
+        lines = sum(report['products'] for report in reports)
+        return jsonify({
+            'message': f"{len(files)} קבצים עובדו בהצלחה! נמצאו {len(products)} מוצרים ({lines} שורות).",
+            'products': products,
+            'total_products': len(products),
+            'files': reports,
+            'file_hash': batch_hash,
+            'seconds': seconds
+        })
+    except Exception as e:
+        return jsonify({'error': f'שגיאה בעיבוד הקבצים: {str(e)}'}), 500
+    finally:
+        for filepath in filepaths:
+            if os.path.exists(filepath):
+                os.remove(filepath)
+# --- END: Batch upload ---
+
+# --- BEGIN: Preload and warm-up (see gunicorn_preload.py) ---
+# Minimal PI workbook (.xls, zlib + base64) used to warm the xlrd engine.
+# The .xlsx counterpart is built with openpyxl at warm-up time.
+WARMUP_XLS = (
+    'eNrtWE1oE1EQ/t7mp0ls06SmYiuUULBqW4XixUu7bf0pOTSkotQ/0DTdQ2ibhDUe9GK15igInhQvhV68VL34gwp6'
+    '8yBU9CAIQqI3PQkKHtqs8ya7JdUeEtCi8r7lzZuZN2/e7M772d1XS+Hi/L32En7CAFwoW354q3SCit8RQqB2y5Ks'
+    'U/uoWAr/FPw+SqTXg8dNLxtkDmW+S9Bw1/2cKPCByinkEM9mjOgGYphjSAoZQz9RgVukCaKNo2phmmK6mekdtnzC'
+    'dJA1V5n2k21RnMCSHu/eZ8/iY1ontwUh/T7gPu9Y04dWvJCz+OI1UbH1YMhMJ6f/zoYOdyMWQHkbMTKGmZwuIkIJ'
+    'XMA3Kwp8dVbqs6jSb6xegPTf1+ob1tFf19zALKwzPMELCOCTS7ZoSMSWEZOZ5UIbayxvzETj2T2bgAPG2ZSZzuXT'
+    '2QxZjx05HgCOZtL5aMJMpwxS7R8epck81Eddx5PmzO5zuYDcuXmlh9as9CZeAY1EJ9HMfJjXQYiGXL795fXoREI/'
+    'zZpZ3t0rZ8B2GTYsXJI9qHMQlaAlPFS6me9hepm9bmO+nWmEbKjuSrTazKE5trnCrV00zl7GG31HFb+T+MLnsYcd'
+    'hY/6LuIXR0oXIotv9Xl00pk0Sf3lNYde0Stu3pB4pDu1sPeL90zbftk7fFrIjt2yD7pmrCDAbJhpRZJPR6xKmv2s'
+    'KpKLJNeq5CbJbXsW63gW7Nlj2wv2LPPxFFuJ12wpjJOapD3scUBrwX1+yINVZ3IACgoKCgoKCgoKCrVD2G/uLn7H'
+    'rLy/e+3PDvlfZ4VKWf0m+W9xGFm68vRhehAZqk2cr2v+bIFHOL5EjX2c/4US4zS6iSlMcBxTdc9f+rIT1fdTc8fQ'
+    '71tC9Y5frifOPzz+D9XZz7g='
+)
+WARMUP_ROWS = [
+    ['Item No.', 'Description', 'QTY', 'Unit Price', 'CBM'],
+    ['A1', 'Warm-up', 1, 1.5, 0.1]
+]
+
+def warm_up():
+    """
+    Import pandas/openpyxl/xlrd, parse a tiny workbook with each Excel engine and
+    prime the exchange-rate cache. Meant to run in the gunicorn master before
+    workers are forked, so they share the loaded pages copy-on-write and the first
+    real upload on each worker skips the warm-up cost. Every step is best-effort.
+    """
+    import base64
+    import io
+    import zlib
+    import openpyxl
+
+    start = time.perf_counter()
+    try:
+        xls_bytes = zlib.decompress(base64.b64decode(''.join(WARMUP_XLS)))
+        pd.read_excel(io.BytesIO(xls_bytes), header=None, engine='xlrd')
+
+        workbook = openpyxl.Workbook()
+        for row in WARMUP_ROWS:
+            workbook.active.append(row)
+        xlsx_buffer = io.BytesIO()
+        workbook.save(xlsx_buffer)
+        xlsx_buffer.seek(0)
+        df = pd.read_excel(xlsx_buffer, header=None, engine='openpyxl')
+        find_header_and_columns(df)
+        print(f"Excel engines warmed in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        print(f"Excel warm-up failed: {e}")
+
+    rates_start = time.perf_counter()
+    try:
+        fetch_rates_json('https://api.exchangerate-api.com/v4/latest/USD', usd_rate_table)
+        print(f"Exchange-rate cache primed in {time.perf_counter() - rates_start:.2f}s")
+    except Exception as e:
+        print(f"Exchange-rate warm-up failed: {e}")
+# --- END: Preload and warm-up ---
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False) 
\ No newline at end of file
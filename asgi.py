@@ -0,0 +1,275 @@
+"""
+ASGI entry point: the same app under an event loop, for deployments where a slow
+exchange-rate API would otherwise hold a whole worker for every request waiting on it.
+
+    uvicorn asgi:app --host 0.0.0.0 --port $PORT --workers 2
+
+Needs httpx and uvicorn (pip install httpx uvicorn). The WSGI entries (`gunicorn app:app`,
+pythonanywhere_wsgi.py) don't import this module and keep working without them.
+
+/get-exchange-rate and /get-currency-rates run on the event loop: providers are called
+through one shared httpx.AsyncClient (pooled keep-alive connections), responses share
+app.rate_cache, and concurrent requests for the same provider wait on a single fetch.
+Every other route is the Flask app called on a thread pool - parse- and compute-heavy
+routes (uploads, /calculate, exports, /simulate) on ASGI_HEAVY_THREADS threads, the rest
+on ASGI_THREADS - so Excel parsing and calculate_costs never block the loop and a burst
+of uploads can't take the threads that light routes need.
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from werkzeug.exceptions import HTTPException
+
+from app import (FALLBACK_RATES, ProviderUnavailable, app as flask_app, cached_rates_json, currency_rate_providers,
+                 currency_rates_fallback, currency_rates_result, provider_health, rate_cache, usd_ils_fallback,
+                 usd_ils_providers, usd_ils_result, usd_rate_table)
+
+LIGHT_THREADS = int(os.environ.get('ASGI_THREADS', 16))
+HEAVY_THREADS = int(os.environ.get('ASGI_HEAVY_THREADS', 2))
+# Request bodies larger than this are spooled to disk before Flask reads them
+BODY_SPOOL_SIZE = 1024 * 1024
+
+HEAVY_ENDPOINTS = {'calculate'} | {endpoint for options in flask_app.config['ADMISSION_CLASSES'].values()
+                                   for endpoint in options['endpoints']}
+
+light_pool = ThreadPoolExecutor(max_workers=LIGHT_THREADS, thread_name_prefix='asgi-light')
+heavy_pool = ThreadPoolExecutor(max_workers=HEAVY_THREADS, thread_name_prefix='asgi-heavy')
+url_adapter = flask_app.url_map.bind('localhost')
+
+class RateFetcher:
+    """Async counterpart of app.fetch_rates_json, sharing its cache."""
+    def __init__(self):
+        self.client = None
+        self.pending = {}   # url -> task of the fetch in flight
+
+    def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=flask_app.config['RATE_TIMEOUT'],
+                                            limits=httpx.Limits(max_connections=50, max_keepalive_connections=10))
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def fetch(self, url, extract):
+        """
+        (data, fetched_at), or (None, None) if the API answered with a non-200 status.
+        As in fetch_rates_json, a response `extract` rejects is a breaker failure and is not cached.
+        Raises ProviderUnavailable while the provider's circuit is open.
+        """
+        cached = cached_rates_json(url)
+        if cached:
+            return cached
+        task = self.pending.get(url)
+        if task is None:
+            breaker = provider_health.breaker(url)
+            if not breaker.allow():
+                raise ProviderUnavailable(f"circuit {breaker.state}")
+            self.start()
+            task = asyncio.ensure_future(self.get(url, extract, breaker))
+            self.pending[url] = task
+            task.add_done_callback(lambda _: self.pending.pop(url, None))
+        # A caller that goes away must not cancel the fetch the others are waiting on
+        return await asyncio.shield(task)
+
+    async def get(self, url, extract, breaker):
+        start = time.perf_counter()
+        try:
+            response = await self.client.get(url)
+            if response.status_code != 200:
+                breaker.record_failure(time.perf_counter() - start, f"HTTP {response.status_code}")
+                return None, None
+            data = response.json()
+            extract(data)
+        except Exception as e:
+            breaker.record_failure(time.perf_counter() - start, e)
+            raise
+        breaker.record_success(time.perf_counter() - start)
+        fetched_at = time.time()
+        rate_cache[url] = (fetched_at, data)
+        return data, fetched_at
+
+rates = RateFetcher()
+
+async def get_exchange_rate():
+    """Async /get-exchange-rate: same providers, ordering and response body as the Flask route."""
+    loop = asyncio.get_running_loop()
+    try:
+        for api in usd_ils_providers():
+            try:
+                data, fetched_at = await rates.fetch(api['url'], api['extract'])
+                if data is not None:
+                    # Records the rate in SQLite, so off the loop
+                    return 200, await loop.run_in_executor(light_pool, usd_ils_result, api, data, fetched_at)
+            except ProviderUnavailable:
+                continue
+            except Exception as e:
+                print(f"API {api['url']} failed: {str(e)}")
+        return 200, await loop.run_in_executor(light_pool, usd_ils_fallback)
+    except Exception as e:
+        return 500, {
+            'success': False,
+            'error': f'שגיאה בקבלת שער חליפין: {str(e)}',
+            'rate': FALLBACK_RATES['USD_ILS']
+        }
+
+async def get_currency_rates():
+    """Async /get-currency-rates: same providers, ordering and response body as the Flask route."""
+    loop = asyncio.get_running_loop()
+    try:
+        for url in currency_rate_providers():
+            try:
+                data, fetched_at = await rates.fetch(url, usd_rate_table)
+                if data is not None:
+                    return 200, await loop.run_in_executor(light_pool, currency_rates_result, url, data, fetched_at)
+            except ProviderUnavailable:
+                continue
+            except Exception as e:
+                print(f"API {url} failed: {str(e)}")
+        return 200, await loop.run_in_executor(light_pool, currency_rates_fallback)
+    except Exception as e:
+        return 500, {
+            'success': False,
+            'error': f'שגיאה בקבלת שערי חליפין: {str(e)}',
+            'rates': dict(FALLBACK_RATES)
+        }
+
+ASYNC_ROUTES = {
+    ('GET', '/get-exchange-rate'): get_exchange_rate,
+    ('GET', '/get-currency-rates'): get_currency_rates
+}
+
+async def send_json(send, status, body):
+    payload = flask_app.json.dumps(body).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(payload)).encode())
+    ]})
+    await send({'type': 'http.response.body', 'body': payload})
+
+def wsgi_environ(scope, body):
+    """PEP 3333 environ for an ASGI HTTP scope, reading the request body from `body`."""
+    server = scope.get('server') or ('localhost', 80)
+    root_path = scope.get('root_path', '')
+    path = scope['path'][len(root_path):] if scope['path'].startswith(root_path) else scope['path']
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+        'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1] or 80),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        value = value.decode('latin-1')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    # The body is already spooled, so its length is known even for a chunked request without Content-Length
+    body.seek(0, os.SEEK_END)
+    environ['CONTENT_LENGTH'] = str(body.tell())
+    body.seek(0)
+    return environ
+
+async def read_body(receive):
+    body = tempfile.SpooledTemporaryFile(max_size=BODY_SPOOL_SIZE)
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            body.close()
+            return None
+        body.write(message.get('body', b''))
+        more_body = message.get('more_body', False)
+    body.seek(0)
+    return body
+
+def thread_pool_for(scope):
+    try:
+        endpoint, _ = url_adapter.match(scope['path'], method=scope['method'])
+    except HTTPException:
+        return light_pool
+    return heavy_pool if endpoint in HEAVY_ENDPOINTS else light_pool
+
+async def call_flask(scope, receive, send):
+    """Run the Flask app for one request on a thread pool, streaming its response back."""
+    body = await read_body(receive)
+    if body is None:
+        return
+    loop = asyncio.get_running_loop()
+    pool = thread_pool_for(scope)
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'] = int(status.split(' ', 1)[0])
+        started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        return lambda data: None
+
+    def run():
+        result = flask_app(wsgi_environ(scope, body), start_response)
+        chunks = iter(result)
+        # The first chunk, so start_response has been called even by apps that call it lazily
+        return result, chunks, next(chunks, None)
+
+    try:
+        result, chunks, chunk = await loop.run_in_executor(pool, run)
+        try:
+            await send({'type': 'http.response.start', 'status': started['status'], 'headers': started['headers']})
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await loop.run_in_executor(pool, next, chunks, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                await loop.run_in_executor(pool, result.close)
+    finally:
+        body.close()
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            rates.start()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await rates.close()
+            light_pool.shutdown(wait=False)
+            heavy_pool.shutdown(wait=False)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        raise RuntimeError(f"Unsupported ASGI scope type {scope['type']}")
+    route = ASYNC_ROUTES.get((scope['method'], scope['path']))
+    if route is not None:
+        status, body = await route()
+        await send_json(send, status, body)
+        return
+    await call_flask(scope, receive, send)
+
+if __name__ == '__main__':
+    import uvicorn
+
+    uvicorn.run('asgi:app', host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the hot paths of the Import Cost Calculator.
+
+Usage:
+    python benchmarks.py json                 # serialization throughput of calculate_costs output
+    python benchmarks.py json --rows 1000 5000 --repeat 10
+    python benchmarks.py sku                  # /sku/suggest prefix lookups on a 100k SKU catalog
+    python benchmarks.py fuzzy                # /sku/match n-gram matching of misspelled codes
+    python benchmarks.py tariff               # HS-code duty lookups and calculate_costs with duty
+    python benchmarks.py ingest               # parsing the same invoice as .xlsx and as CSV/TSV exports
+    python benchmarks.py detect               # sheet profiling and header/column/row detection (/upload)
+    python benchmarks.py money                # float vs fixed-point (agorot) calculate_costs
+    python benchmarks.py providers            # /get-exchange-rate with a stalled and a failing provider
+"""
+
+import argparse
+import contextlib
+import csv
+import http.server
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+from flask.json.provider import DefaultJSONProvider
+
+from app import (ContainerCalculator, FastJSONProvider, NgramIndex, SheetProfile, SkuIndex, TariffTable, app,
+                 extract_products_from_excel, find_column_indices, find_product_rows, orjson, read_table)
+
+def build_calculator(rows, seed=42):
+    """A calculator with `rows` random products that fit in the container."""
+    rng = random.Random(seed)
+    calculator = ContainerCalculator()
+    calculator.container_cost_usd = 4500
+    calculator.import_tax_rate = 0.18
+    calculator.usd_to_ils_rate = 3.65
+    calculator.rmb_to_ils_rate = 0.51
+    calculator.local_transportation_ils = 2500
+    calculator.unloading_cost_ils = 800
+    calculator.additional_fees_ils = 1200
+    for idx in range(rows):
+        calculator.add_product(
+            name=f"HD{idx:05d} - Item No.{rng.randint(1000, 9999)}",
+            quantity=rng.randint(10, 2000),
+            total_volume=round(rng.uniform(0.05, 3.0), 3),
+            cost_per_unit=round(rng.uniform(0.5, 80.0), 2),
+            currency=rng.choice(['USD', 'RMB'])
+        )
+    calculator.container_volume = sum(p['total_volume'] for p in calculator.products) + 1
+    return calculator
+
+def best_of(repeat, func):
+    """Fastest wall time of `repeat` calls, and the last return value."""
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def to_numpy_scalars(results):
+    """Same rows with NumPy scalar values, as a vectorized engine would produce them."""
+    import numpy as np
+    return [{key: (np.float64(value) if isinstance(value, float) else
+                   np.int64(value) if isinstance(value, int) and not isinstance(value, bool) else value)
+             for key, value in row.items()} for row in results]
+
+def bench_json(args):
+    providers = [('flask default (sorted keys)', DefaultJSONProvider(app)),
+                 ('FastJSONProvider stdlib', FastJSONProvider(app, backend='stdlib'))]
+    if orjson is not None:
+        providers.append(('FastJSONProvider orjson', FastJSONProvider(app, backend='orjson')))
+    else:
+        print("orjson is not installed - only the stdlib backends are measured\n")
+
+    print(f"{'rows':>7}  {'payload':<8} {'provider':<28} {'ms':>8} {'rows/s':>11} {'MB/s':>8}")
+    for rows in args.rows:
+        calculator = build_calculator(rows)
+        with contextlib.redirect_stdout(io.StringIO()):
+            results = calculator.calculate_costs()
+        payloads = [('python', {'results': results}),
+                    ('numpy', {'results': to_numpy_scalars(results)})]
+
+        for payload_name, payload in payloads:
+            for provider_name, provider in providers:
+                try:
+                    seconds, body = best_of(args.repeat, lambda: provider.dumps(payload))
+                except TypeError:
+                    print(f"{rows:>7}  {payload_name:<8} {provider_name:<28} {'unsupported (TypeError)':>29}")
+                    continue
+                megabytes = len(body.encode('utf-8')) / 1e6
+                print(f"{rows:>7}  {payload_name:<8} {provider_name:<28} {seconds * 1000:>8.2f} "
+                      f"{rows / seconds:>11,.0f} {megabytes / seconds:>8.1f}")
+        print()
+
+def bench_sku(args):
+    rng = random.Random(42)
+    letters = 'ABCDEFGHJKLMNPRSTUVWXYZ'
+    records = []
+    for idx in range(args.skus):
+        product_code = f"{rng.choice(letters)}{rng.choice(letters)}{rng.randint(10, 9999)}{rng.choice(['', 'A', 'B', '-1'])}"
+        item_number = f"{rng.randint(1000, 99999)}"
+        records.append({'sku': f"{product_code} - {item_number}-{idx}", 'product_code': product_code,
+                        'item_number': item_number, 'description': '', 'unit_cbm': 0.05, 'unit_price': 3.2,
+                        'currency': 'USD', 'supplier': 'bench'})
+    index = SkuIndex()
+    start = time.perf_counter()
+    index.add_many(records)
+    print(f"Built index of {len(index.records):,} SKUs ({len(index.keys):,} keys) in {time.perf_counter() - start:.2f}s")
+
+    for length in (1, 2, 3, 5):
+        samples = []
+        for _ in range(args.queries):
+            key = rng.choice(index.keys)[0]
+            prefix = key[:length]
+            query_start = time.perf_counter()
+            index.suggest(prefix, limit=10)
+            samples.append(time.perf_counter() - query_start)
+        samples.sort()
+        mean = sum(samples) / len(samples)
+        p99 = samples[int(len(samples) * 0.99) - 1]
+        print(f"prefix length {length}: mean {mean * 1e6:7.1f} µs, p99 {p99 * 1e6:7.1f} µs")
+
+def misspell(code, rng):
+    """Supplier-style variant of a product code: dashes, spaces, case, a dropped character."""
+    variant = rng.choice([
+        lambda c: c[:2] + '-' + c[2:],
+        lambda c: c[:-1] + ' ' + c[-1],
+        lambda c: c.lower(),
+        lambda c: c[:3] + c[4:] if len(c) > 4 else c,
+    ])
+    return variant(code)
+
+def bench_fuzzy(args):
+    rng = random.Random(7)
+    letters = 'ABCDEFGHJKLMNPRSTUVWXYZ'
+    words = ['scooter', 'wheel', 'deck', 'handle', 'aluminium', 'pu', 'led', 'kids', 'folding', 'brake']
+    index = NgramIndex()
+    codes = []
+    start = time.perf_counter()
+    for idx in range(args.skus):
+        code = f"{rng.choice(letters)}{rng.choice(letters)}{rng.randint(100, 99999)}{rng.choice(['', 'A', 'B', 'C'])}"
+        codes.append(code)
+        index.add(f"{code}#{idx}", code, ' '.join(rng.sample(words, 3)))
+    print(f"Indexed {args.skus:,} SKUs in {time.perf_counter() - start:.2f}s")
+
+    queries = [(idx, misspell(codes[idx], rng)) for idx in rng.sample(range(args.skus), args.queries)]
+    start = time.perf_counter()
+    hits = 0
+    for idx, query in queries:
+        top = index.match(query, k=5)
+        hits += any(sku == f"{codes[idx]}#{idx}" for sku, _ in top)
+    elapsed = time.perf_counter() - start
+    print(f"Matched {len(queries):,} misspelled codes in {elapsed * 1000:.0f} ms "
+          f"({elapsed / len(queries) * 1e6:.0f} µs each), recall@5 {hits / len(queries):.1%}")
+
+def build_tariff_table(lines, seed=3):
+    """An in-memory tariff schedule with `lines` entries spread over 2- to 10-digit HS codes."""
+    rng = random.Random(seed)
+    table = TariffTable()
+    rates = {}
+    for idx in range(lines):
+        length = (2, 4, 6, 8, 10)[idx % 5]
+        rates[f"{rng.randint(10 ** (length - 1), 10 ** length - 1)}"] = (rng.randint(0, 30) / 100, '')
+    table.schedule = (rates, sorted({len(code) for code in rates}, reverse=True))
+    table.refreshed_at = float('inf')   # never hit the database
+    return table
+
+def bench_tariff(args):
+    table = build_tariff_table(args.lines)
+    rng = random.Random(11)
+    schedule = list(table.schedule[0])
+    for products in args.products:
+        # Half the codes extend a schedule line, half are random 10-digit codes
+        codes = [rng.choice(schedule).ljust(10, '0') if idx % 2 else f"{rng.randint(10 ** 9, 10 ** 10 - 1)}"
+                 for idx in range(products)]
+        seconds, rates = best_of(args.repeat, lambda: table.duty_rates(codes))
+        matched = sum(1 for rate, code in zip(rates, codes) if table.longest_prefix(code, table.schedule))
+        print(f"{products:>7,} products vs {len(table.schedule[0]):,} tariff lines: lookup {seconds * 1000:7.2f} ms "
+              f"({matched:,} matched)")
+
+        calculator = build_calculator(products)
+        for product, code in zip(calculator.products, codes):
+            product['hs_code'] = code
+        calculator.tariffs = table
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds, _ = best_of(args.repeat, calculator.calculate_costs)
+        print(f"{'':>7}  calculate_costs with duty: {seconds * 1000:7.2f} ms")
+
+def invoice_rows(rows, seed=5):
+    """A PI as a list of rows: title, blank line, header, then `rows` products."""
+    rng = random.Random(seed)
+    data = [['PROFORMA INVOICE 形式发票'], [], ['Item No', 'Description', 'Qty', 'Unit Price USD', 'CBM']]
+    for idx in range(rows):
+        data.append([f"HD{idx:05d}", f"滑板车 scooter model {rng.randint(1, 99)}", rng.randint(10, 2000),
+                     round(rng.uniform(0.5, 80.0), 2), round(rng.uniform(0.05, 3.0), 3)])
+    return data
+
+def write_invoice(folder, name, data, encoding=None, delimiter=','):
+    """Write `data` as .xlsx (encoding=None) or as delimited text in `encoding`."""
+    path = os.path.join(folder, name)
+    if encoding is None:
+        import openpyxl
+        workbook = openpyxl.Workbook()
+        for row in data:
+            workbook.active.append(row)
+        workbook.save(path)
+    else:
+        buffer = io.StringIO()
+        csv.writer(buffer, delimiter=delimiter).writerows(data)
+        with open(path, 'wb') as f:
+            f.write(buffer.getvalue().encode(encoding))
+    return path
+
+def bench_ingest(args):
+    formats = [('xlsx', 'invoice.xlsx', None, ','),
+               ('csv utf-8', 'invoice.csv', 'utf-8', ','),
+               ('csv gbk', 'invoice-gbk.csv', 'gbk', ','),
+               ('tsv utf-16', 'invoice.tsv', 'utf-16', '\t')]
+    print(f"{'rows':>7}  {'format':<12} {'read ms':>9} {'total ms':>9} {'products':>9}")
+    with tempfile.TemporaryDirectory() as folder:
+        for rows in args.rows:
+            data = invoice_rows(rows)
+            for label, name, encoding, delimiter in formats:
+                path = write_invoice(folder, name, data, encoding, delimiter)
+                best_read, best_total, products = None, None, []
+                for _ in range(args.repeat):
+                    timings = {}
+                    start = time.perf_counter()
+                    # The parser logs every row - keep that out of the measurement as far as possible
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        products = extract_products_from_excel(path, timings=timings)
+                    total = time.perf_counter() - start
+                    best_read = timings['read_excel'] if best_read is None else min(best_read, timings['read_excel'])
+                    best_total = total if best_total is None else min(best_total, total)
+                print(f"{rows:>7}  {label:<12} {best_read * 1000:>9.1f} {best_total * 1000:>9.1f} {len(products):>9,}")
+            print()
+
+def bench_detect(args):
+    def detect(df):
+        profile = SheetProfile(df)
+        find_column_indices(df, profile)
+        return find_product_rows(df, profile)
+
+    print(f"{'rows':>7} {'profile ms':>11} {'detect ms':>10} {'products':>9}")
+    with tempfile.TemporaryDirectory() as folder:
+        for rows in args.rows:
+            df = read_table(write_invoice(folder, 'invoice.xlsx', invoice_rows(rows)))
+            with contextlib.redirect_stdout(io.StringIO()):
+                profile_seconds, _ = best_of(args.repeat, lambda: SheetProfile(df))
+                # Profile plus every header/column/row heuristic of /upload reading it
+                detect_seconds, (start_row, end_row) = best_of(args.repeat, lambda: detect(df))
+            print(f"{rows:>7} {profile_seconds * 1000:>11.1f} {detect_seconds * 1000:>10.1f} {end_row - start_row + 1:>9,}")
+
+def lines_off_totals(results):
+    """Total columns whose product lines (as shown, in agorot) do not add up to the TOTALS row."""
+    columns = ['shipping_cost_ils', 'local_transportation_ils', 'unloading_cost_ils', 'additional_fees_ils',
+               'duty_ils', 'total_cost_ils']
+    return [name for name in columns
+            if sum(round(row[name] * 100) for row in results[:-1]) != round(results[-1][name] * 100)]
+
+def bench_money(args):
+    for rows in args.rows:
+        calculator = build_calculator(rows)
+        timings = {}
+        for mode in ('float', 'exact'):
+            calculator.exact = mode == 'exact'
+            timings[mode], _ = best_of(args.repeat, calculator.calculate_columns)
+            timings[mode + ' rows'], results = best_of(args.repeat, calculator.calculate_costs)
+            off = lines_off_totals(results)
+            print(f"{rows:>7,} products {mode:>5}: engine {timings[mode] * 1000:7.2f} ms, "
+                  f"calculate_costs {timings[mode + ' rows'] * 1000:7.2f} ms, "
+                  f"lines != totals in {', '.join(off) if off else 'no column'}")
+        print(f"{'':>7}  exact/float: engine {timings['exact'] / timings['float']:.2f}x, "
+              f"calculate_costs {timings['exact rows'] / timings['float rows']:.2f}x")
+
+class FakeRateProvider:
+    """
+    A local USD-based rate API on 127.0.0.1 whose behaviour can be switched: 'ok', 'fail' (HTTP 500),
+    'bad' (HTTP 200 with an error body) or 'stall'. `calls` counts the requests it received.
+    """
+    def __init__(self, mode='ok', stall_seconds=10):
+        self.mode = mode
+        self.stall_seconds = stall_seconds
+        self.calls = 0
+        provider = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                provider.calls += 1
+                if provider.mode == 'stall':
+                    time.sleep(provider.stall_seconds)
+                if provider.mode == 'fail':
+                    status, body = 500, b'{}'
+                elif provider.mode == 'bad':
+                    status, body = 200, b'{"result": "error", "error-type": "quota-reached"}'
+                else:
+                    status, body = 200, json.dumps(
+                        {'rates': {'USD': 1, 'ILS': 3.65, 'CNY': 7.18, 'EUR': 0.92, 'HKD': 7.8}}).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Type', 'application/json')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except OSError:
+                    pass   # the client gave up on a stalled request
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v4/latest/USD"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+def bench_providers(args):
+    stalled, failing, healthy = FakeRateProvider('stall'), FakeRateProvider('fail'), FakeRateProvider('ok')
+    app.config.update(RATE_PROVIDER_URLS=[stalled.url, failing.url, healthy.url], RATE_TIMEOUT=args.timeout,
+                      RATE_CACHE_TTL=0, RATE_BREAKER_COOLDOWN=args.cooldown, RATE_HEALTH_MEMORY=args.cooldown,
+                      DATABASE_PATH=os.path.join(tempfile.mkdtemp(), 'rates.db'))
+    client = app.test_client()
+
+    def run(label, requests):
+        for idx in range(requests):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                body = client.get('/get-exchange-rate').get_json()
+            source = next((name for name, provider in (('stalled', stalled), ('failing', failing), ('healthy', healthy))
+                           if provider.url == body.get('source')), None) if body['success'] else 'stored'
+            states = ' '.join(f"{state:<9}" for state in body['providers'].values())
+            print(f"{label:<22} #{idx + 1:<3} {(time.perf_counter() - start) * 1000:8.1f} ms  from {source:<8}  {states}")
+
+    print(f"Providers tried healthiest first, {args.timeout}s timeout (breakers: stalled, failing, healthy)")
+    run('stalled + failing', args.requests)
+    healthy.mode = 'fail'
+    run('all down', args.requests)
+    stalled.mode = failing.mode = healthy.mode = 'ok'
+    time.sleep(args.cooldown)
+    run(f'recovered, {args.cooldown:g}s later', 4)
+    for server in (stalled, failing, healthy):
+        server.server.shutdown()
+
+def main():
+    parser = argparse.ArgumentParser(description='Import Cost Calculator micro-benchmarks.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    json_parser = subparsers.add_parser('json', help='JSON serialization of calculate_costs output')
+    json_parser.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 5000])
+    json_parser.add_argument('--repeat', type=int, default=5)
+    json_parser.set_defaults(func=bench_json)
+
+    sku_parser = subparsers.add_parser('sku', help='SKU catalog prefix lookups')
+    sku_parser.add_argument('--skus', type=int, default=100000)
+    sku_parser.add_argument('--queries', type=int, default=2000)
+    sku_parser.set_defaults(func=bench_sku)
+
+    fuzzy_parser = subparsers.add_parser('fuzzy', help='SKU n-gram fuzzy matching')
+    fuzzy_parser.add_argument('--skus', type=int, default=100000)
+    fuzzy_parser.add_argument('--queries', type=int, default=1000)
+    fuzzy_parser.set_defaults(func=bench_fuzzy)
+
+    tariff_parser = subparsers.add_parser('tariff', help='HS-code tariff lookups and duty calculation')
+    tariff_parser.add_argument('--lines', type=int, default=20000)
+    tariff_parser.add_argument('--products', type=int, nargs='+', default=[1000, 5000])
+    tariff_parser.add_argument('--repeat', type=int, default=5)
+    tariff_parser.set_defaults(func=bench_tariff)
+
+    ingest_parser = subparsers.add_parser('ingest', help='Excel vs CSV/TSV upload parsing')
+    ingest_parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000])
+    ingest_parser.add_argument('--repeat', type=int, default=3)
+    ingest_parser.set_defaults(func=bench_ingest)
+
+    detect_parser = subparsers.add_parser('detect', help='sheet profiling and /upload header/column/row detection')
+    detect_parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000])
+    detect_parser.add_argument('--repeat', type=int, default=3)
+    detect_parser.set_defaults(func=bench_detect)
+
+    money_parser = subparsers.add_parser('money', help='float vs fixed-point (agorot) calculation')
+    money_parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    money_parser.add_argument('--repeat', type=int, default=5)
+    money_parser.set_defaults(func=bench_money)
+
+    providers_parser = subparsers.add_parser('providers', help='rate provider circuit breakers against local fakes')
+    providers_parser.add_argument('--requests', type=int, default=8)
+    providers_parser.add_argument('--timeout', type=float, default=1.0)
+    providers_parser.add_argument('--cooldown', type=float, default=2.0)
+    providers_parser.set_defaults(func=bench_providers)
+
+    args = parser.parse_args()
+    args.func(args)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,33 @@
+"""
+Gunicorn config for long-lived deployments: load and warm the app in the master.
+
+    gunicorn -c gunicorn_preload.py app:app
+
+The app is imported once in the master (preload_app), then warm_up() loads pandas,
+openpyxl and xlrd, parses a tiny workbook with each engine and primes the
+exchange-rate cache before any worker is forked. Workers share those pages
+copy-on-write, so the first upload on each worker does not pay the warm-up cost.
+
+This is the opposite trade-off to the lazy imports in app.py: boot is slower, but
+every worker is ready for uploads immediately. For free-tier hosts that spin down
+when idle, keep using the plain `gunicorn app:app` command.
+"""
+
+import gc
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+preload_app = True
+
+def when_ready(server):
+    """Runs in the master after the app is loaded and before workers are forked."""
+    from app import warm_up
+
+    server.log.info("Warming up app before forking workers")
+    warm_up()
+    # Move everything allocated so far out of the collector's reach, so the
+    # workers' garbage collections don't touch (and copy) the shared pages
+    gc.freeze()
+    server.log.info(f"Warm-up done, {gc.get_freeze_count()} objects frozen")
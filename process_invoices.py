@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Parse a directory (or globs) of supplier PIs without the web server, using the same
+robust extractor as /upload-robust, optionally run the landed-cost calculation, and
+write every product line as JSON, CSV or Parquet with a per-file timing/error summary.
+
+Usage:
+    python process_invoices.py invoices/2025/                        # summary only
+    python process_invoices.py invoices/2025/ -o season.json         # products + summary as JSON
+    python process_invoices.py "invoices/2025/*.xlsx" --config container.json --calculate file -o season.parquet
+    python process_invoices.py invoices/ --recursive --all-sheets --workers 8 -o season.csv --summary summary.json
+
+The --config file holds the /calculate settings (and optional "exchange_rates"), e.g.
+    {"container_cost_usd": 5000, "container_volume": 68, "import_tax_rate": 0.18,
+     "usd_to_ils_rate": 3.7, "rmb_to_ils_rate": 0.51, "local_transportation_ils": 1200}
+"""
+
+import argparse
+import contextlib
+import csv
+import glob
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from app import (UPLOAD_EXTENSIONS, ContainerCalculator, calculator_for, currency_array, currency_index,
+                 extract_file, in_request_order, pa, plan_calculation, pq, pyarrow_available)
+
+OUTPUT_FORMATS = ('json', 'csv', 'parquet')
+PRODUCT_FIELDS = ['file', 'sheet', 'item', 'description', 'hs_code', 'currency', 'quantity', 'cbm', 'price']
+TEXT_FIELDS = ('file', 'sheet', 'item', 'description', 'hs_code')
+
+def find_invoices(inputs, recursive=False):
+    """Invoice files named by `inputs` (files, directories or glob patterns), sorted and de-duplicated."""
+    paths = set()
+    for entry in inputs:
+        if os.path.isdir(entry):
+            pattern = os.path.join(entry, '**', '*') if recursive else os.path.join(entry, '*')
+            candidates = glob.glob(pattern, recursive=recursive)
+        else:
+            candidates = glob.glob(entry, recursive=recursive) or [entry]
+        for path in candidates:
+            if os.path.isfile(path) and path.lower().endswith(UPLOAD_EXTENSIONS):
+                paths.add(os.path.normpath(path))
+    return sorted(paths)
+
+def extract_file_quietly(filepath, all_sheets):
+    """extract_file() for a pool worker, with the parser's per-row chatter discarded."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return extract_file(filepath, all_sheets)
+
+def parse_files(paths, all_sheets=False, workers=1):
+    """Per-file reports (see app.extract_file) in `paths` order, parsed across `workers` processes."""
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(extract_file_quietly, paths, [all_sheets] * len(paths)))
+    return [extract_file_quietly(path, all_sheets) for path in paths]
+
+def calculate_lines(lines, settings):
+    """
+    Run ContainerCalculator over product lines (as one container) and add the rounded
+    per-line results to each line. Returns the TOTALS row.
+    """
+    body = dict(settings, products=[{
+        'name': line['item'],
+        'quantity': line['quantity'],
+        'total_volume': line['cbm'],
+        'price': line['price'],
+        'currency': line['currency'],
+        'hs_code': line['hs_code']
+    } for line in lines])
+    settings, products, order, canonical_products, _ = plan_calculation(body)
+    with contextlib.redirect_stdout(io.StringIO()):
+        canonical_results = calculator_for(settings, canonical_products).calculate_costs()
+    results = in_request_order(canonical_results, order)
+    for line, result in zip(lines, results):
+        for name in ContainerCalculator.COST_COLUMNS:
+            line[name] = result[name]
+    return results[-1]
+
+def write_json(path, lines, summary):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'files': summary, 'products': lines}, f, ensure_ascii=False, indent=2, default=str)
+
+def write_csv(path, lines, fields):
+    # utf-8-sig so Excel shows Hebrew and Chinese descriptions correctly
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(lines)
+
+def write_parquet(path, lines, fields):
+    """Typed like the server's exports: strings, categorical currency, float64 numbers."""
+    columns = []
+    for field in fields:
+        values = [line.get(field) for line in lines]
+        if field == 'currency':
+            columns.append(currency_array([currency_index(value) for value in values]))
+        elif field in TEXT_FIELDS:
+            columns.append(pa.array(values, type=pa.string()))
+        else:
+            columns.append(pa.array(values, type=pa.float64()))
+    pq.write_table(pa.table(columns, names=fields), path)
+
+def main():
+    parser = argparse.ArgumentParser(description='Parse (and optionally cost) a directory of supplier PIs.')
+    parser.add_argument('inputs', nargs='+', help='invoice files, directories or glob patterns')
+    parser.add_argument('--recursive', action='store_true', help='descend into subdirectories (and ** in globs)')
+    parser.add_argument('--all-sheets', action='store_true', help='read every worksheet, not just the first')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='parser processes (default: number of CPUs)')
+    parser.add_argument('--config', help='JSON file with the /calculate settings and exchange rates')
+    parser.add_argument('--calculate', choices=['file', 'all'],
+                        help='run the cost calculation per file (one container each) or over all files together')
+    parser.add_argument('-o', '--output', help='write product lines here (.json, .csv or .parquet)')
+    parser.add_argument('--format', choices=OUTPUT_FORMATS, help='output format (default: from the extension)')
+    parser.add_argument('--summary', help='also write the per-file summary as JSON to this path')
+    parser.add_argument('--fail-on-error', action='store_true', help='exit 1 if any file could not be parsed')
+    args = parser.parse_args()
+
+    output_format = args.format
+    if args.output and output_format is None:
+        output_format = os.path.splitext(args.output)[1].lstrip('.').lower()
+        if output_format not in OUTPUT_FORMATS:
+            parser.error(f"cannot tell the format of {args.output}; use --format")
+    if output_format == 'parquet' and not pyarrow_available():
+        parser.error('Parquet output needs pyarrow (pip install pyarrow)')
+    settings = None
+    if args.calculate:
+        if not args.config:
+            parser.error('--calculate needs --config')
+        with open(args.config, encoding='utf-8') as f:
+            settings = json.load(f)
+
+    paths = find_invoices(args.inputs, args.recursive)
+    if not paths:
+        print("No invoice files found.")
+        return 1
+
+    start = time.perf_counter()
+    reports = parse_files(paths, args.all_sheets, args.workers)
+    parse_seconds = time.perf_counter() - start
+
+    lines, summary = [], []
+    for path, report in zip(paths, reports):
+        file_lines = [{
+            'file': path,
+            'sheet': product.get('sheet'),
+            'item': product['item'],
+            'description': product['description'],
+            'hs_code': product['hs_code'],
+            'currency': product['currency'],
+            'quantity': product['quantity'],
+            'cbm': product['cbm'],
+            'price': product['price']
+        } for product in report['products']]
+        entry = {
+            'file': path,
+            'products': len(file_lines),
+            'seconds': report['seconds'],
+            'timings': {stage: round(seconds, 4) for stage, seconds in report['timings'].items()},
+            'file_hash': report.get('file_hash'),
+            'parse_failures': report.get('parse_failures', {}),
+            'error': report.get('error')
+        }
+        if 'sheets' in report:
+            entry['sheets'] = report['sheets']
+        if args.calculate == 'file' and file_lines:
+            try:
+                entry['total_cost_ils'] = calculate_lines(file_lines, settings)['total_cost_ils']
+            except (KeyError, ValueError) as e:
+                entry['calculation_error'] = str(e)
+        lines.extend(file_lines)
+        summary.append(entry)
+
+    calculation_failed = False
+    if args.calculate == 'all' and lines:
+        try:
+            totals = calculate_lines(lines, settings)
+            print(f"All files as one container: total cost {totals['total_cost_ils']:,.2f} ILS")
+        except (KeyError, ValueError) as e:
+            # The parsed lines are still written, without costs
+            print(f"Calculation failed: {e}")
+            calculation_failed = True
+
+    print(f"{'file':<50} {'products':>8} {'seconds':>8}  status")
+    for entry in summary:
+        status = entry['error'] or entry.get('calculation_error') or 'ok'
+        if 'total_cost_ils' in entry:
+            status = f"ok, {entry['total_cost_ils']:,.2f} ILS"
+        print(f"{entry['file'][-50:]:<50} {entry['products']:>8} {entry['seconds']:>8.2f}  {status}")
+    failed = [entry for entry in summary if entry['error']]
+    print(f"\nParsed {len(paths)} files ({len(failed)} failed, {len(lines)} product lines) "
+          f"in {parse_seconds:.2f}s with {min(args.workers, len(paths))} workers.")
+
+    fields = PRODUCT_FIELDS + (ContainerCalculator.COST_COLUMNS if args.calculate else [])
+    if args.output:
+        if output_format == 'json':
+            write_json(args.output, lines, summary)
+        elif output_format == 'csv':
+            write_csv(args.output, lines, fields)
+        else:
+            write_parquet(args.output, lines, fields)
+        print(f"Products written to {args.output}")
+    if args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2, default=str)
+        print(f"Summary written to {args.summary}")
+
+    return 1 if calculation_failed or (args.fail_on_error and failed) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
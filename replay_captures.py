@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Replay captured slow/failed uploads through the current parsers.
+Reports stage timings against the recorded ones and diffs the parsed products,
+so real-world slow files can be used as regression benchmarks.
+
+Usage:
+    python replay_captures.py                    # replay everything in ./captures
+    python replay_captures.py --repeat 5         # best-of-5 timings
+    python replay_captures.py --only 20250604-101500-1a2b3c4d --verbose
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+
+from app import (analyze_excel_structure, extract_products_from_excel, extract_products_from_workbook,
+                 process_excel_data)
+
+NUMERIC_TOLERANCE = 1e-9
+
+def load_captures(capture_folder, only=None):
+    """Load capture metadata files, oldest first."""
+    captures = []
+    for name in sorted(os.listdir(capture_folder)):
+        if not name.endswith('.json'):
+            continue
+        with open(os.path.join(capture_folder, name), encoding='utf-8') as f:
+            meta = json.load(f)
+        if only and meta['id'] not in only:
+            continue
+        captures.append(meta)
+    return captures
+
+def run_pipeline(route, filepath, options=None):
+    """Run the parser used by `route` (with the upload's `options`) and return (products, stage timings)."""
+    timings = {}
+    if route == 'upload-robust' and (options or {}).get('all_sheets'):
+        products = extract_products_from_workbook(filepath, timings=timings)[0]
+    elif route == 'upload-robust':
+        products = extract_products_from_excel(filepath, timings=timings)
+    else:
+        stage_start = time.perf_counter()
+        df = analyze_excel_structure(filepath)
+        timings['analyze_structure'] = time.perf_counter() - stage_start
+        if df is None:
+            raise ValueError('Could not read Excel file')
+        stage_start = time.perf_counter()
+        products = process_excel_data(df)['products']
+        timings['process_data'] = time.perf_counter() - stage_start
+    return products, timings
+
+def replay(meta, capture_folder, repeat=1):
+    """Replay one capture `repeat` times, keeping the fastest run."""
+    filepath = os.path.join(capture_folder, meta['workbook'])
+    best_products, best_timings, error = None, None, None
+    for _ in range(repeat):
+        try:
+            # The parsers are very chatty - keep the report readable
+            with contextlib.redirect_stdout(io.StringIO()):
+                products, timings = run_pipeline(meta['route'], filepath, meta.get('options'))
+        except Exception as e:
+            error = str(e)
+            break
+        if best_timings is None or sum(timings.values()) < sum(best_timings.values()):
+            best_products, best_timings = products, timings
+    return best_products, best_timings, error
+
+def diff_products(recorded, replayed, ignore_fields=()):
+    """Return a list of human-readable differences between two product lists."""
+    differences = []
+    if len(recorded) != len(replayed):
+        differences.append(f"product count {len(recorded)} -> {len(replayed)}")
+    for idx, (old, new) in enumerate(zip(recorded, replayed)):
+        for field in sorted(set(old) | set(new)):
+            if field in ignore_fields:
+                continue
+            old_value, new_value = old.get(field), new.get(field)
+            if isinstance(old_value, (int, float)) and isinstance(new_value, (int, float)):
+                if abs(old_value - new_value) <= NUMERIC_TOLERANCE:
+                    continue
+            elif old_value == new_value:
+                continue
+            differences.append(f"row {idx} {field}: {old_value!r} -> {new_value!r}")
+    return differences
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay captured uploads through the current parsers.')
+    parser.add_argument('--dir', default=os.environ.get('UPLOAD_CAPTURE_FOLDER', 'captures'),
+                        help='capture folder (default: $UPLOAD_CAPTURE_FOLDER or ./captures)')
+    parser.add_argument('--only', nargs='*', help='capture ids to replay')
+    parser.add_argument('--repeat', type=int, default=1, help='runs per capture, fastest is reported')
+    parser.add_argument('--verbose', action='store_true', help='print every output difference')
+    parser.add_argument('--json', dest='json_path', help='also write the report as JSON to this path')
+    parser.add_argument('--fail-on-diff', action='store_true', help='exit 1 if any output changed')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dir):
+        print(f"Capture folder not found: {args.dir}")
+        return 1
+
+    captures = load_captures(args.dir, args.only)
+    if not captures:
+        print("No captures to replay.")
+        return 0
+
+    report = []
+    print(f"{'capture':<27} {'route':<14} {'recorded':>9} {'replayed':>9} {'speedup':>8}  status")
+    for meta in captures:
+        entry = {'id': meta['id'], 'route': meta['route'], 'recorded_seconds': meta['total_seconds']}
+        if not meta.get('workbook'):
+            entry['status'] = 'no workbook'
+            print(f"{meta['id']:<27} {meta['route']:<14} {meta['total_seconds']:>8.2f}s {'-':>9} {'-':>8}  no workbook stored")
+            report.append(entry)
+            continue
+
+        products, timings, error = replay(meta, args.dir, args.repeat)
+        differences = []
+        if error is not None:
+            status = 'still failing' if meta['error'] else 'NOW FAILING'
+        elif meta['products'] is None:
+            status = 'fixed'
+        else:
+            # Scrubbed captures have masked descriptions that the parser re-derives differently
+            ignore_fields = ('description',) if meta.get('scrubbed') else ()
+            differences = diff_products(meta['products'], products, ignore_fields)
+            status = f"DIFF ({len(differences)})" if differences else 'same'
+
+        replayed_seconds = sum(timings.values()) if timings else None
+        entry.update({
+            'status': status,
+            'error': error,
+            'replayed_seconds': replayed_seconds,
+            'recorded_timings': meta['timings'],
+            'replayed_timings': timings,
+            'differences': differences
+        })
+        report.append(entry)
+
+        if replayed_seconds:
+            speedup = f"{meta['total_seconds'] / replayed_seconds:.1f}x"
+            replayed = f"{replayed_seconds:.2f}s"
+        else:
+            speedup, replayed = '-', '-'
+        print(f"{meta['id']:<27} {meta['route']:<14} {meta['total_seconds']:>8.2f}s {replayed:>9} {speedup:>8}  {status}")
+        if args.verbose:
+            if timings:
+                for stage, seconds in timings.items():
+                    recorded = meta['timings'].get(stage)
+                    recorded = f"{recorded:.3f}s" if recorded is not None else '-'
+                    print(f"    {stage:<20} {recorded:>9} -> {seconds:.3f}s")
+            if error:
+                print(f"    error: {error}")
+            for difference in differences:
+                print(f"    {difference}")
+
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+        print(f"\nReport written to {args.json_path}")
+
+    changed = [e for e in report if e['status'].startswith('DIFF') or e['status'] == 'NOW FAILING']
+    print(f"\nReplayed {len(report)} captures, {len(changed)} with changed output.")
+    return 1 if args.fail_on_diff and changed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
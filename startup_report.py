@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Startup-time report for the Flask app.
+Runs `python -X importtime -c "import app"` in a fresh interpreter, lists the slowest
+imports, checks that heavy dependencies are not loaded at boot, and times the first
+request to / (what a cold gunicorn worker sees after an idle spin-down).
+
+Usage:
+    python startup_report.py            # top 15 imports
+    python startup_report.py --top 30
+"""
+
+import argparse
+import re
+import subprocess
+import sys
+
+# These must only be imported by the parsing and exchange-rate code paths
+HEAVY_MODULES = ['pandas', 'numpy', 'requests', 'openpyxl', 'xlrd']
+
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)')
+
+FIRST_REQUEST_SCRIPT = """
+import time, sys
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get('/')
+served = time.perf_counter()
+print(f"{imported - start:.4f} {served - start:.4f} {response.status_code}")
+print(' '.join(m for m in %r if m in sys.modules))
+""" % (HEAVY_MODULES,)
+
+def run_importtime():
+    """Return [(self_us, cumulative_us, depth, module)] for `import app`."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                            capture_output=True, text=True)
+    entries = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            entries.append((int(self_us), int(cumulative_us), len(indent) // 2, module))
+    return entries
+
+def main():
+    parser = argparse.ArgumentParser(description='Report app import time and time to first request.')
+    parser.add_argument('--top', type=int, default=15, help='number of slowest imports to list')
+    args = parser.parse_args()
+
+    entries = run_importtime()
+    app_entry = next((e for e in entries if e[3] == 'app'), None)
+    if app_entry is None:
+        print("❌ Could not import app - run this from the project directory")
+        return 1
+
+    print("🚀 Startup report")
+    print("=" * 50)
+    print(f"import app: {app_entry[1] / 1000:.1f} ms cumulative")
+
+    # importtime lists children before their parent; app's direct imports are the
+    # depth-1 entries between the previous top-level entry and app itself
+    app_index = entries.index(app_entry)
+    start = app_index
+    while start > 0 and entries[start - 1][2] > 0:
+        start -= 1
+    direct_imports = [e for e in entries[start:app_index] if e[2] == 1]
+
+    print(f"\nSlowest imports made by app (cumulative):")
+    for self_us, cumulative_us, _, module in sorted(direct_imports, key=lambda e: e[1], reverse=True)[:args.top]:
+        print(f"  {cumulative_us / 1000:>8.1f} ms  {module}")
+
+    result = subprocess.run([sys.executable, '-c', FIRST_REQUEST_SCRIPT], capture_output=True, text=True)
+    timing_line, loaded_line = result.stdout.splitlines()[-2:] if result.returncode == 0 else ('', '')
+    if timing_line:
+        imported, served, status = timing_line.split()
+        print(f"\nFirst request to / (status {status}): {float(served) * 1000:.1f} ms after interpreter start "
+              f"({float(imported) * 1000:.1f} ms import)")
+
+    imported_at_boot = [e[3] for e in entries if e[3] in HEAVY_MODULES]
+    loaded_after_index = loaded_line.split()
+    print()
+    if imported_at_boot or loaded_after_index:
+        print(f"⚠️  Heavy modules loaded at boot: {sorted(set(imported_at_boot + loaded_after_index))}")
+        return 1
+    print(f"✅ None of {HEAVY_MODULES} are loaded at boot or by /")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,16 @@
+"""
+The app reads its configuration from the environment at import time, so a throwaway
+database, admission folder and capture setting are put in place before any test imports it.
+"""
+
+import os
+import sys
+import tempfile
+
+STATE = tempfile.mkdtemp(prefix='import-calculator-tests-')
+os.environ.setdefault('DATABASE_PATH', os.path.join(STATE, 'app.db'))
+os.environ.setdefault('ADMISSION_FOLDER', os.path.join(STATE, 'admission'))
+os.environ.setdefault('UPLOAD_CAPTURE_ENABLED', '0')
+os.environ.setdefault('SHEET_WORKERS', '1')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
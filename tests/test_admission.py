@@ -0,0 +1,31 @@
+import uuid
+
+from app import admission_gate, app
+
+def calculation():
+    return {
+        'container_cost_usd': 5000, 'container_volume': 68, 'import_tax_rate': 0.18,
+        'usd_to_ils_rate': 3.7, 'rmb_to_ils_rate': 0.51, 'local_transportation_ils': 1200,
+        'products': [{'name': f"ADM-{uuid.uuid4().hex[:8]}", 'quantity': 100, 'total_volume': 0.1,
+                      'price': 12.5, 'currency': 'USD'}]
+    }
+
+def running(endpoint):
+    return admission_gate(endpoint).stats()['running']
+
+def test_streamed_response_holds_its_slot_until_closed():
+    client = app.test_client()
+    response = client.post('/export/xlsx', json=calculation(), buffered=False)
+    assert response.status_code == 200
+    assert response.is_streamed
+    # The view has returned, but the file is still being sent
+    assert running('export_xlsx') == 1
+    assert response.get_data()[:2] == b'PK'
+    response.close()
+    assert running('export_xlsx') == 0
+
+def test_buffered_response_releases_its_slot_at_teardown():
+    response = app.test_client().post('/export/xlsx', json={'products': []})
+    assert response.status_code == 400
+    assert running('export_xlsx') == 0
+    assert admission_gate('export_xlsx').stats()['average_seconds'] is not None
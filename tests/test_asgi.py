@@ -0,0 +1,125 @@
+"""The ASGI entry point (asgi.py): Flask routes through the WSGI bridge and the async rate routes."""
+
+import asyncio
+import gzip
+import io
+import json
+import uuid
+
+import pytest
+
+pytest.importorskip('httpx')
+import asgi
+from app import app, provider_health, rate_cache
+from benchmarks import FakeRateProvider
+
+def calculation(products=1):
+    return {
+        'container_cost_usd': 5000, 'container_volume': 68, 'import_tax_rate': 0.18,
+        'usd_to_ils_rate': 3.7, 'rmb_to_ils_rate': 0.51, 'local_transportation_ils': 1200,
+        'supplier_file_hash': uuid.uuid4().hex,
+        'products': [{'name': f"ASGI-{uuid.uuid4().hex[:8]}", 'quantity': 100, 'total_volume': 0.1,
+                      'price': 12.5, 'currency': 'USD'} for _ in range(products)]
+    }
+
+def request(method, path, body=b'', headers=(), chunk_size=None):
+    """
+    Call asgi.app once; the request body arrives in `chunk_size` pieces.
+    Returns (status, {header: value}, [body chunks]).
+    """
+    chunk_size = chunk_size or max(len(body), 1)
+    pieces = [body[start:start + chunk_size] for start in range(0, len(body), chunk_size)] or [b'']
+    received = [{'type': 'http.request', 'body': piece, 'more_body': idx < len(pieces) - 1}
+                for idx, piece in enumerate(pieces)]
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http', 'method': method, 'path': path, 'root_path': '', 'query_string': query.encode(),
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers],
+        'http_version': '1.1', 'scheme': 'http', 'server': ('testserver', 80), 'client': ('127.0.0.1', 50000)
+    }
+    sent = []
+
+    async def receive():
+        return received.pop(0) if received else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.app(scope, receive, send))
+    start, bodies = sent[0], sent[1:]
+    assert start['type'] == 'http.response.start'
+    assert all(message['type'] == 'http.response.body' for message in bodies)
+    assert not bodies[-1].get('more_body')
+    headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in start['headers']}
+    return start['status'], headers, [message['body'] for message in bodies]
+
+def post_json(path, data, headers=(), chunk_size=None):
+    return request('POST', path, json.dumps(data).encode('utf-8'),
+                   [('Content-Type', 'application/json')] + list(headers), chunk_size)
+
+def test_request_body_in_chunks_and_etag_304():
+    data = calculation()
+    # Like a chunked upload: several body messages and no Content-Length header
+    status, headers, chunks = post_json('/calculate', data, chunk_size=64)
+    assert status == 200
+    assert headers['content-type'] == 'application/json'
+    assert json.loads(b''.join(chunks))['results'][0]['name'] == data['products'][0]['name']
+
+    status, headers_304, chunks = post_json('/calculate', data, [('If-None-Match', headers['etag'])])
+    assert status == 304
+    assert headers_304['etag'] == headers['etag']
+    assert b''.join(chunks) == b''
+
+def test_gzip_response():
+    status, headers, chunks = post_json('/calculate', calculation(products=20), [('Accept-Encoding', 'gzip')])
+    assert status == 200
+    assert headers['content-encoding'] == 'gzip'
+    assert 'Accept-Encoding' in headers['vary']
+    body = b''.join(chunks)
+    assert int(headers['content-length']) == len(body)
+    assert len(json.loads(gzip.decompress(body))['results']) == 21
+
+def test_streamed_file_response():
+    openpyxl = pytest.importorskip('openpyxl')
+    status, headers, chunks = post_json('/export/xlsx', calculation(products=300))
+    assert status == 200
+    assert headers['content-type'] == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    assert 'attachment' in headers['content-disposition']
+    # send_file streams the workbook in blocks, each sent as it is read
+    assert len([chunk for chunk in chunks if chunk]) > 1
+    workbook = openpyxl.load_workbook(io.BytesIO(b''.join(chunks)))
+    assert workbook.worksheets[0].max_row == 302   # header, 300 products, totals
+
+def test_repeated_headers_and_query_string():
+    environ = asgi.wsgi_environ({
+        'type': 'http', 'method': 'GET', 'path': '/app/history', 'root_path': '/app', 'query_string': b'limit=5',
+        'headers': [(b'accept', b'text/html'), (b'accept', b'application/json'), (b'content-type', b'text/plain')]
+    }, io.BytesIO(b'body'))
+    assert environ['SCRIPT_NAME'] == '/app'
+    assert environ['PATH_INFO'] == '/history'
+    assert environ['QUERY_STRING'] == 'limit=5'
+    assert environ['HTTP_ACCEPT'] == 'text/html,application/json'
+    assert environ['CONTENT_TYPE'] == 'text/plain'
+    assert environ['CONTENT_LENGTH'] == '4'
+
+    status, _, chunks = request('GET', '/history?limit=0')
+    assert status == 400
+    assert 'error' in json.loads(b''.join(chunks))
+
+def test_async_rate_route(monkeypatch):
+    provider = FakeRateProvider('ok')
+    monkeypatch.setitem(app.config, 'RATE_PROVIDER_URLS', [provider.url])
+    monkeypatch.setitem(app.config, 'RATE_CACHE_TTL', 0)
+    provider_health.breakers.clear()
+    rate_cache.clear()
+    try:
+        status, headers, chunks = request('GET', '/get-exchange-rate')
+    finally:
+        asyncio.run(asgi.rates.close())
+        provider.server.shutdown()
+        provider_health.breakers.clear()
+        rate_cache.clear()
+    body = json.loads(b''.join(chunks))
+    assert status == 200
+    assert (body['success'], body['rate'], body['source']) == (True, 3.65, provider.url)
+    assert provider.calls == 1
@@ -0,0 +1,55 @@
+import uuid
+
+import pytest
+
+import app as app_module
+from app import app, calculation_cache, calculator_for, parse_calculation_request
+
+def settings(**products):
+    return {
+        'container_cost_usd': 5000, 'container_volume': 68, 'import_tax_rate': 0.18,
+        'usd_to_ils_rate': 3.7, 'rmb_to_ils_rate': 0.51, 'local_transportation_ils': 1200,
+        'products': [{'name': name, 'quantity': quantity, 'total_volume': 1.5, 'price': 12.5, 'currency': 'USD'}
+                     for name, quantity in products.items()]
+    }
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+def names(response):
+    return [row['name'] for row in response.get_json()['results'][:-1]]
+
+def test_reordered_rows_are_not_answered_with_304(client):
+    first, second = f"A{uuid.uuid4().hex[:6]}", f"B{uuid.uuid4().hex[:6]}"
+    response = client.post('/calculate', json=settings(**{first: 100, second: 200}))
+    assert names(response) == [first, second]
+    etag = response.headers['ETag']
+    assert client.post('/calculate', json=settings(**{first: 100, second: 200}),
+                       headers={'If-None-Match': etag}).status_code == 304
+
+    # Same calculation in another order: same cache entry, but the body follows the new order
+    hits = calculation_cache.hits
+    response = client.post('/calculate', json=settings(**{second: 200, first: 100}), headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert names(response) == [second, first]
+    assert response.headers['ETag'] != etag
+    assert calculation_cache.hits == hits + 1
+
+def test_conversion_rates_without_the_cross_rate_matrix(client, monkeypatch):
+    def no_matrix(*args, **kwargs):
+        raise AssertionError('prepare() built a CrossRates matrix')
+    monkeypatch.setattr(app_module, 'CrossRates', no_matrix)
+    body = settings(**{f"E{uuid.uuid4().hex[:6]}": 100, f"I{uuid.uuid4().hex[:6]}": 100})
+    body['products'][0]['currency'], body['products'][1]['currency'] = 'EUR', 'ILS'
+    body['exchange_rates'] = {'EUR': 4.0}
+    calculator = calculator_for(*parse_calculation_request(body))
+    currency_indices, conversion_rate, duty_rate = calculator.prepare()
+    assert conversion_rate.tolist() == [4.0, 1.0]
+
+    # A currency with no rate is still rejected
+    del body['exchange_rates']
+    monkeypatch.setattr(app_module, 'market_ils_rate', lambda currency: None)
+    response = client.post('/calculate', json=body)
+    assert response.status_code == 400
+    assert 'EUR' in response.get_json()['error']
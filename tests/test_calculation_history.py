@@ -0,0 +1,89 @@
+import sqlite3
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+import pytest
+
+from app import CalculationHistory, app, calculation_cache, calculator_for, plan_calculation
+
+def calculation(supplier_file_hash, name=None):
+    return {
+        'container_cost_usd': 5000, 'container_volume': 68, 'import_tax_rate': 0.18,
+        'usd_to_ils_rate': 3.7, 'rmb_to_ils_rate': 0.51, 'local_transportation_ils': 1200,
+        'supplier_file_hash': supplier_file_hash,
+        'products': [{'name': name or f"HIST-{uuid.uuid4().hex[:8]}", 'quantity': 100, 'total_volume': 1.5,
+                      'price': 12.5, 'currency': 'USD'}]
+    }
+
+def saved(client, file_hash):
+    return client.get('/history', query_string={'file_hash': file_hash}).get_json()['calculations']
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+def test_cache_hits_are_saved_for_another_supplier_file(client):
+    first, second = uuid.uuid4().hex, uuid.uuid4().hex
+    body = calculation(first)
+    response = client.post('/calculate', json=body)
+    assert response.status_code == 200
+    hits = calculation_cache.hits
+    # Same numbers from a different supplier file: served from the cache, still a new run
+    response = client.post('/calculate', json=dict(body, supplier_file_hash=second))
+    assert response.status_code == 200
+    assert calculation_cache.hits == hits + 1
+    assert len(saved(client, first)) == 1
+    assert len(saved(client, second)) == 1
+
+def test_same_calculation_and_file_is_stored_once(client):
+    file_hash = uuid.uuid4().hex
+    body = calculation(file_hash)
+    client.post('/calculate', json=body)
+    client.post('/calculate', json=body)
+    assert len(saved(client, file_hash)) == 1
+
+def test_not_modified_only_for_the_same_supplier_file(client):
+    first, second = uuid.uuid4().hex, uuid.uuid4().hex
+    body = calculation(first)
+    etag = client.post('/calculate', json=body).headers['ETag']
+    assert client.post('/calculate', json=body, headers={'If-None-Match': etag}).status_code == 304
+    # The frontend always sends its last ETag: the same numbers for a new supplier file are a new run
+    response = client.post('/calculate', json=dict(body, supplier_file_hash=second), headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert len(saved(client, first)) == 1
+    assert len(saved(client, second)) == 1
+
+def test_concurrent_saves_store_one_row(client):
+    file_hash = uuid.uuid4().hex
+    body = calculation(file_hash)
+    args = plan_calculation(body)
+    settings, products, key = args[0], args[1], args[4]
+    results = calculator_for(settings, products).calculate_costs()
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        ids = list(pool.map(lambda _: CalculationHistory().save(key, settings, products, [''], results, {},
+                                                                supplier_file_hash=file_hash), range(16)))
+    assert len(set(ids)) == 1
+    assert len(saved(client, file_hash)) == 1
+
+def test_duplicates_from_before_the_unique_index_are_dropped(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'DATABASE_PATH', str(tmp_path / 'old.db'))
+    store = CalculationHistory()
+    with closing(store.connect()) as connection, connection:
+        connection.execute('DROP INDEX idx_calculations_run')
+        for file_hash in ('a', 'a', None, None, 'b'):
+            calculation_id = connection.execute(
+                "INSERT INTO calculations (created_at, calculation_key, supplier_file_hash, calculator_version, "
+                "product_count, settings, results, summary) VALUES ('', 'key', ?, '', 1, '{}', '[]', '{}')",
+                (file_hash,)).lastrowid
+            connection.execute('INSERT INTO calculation_products (calculation_id, position) VALUES (?, 0)',
+                               (calculation_id,))
+
+    with closing(CalculationHistory().connect()) as connection:
+        assert [row[0] for row in connection.execute('SELECT id FROM calculations ORDER BY id')] == [1, 3, 5]
+        assert [row[0] for row in connection.execute('SELECT calculation_id FROM calculation_products')] == [1, 3, 5]
+        with pytest.raises(sqlite3.IntegrityError):
+            connection.execute("INSERT INTO calculations (created_at, calculation_key, supplier_file_hash, "
+                               "calculator_version, product_count, settings, results, summary) "
+                               "VALUES ('', 'key', NULL, '', 1, '{}', '[]', '{}')")
@@ -0,0 +1,87 @@
+import io
+import uuid
+
+import pytest
+
+from app import ContainerCalculator, app
+
+pa = pytest.importorskip('pyarrow')
+import pyarrow.parquet as pq
+
+INVOICE = ('Item No,Description,Qty,Unit Price USD,CBM\n'
+           'HD001,scooter,100,12.5,1.2\n'
+           'HD002,helmet,200,3.75,0.8\n').encode('utf-8')
+
+def calculation(supplier_file_hash=None):
+    return {
+        'container_cost_usd': 5000, 'container_volume': 68, 'import_tax_rate': 0.18,
+        'usd_to_ils_rate': 3.7, 'rmb_to_ils_rate': 0.51, 'local_transportation_ils': 1200,
+        'supplier_file_hash': supplier_file_hash,
+        'products': [
+            {'name': f"COL-{uuid.uuid4().hex[:8]}", 'description': 'kick scooter', 'quantity': 100,
+             'total_volume': 1.5, 'price': 12.5, 'currency': 'USD'},
+            {'name': f"COL-{uuid.uuid4().hex[:8]}", 'description': 'helmet', 'quantity': 40,
+             'total_volume': 0.5, 'price': 30, 'currency': 'RMB'}
+        ]
+    }
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+def read_table(response, export_format):
+    """The exported table; closes the response, which frees its admission slot."""
+    with response:
+        data = response.get_data()
+    assert response.status_code == 200, data[:200]
+    if export_format == 'parquet':
+        assert response.mimetype == 'application/vnd.apache.parquet'
+        return pq.read_table(io.BytesIO(data))
+    assert response.mimetype == 'application/vnd.apache.arrow.stream'
+    return pa.ipc.open_stream(data).read_all()
+
+@pytest.mark.parametrize('export_format', ['arrow', 'parquet'])
+def test_calculation_export_matches_calculate(client, export_format):
+    body = calculation()
+    results = client.post('/calculate', json=body).get_json()['results']
+    table = read_table(client.post(f'/export/{export_format}', json=body), export_format)
+
+    # Request order, no totals row
+    assert table.column('sku').to_pylist() == [product['name'] for product in body['products']]
+    assert table.column('description').to_pylist() == ['kick scooter', 'helmet']
+    assert table.column('currency').to_pylist() == ['USD', 'CNY']
+    assert table.column('quantity').to_pylist() == [100, 40]
+    for name in ContainerCalculator.COST_COLUMNS:
+        assert table.column(name).to_pylist() == pytest.approx([result[name] for result in results[:-1]], abs=0.01)
+
+def test_history_export(client):
+    file_hashes = [uuid.uuid4().hex, uuid.uuid4().hex]
+    bodies = [calculation(file_hash) for file_hash in file_hashes]
+    for body in bodies:
+        assert client.post('/calculate', json=body).status_code == 200
+    ids = [client.get('/history', query_string={'file_hash': file_hash}).get_json()['calculations'][0]['id']
+           for file_hash in file_hashes]
+
+    table = read_table(client.get('/history/export.parquet', query_string={'ids': ','.join(map(str, ids))}),
+                       'parquet')
+    assert table.column('calculation_id').to_pylist() == [ids[0], ids[0], ids[1], ids[1]]
+    assert table.column('sku').to_pylist() == [product['name'] for body in bodies for product in body['products']]
+    assert table.schema.field('created_at').type == pa.timestamp('us')
+
+def test_upload_as_arrow(client):
+    products = client.post('/upload', data={'file': (io.BytesIO(INVOICE), 'invoice.csv')},
+                           content_type='multipart/form-data').get_json()['products']
+    response = client.post('/upload', data={'file': (io.BytesIO(INVOICE), 'invoice.csv'), 'format': 'arrow'},
+                           content_type='multipart/form-data')
+    table = read_table(response, 'arrow')
+    assert table.column('sku').to_pylist() == [product['name'] for product in products]
+    assert table.column('quantity').to_pylist() == [100, 200]
+    assert table.column('unit_price').to_pylist() == [12.5, 3.75]
+
+def test_export_errors(client):
+    assert client.post('/export/parquet', json={'products': []}).status_code == 400
+    assert client.get('/history/export.arrow', query_string={'ids': 'x'}).status_code == 400
+    assert client.get('/history/export.arrow', query_string={'ids': '999999999'}).status_code == 404
+    response = client.post('/upload', data={'file': (io.BytesIO(INVOICE), 'invoice.csv'), 'format': 'feather'},
+                           content_type='multipart/form-data')
+    assert response.status_code == 400
@@ -0,0 +1,75 @@
+import contextlib
+import io
+
+import pytest
+
+from app import coerce_numeric, extract_products_from_excel, parse_number, process_excel_data, read_table
+
+def numbers(values, **kwargs):
+    return coerce_numeric(values, **kwargs)[0].tolist()
+
+@pytest.mark.parametrize('text, expected', [
+    ('-5', -5.0),
+    ('(5)', -5.0),
+    ('5-', -5.0),
+    ('¥-5', -5.0),
+    ('US$ -12.50', -12.5),
+    ('-US$ 12.50', -12.5),
+    ('RMB(7)', -7.0),
+    ('(5) pcs', -5.0),
+    ('US$ 12', 12.0),
+    ('¥12', 12.0),
+    ('0.35 cbm', 0.35),
+    ('0.35m³', 0.35),
+    ('500pcs', 500.0),
+])
+def test_signs_markers_and_units(text, expected):
+    assert parse_number(text) == expected
+
+@pytest.mark.parametrize('column, expected', [
+    (['1.234,56', '2.500,00', '3,5'], [1234.56, 2500.0, 3.5]),
+    (['1,234.56', '2,500', '3.5'], [1234.56, 2500.0, 3.5]),
+    (['1 234,56', '12,5'], [1234.56, 12.5]),
+    (['1.234.567', '2.000'], [1234567.0, 2000.0]),
+    # The comma-decimal value decides the column, including the dotted "2.500"
+    (['2.500', '1.250,50'], [2500.0, 1250.5]),
+])
+def test_decimal_separator_is_voted_per_column(column, expected):
+    assert numbers(column) == expected
+
+def test_ambiguous_column_uses_the_default_separator():
+    assert numbers(['2.500', '12.000']) == [2.5, 12.0]
+    assert numbers(['2.500', '12.000'], default_decimal=',') == [2500.0, 12000.0]
+
+def test_real_numbers_pass_through():
+    values, failed = coerce_numeric([2.5, 12, None])
+    assert values[:2].tolist() == [2.5, 12.0]
+    assert values.isna().tolist() == [False, False, True]
+    assert not failed.any()
+
+def test_failures_are_counted_only_for_non_empty_cells():
+    values, failed = coerce_numeric(['12', 'lots', '', None, 'n/a', '¥'])
+    assert failed.tolist() == [False, True, False, False, False, True]
+    assert values.isna().tolist() == [False, True, True, True, True, True]
+
+@pytest.fixture
+def european_csv(tmp_path):
+    path = tmp_path / 'invoice.csv'
+    path.write_text('Item No;Description;Qty;Unit Price USD;CBM\n'
+                    'A1;scooter;2.500;1.234,50;0,35\n'
+                    'A2;helmet;12.000;3,75;1,2\n', encoding='utf-8')
+    return str(path)
+
+def test_robust_pipeline_reads_european_numbers(european_csv):
+    failures = {}
+    with contextlib.redirect_stdout(io.StringIO()):
+        products = extract_products_from_excel(european_csv, failures=failures)
+    assert [(p['quantity'], p['price'], p['cbm']) for p in products] == [(2500.0, 1234.5, 0.35), (12000.0, 3.75, 1.2)]
+    assert failures == {}
+
+def test_legacy_pipeline_reads_european_numbers(european_csv):
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = process_excel_data(read_table(european_csv))
+    assert [(p['quantity'], p['cost_per_unit_usd'], p['total_volume']) for p in result['products']] == [
+        (2500.0, 1234.5, 0.35), (12000.0, 3.75, 1.2)]
+    assert result['parse_failures'] == {'quantity': 0, 'price': 0, 'volume': 0}
@@ -0,0 +1,23 @@
+import pytest
+
+from app import app
+
+ROUTES = ['/rates/history', '/history', '/sku/suggest?q=HD']
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+@pytest.mark.parametrize('route', ROUTES)
+@pytest.mark.parametrize('limit', ['-1', '0', 'many'])
+def test_invalid_limits_are_rejected(client, route, limit):
+    separator = '&' if '?' in route else '?'
+    response = client.get(f"{route}{separator}limit={limit}")
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
+
+@pytest.mark.parametrize('route', ROUTES)
+def test_positive_limits_are_accepted(client, route):
+    separator = '&' if '?' in route else '?'
+    assert client.get(f"{route}{separator}limit=1").status_code == 200
+    assert client.get(f"{route}{separator}limit=1000000").status_code == 200
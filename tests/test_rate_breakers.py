@@ -0,0 +1,131 @@
+import time
+from urllib.parse import urlsplit
+
+import pytest
+
+from app import app, provider_health, rate_cache, usd_ils_providers
+from benchmarks import FakeRateProvider
+
+COOLDOWN = 0.2
+
+def host(provider):
+    return urlsplit(provider.url).netloc
+
+@pytest.fixture
+def servers():
+    """Fake providers, fresh breakers and no rate cache; the rate settings are put back afterwards."""
+    saved = {name: app.config[name] for name in ('RATE_PROVIDER_URLS', 'RATE_TIMEOUT', 'RATE_CACHE_TTL',
+                                                 'RATE_BREAKER_FAILURES', 'RATE_BREAKER_COOLDOWN',
+                                                 'RATE_BREAKER_MAX_COOLDOWN', 'RATE_HEALTH_MEMORY')}
+    app.config.update(RATE_TIMEOUT=2, RATE_CACHE_TTL=0, RATE_BREAKER_FAILURES=3, RATE_BREAKER_COOLDOWN=COOLDOWN,
+                      RATE_BREAKER_MAX_COOLDOWN=10, RATE_HEALTH_MEMORY=300)
+    provider_health.breakers.clear()
+    rate_cache.clear()
+    started = []
+
+    def start(*modes):
+        providers = [FakeRateProvider(mode) for mode in modes]
+        started.extend(providers)
+        app.config['RATE_PROVIDER_URLS'] = [provider.url for provider in providers]
+        return providers
+
+    yield start
+    for provider in started:
+        provider.server.shutdown()
+    app.config.update(saved)
+    provider_health.breakers.clear()
+    rate_cache.clear()
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+def fetch(client):
+    return client.get('/get-exchange-rate').get_json()
+
+def test_breaker_opens_after_consecutive_failures(servers, client):
+    failing, = servers('fail')
+    for attempt in range(app.config['RATE_BREAKER_FAILURES']):
+        assert provider_health.states().get(host(failing), 'closed') == 'closed'
+        body = fetch(client)
+        assert body['success'] is False
+    assert failing.calls == app.config['RATE_BREAKER_FAILURES']
+    assert body['providers'] == {host(failing): 'open'}
+
+    # While open the provider is skipped without a request
+    body = fetch(client)
+    assert failing.calls == app.config['RATE_BREAKER_FAILURES']
+    assert body['providers'] == {host(failing): 'open'}
+
+@pytest.mark.parametrize('route', ['/get-exchange-rate', '/get-currency-rates'])
+def test_error_bodies_count_as_failures_and_are_not_cached(servers, client, route):
+    bad, = servers('bad')
+    for attempt in range(app.config['RATE_BREAKER_FAILURES']):
+        assert client.get(route).get_json()['success'] is False
+    assert bad.calls == app.config['RATE_BREAKER_FAILURES']
+    assert bad.url not in rate_cache
+    assert provider_health.states() == {host(bad): 'open'}
+    assert provider_health.breaker(bad.url).last_error == "'rates'"
+
+def test_half_open_trial_closes_or_reopens_with_doubled_cooldown(servers, client):
+    provider, = servers('fail')
+    breaker = provider_health.breaker(provider.url)
+    for attempt in range(app.config['RATE_BREAKER_FAILURES']):
+        fetch(client)
+    assert breaker.state == 'open'
+    assert breaker.cooldown == COOLDOWN
+
+    # A failed trial reopens the circuit for twice as long
+    time.sleep(COOLDOWN)
+    assert provider_health.states() == {host(provider): 'half_open'}
+    calls = provider.calls
+    body = fetch(client)
+    assert provider.calls == calls + 1
+    assert body['providers'] == {host(provider): 'open'}
+    assert breaker.cooldown == 2 * COOLDOWN
+    time.sleep(COOLDOWN)
+    assert provider_health.states() == {host(provider): 'open'}
+
+    # A successful trial closes it and resets the cooldown
+    provider.mode = 'ok'
+    time.sleep(COOLDOWN)
+    assert provider_health.states() == {host(provider): 'half_open'}
+    body = fetch(client)
+    assert body['success'] is True
+    assert body['source'] == provider.url
+    assert body['providers'] == {host(provider): 'closed'}
+    assert breaker.cooldown == COOLDOWN
+    assert breaker.consecutive_failures == 0
+
+def test_healthiest_provider_is_tried_first(servers, client):
+    failing, healthy = servers('fail', 'ok')
+    assert [api['url'] for api in usd_ils_providers()] == [failing.url, healthy.url]
+
+    body = fetch(client)
+    assert body['source'] == healthy.url
+    assert (failing.calls, healthy.calls) == (1, 1)
+
+    # The provider that just failed now goes last, so it is not called again
+    assert [api['url'] for api in usd_ils_providers()] == [healthy.url, failing.url]
+    body = fetch(client)
+    assert body['source'] == healthy.url
+    assert (failing.calls, healthy.calls) == (1, 2)
+    assert body['providers'] == {host(failing): 'closed', host(healthy): 'closed'}
+
+def test_metrics_report_provider_health(servers, client):
+    failing, healthy = servers('fail', 'ok')
+    for attempt in range(app.config['RATE_BREAKER_FAILURES']):
+        provider_health.breaker(failing.url).record_failure(0.01, 'HTTP 500')
+    fetch(client)
+
+    stats = client.get('/metrics').get_json()['rate_providers']
+    assert set(stats) == {host(failing), host(healthy)}
+    assert stats[host(failing)]['state'] == 'open'
+    assert stats[host(failing)]['consecutive_failures'] == app.config['RATE_BREAKER_FAILURES']
+    assert stats[host(failing)]['error_rate'] == 1.0
+    assert stats[host(failing)]['last_error'] == 'HTTP 500'
+    assert 0 < stats[host(failing)]['retry_in_seconds'] <= COOLDOWN
+    assert stats[host(healthy)]['state'] == 'closed'
+    assert stats[host(healthy)]['error_rate'] == 0.0
+    assert stats[host(healthy)]['latency_ms'] is not None
+    assert failing.calls == 0
@@ -0,0 +1,76 @@
+import uuid
+
+import pytest
+
+from app import app
+
+def calculation(simulation):
+    return {
+        'container_cost_usd': 5000, 'container_volume': 68, 'import_tax_rate': 0.18,
+        'usd_to_ils_rate': 3.7, 'rmb_to_ils_rate': 0.51, 'local_transportation_ils': 1200,
+        'products': [
+            {'name': f"SIM-{uuid.uuid4().hex[:8]}", 'quantity': 100, 'total_volume': 1.5, 'price': 12.5,
+             'currency': 'USD'},
+            {'name': f"SIM-{uuid.uuid4().hex[:8]}", 'quantity': 40, 'total_volume': 0.5, 'price': 30,
+             'currency': 'RMB'}
+        ],
+        'simulation': simulation
+    }
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+def simulate(client, body):
+    response = client.post('/simulate', json=body)
+    body = response.get_json()
+    assert response.status_code == 200, body
+    return body
+
+def test_without_volatility_every_path_is_the_spot_cost(client):
+    request_body = calculation({'paths': 500, 'volatility': {'USD': 0, 'RMB': 0}})
+    body = simulate(client, request_body)
+    assert body['currencies'] == ['USD', 'CNY']
+    assert body['model']['type'] == 'lognormal'
+    total = body['total_cost_ils']
+    assert total['p5'] == total['p50'] == total['p95'] == total['mean'] == pytest.approx(total['spot'], abs=0.01)
+    spot = client.post('/calculate', json=request_body).get_json()['results']
+    assert total['spot'] == pytest.approx(spot[-1]['total_cost_ils'], abs=0.01)
+    for product, result in zip(body['products'], spot):
+        assert product['name'] == result['name']
+        assert product['total_cost_ils']['p50'] == pytest.approx(result['total_cost_ils'], abs=0.01)
+
+def test_lognormal_is_reproducible_from_its_seed(client):
+    body = calculation({'paths': 2000, 'horizon_days': 90, 'volatility': {'USD': 0.07, 'RMB': 0.09},
+                        'correlation': 0.8})
+    first = simulate(client, body)
+    body['simulation']['seed'] = first['seed']
+    assert simulate(client, body) == first
+    total = first['total_cost_ils']
+    assert total['p5'] < total['p50'] < total['p95']
+    assert first['model']['correlation'] == [[1.0, 0.8], [0.8, 1.0]]
+
+def test_bootstrap_of_request_returns(client):
+    returns = {'USD': [0.004, -0.003, 0.002, -0.001] * 10, 'RMB': [0.005, -0.004, 0.001, -0.002] * 10}
+    request_body = calculation({'paths': 1000, 'horizon_days': 30, 'returns': returns, 'seed': 7})
+    body = simulate(client, request_body)
+    assert body['model']['type'] == 'historical bootstrap'
+    assert (body['model']['source'], body['model']['days'], body['model']['drift']) == ('request', 40, False)
+    assert body['model']['correlation'][0][1] > 0.5
+    rates = body['rates']['USD']
+    assert rates['p5'] < 3.7 < rates['p95']
+    assert simulate(client, request_body) == body
+
+@pytest.mark.parametrize('simulation', [
+    {'paths': 0, 'volatility': {'USD': 0.1, 'RMB': 0.1}},
+    {'horizon_days': 100000, 'volatility': {'USD': 0.1, 'RMB': 0.1}},
+    {'percentiles': [101], 'volatility': {'USD': 0.1, 'RMB': 0.1}},
+    {'volatility': {'USD': 0.1}},
+    {'volatility': {'USD': -0.1, 'RMB': 0.1}},
+    {'volatility': {'USD': 0.1, 'RMB': 0.1}, 'correlation': 1.5},
+    {'returns': {'USD': [0.001] * 5, 'RMB': [0.001] * 5}},
+])
+def test_invalid_simulations_are_rejected(client, simulation):
+    response = client.post('/simulate', json=calculation(simulation))
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
@@ -0,0 +1,80 @@
+import sqlite3
+import uuid
+from contextlib import closing
+
+import pytest
+
+from app import SkuCatalog, app
+
+def records(count):
+    return [{'sku': code, 'product_code': code, 'item_number': '', 'description': 'aluminium kick scooter',
+             'unit_cbm': 0.01, 'unit_price': 12.5, 'currency': 'USD', 'supplier': 'test'}
+            for code in (f"T{uuid.uuid4().hex[:8].upper()}" for _ in range(count))]
+
+@pytest.fixture
+def catalog():
+    catalog = SkuCatalog()
+    catalog.record(records(20))
+    return catalog
+
+def locked_while_called(catalog, index, method, monkeypatch):
+    """Record whether the catalog lock is held each time index.method runs."""
+    held, original = [], getattr(index, method)
+
+    def wrapper(*args, **kwargs):
+        held.append(catalog.lock.locked())
+        return original(*args, **kwargs)
+    monkeypatch.setattr(index, method, wrapper)
+    return held
+
+def test_match_reads_the_indexes_under_the_lock(catalog, monkeypatch):
+    code = next(iter(catalog.index.records))
+    catalog.match([(code, '')])   # builds the n-gram index
+    held = locked_while_called(catalog, catalog.fuzzy, 'match', monkeypatch)
+    matches = catalog.match([(code, ''), (code[:-1], 'kick scooter')], k=3)
+    assert held == [True, True]
+    assert matches[0][0]['sku'] == code and matches[0][0]['score'] == 1.0
+
+def test_suggest_reads_the_index_under_the_lock(catalog, monkeypatch):
+    code = next(iter(catalog.index.records))
+    held = locked_while_called(catalog, catalog.index, 'suggest', monkeypatch)
+    assert [record['sku'] for record in catalog.suggest(code)] == [code]
+    assert held == [True]
+
+def test_refresh_picks_up_rows_committed_with_an_earlier_timestamp(catalog):
+    # Another worker stamped these rows before this catalog's last write but committed them after
+    late = dict(records(1)[0], unit_cbm=0.5, updated_at='2000-01-01T00:00:00')
+    updated = dict(next(iter(catalog.index.records.values())), unit_cbm=0.25, updated_at='2000-01-01T00:00:00')
+    columns = SkuCatalog.columns
+    with closing(catalog.connect()) as connection, connection:
+        connection.executemany(
+            f"INSERT INTO sku_catalog ({', '.join(columns)}, seq) VALUES ({', '.join('?' * len(columns))}, "
+            "(SELECT MAX(seq) + 1 FROM sku_catalog)) ON CONFLICT (sku) DO UPDATE SET "
+            "unit_cbm = excluded.unit_cbm, updated_at = excluded.updated_at, seq = excluded.seq",
+            [[record[column] for column in columns] for record in (late, updated)])
+
+    catalog.refresh(force=True)
+    assert catalog.index.records[late['sku']]['unit_cbm'] == 0.5
+    assert catalog.index.records[updated['sku']]['unit_cbm'] == 0.25
+
+def test_tables_without_seq_are_numbered_in_rowid_order(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'DATABASE_PATH', str(tmp_path / 'old.db'))
+    with closing(sqlite3.connect(app.config['DATABASE_PATH'])) as connection, connection:
+        connection.execute(SkuCatalog.schema[0])
+        connection.executemany(f"INSERT INTO sku_catalog ({', '.join(SkuCatalog.columns)}) "
+                               f"VALUES ({', '.join('?' * len(SkuCatalog.columns))})",
+                               [tuple(record.values()) + ('2024-01-01T00:00:00',) for record in records(3)])
+
+    catalog = SkuCatalog()
+    catalog.refresh(force=True)
+    assert len(catalog.index.records) == 3
+    assert catalog.loaded_seq == 3
+    catalog.record(records(1))
+    assert len(catalog.index.records) == 4
+    assert catalog.loaded_seq == 4
+
+@pytest.mark.parametrize('k', [0, -1, 'many'])
+def test_match_rejects_k_below_one(k):
+    response = app.test_client().post('/sku/match', json={'products': [{'product_code': 'T1'}], 'k': k})
+    assert response.status_code == 400
+    assert 'error' in response.get_json()
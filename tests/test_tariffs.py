@@ -0,0 +1,42 @@
+import pytest
+
+from app import TariffTable, app, normalize_hs_code
+
+SCHEDULE = ('hs_code,duty_rate,description\n'
+            '8712,12,Bicycles\n'
+            '8712.00.10,0,Children\'s bicycles\n')
+
+@pytest.fixture
+def table(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'DATABASE_PATH', str(tmp_path / 'tariffs.db'))
+    table = TariffTable()
+    table.import_csv(SCHEDULE)
+    return table
+
+@pytest.mark.parametrize('code, expected', [
+    ('8712.00.10', '87120010'),
+    (87120010, '87120010'),
+    (8712.0010, '87120010'),   # Excel reads the subheading as 8712.001
+    (8712.1, '871210'),
+    (8712.0, '8712'),
+    (401.1, '040110'),
+    (401, '0401'),
+    (float('nan'), ''),
+])
+def test_normalize_hs_code(code, expected):
+    assert normalize_hs_code(code) == expected
+
+def test_numeric_subheading_keeps_its_own_rate(table):
+    assert table.lookup(8712.0010)['matched_code'] == '87120010'
+    assert table.duty_rates([8712.0010, '8712.90', 9999]) == [0.0, 0.12, 0.0]
+
+def test_lookup_reads_one_schedule_snapshot(table, monkeypatch):
+    longest_prefix = TariffTable.longest_prefix
+
+    def swapped_meanwhile(digits, schedule):
+        matched = longest_prefix(digits, schedule)
+        table.schedule = ({}, [])   # a concurrent refresh() to an empty schedule
+        return matched
+    monkeypatch.setattr(table, 'longest_prefix', swapped_meanwhile)
+    table.refreshed_at = float('inf')
+    assert table.lookup('8712.00.10')['description'] == "Children's bicycles"
@@ -0,0 +1,35 @@
+import json
+
+import pandas as pd
+import pytest
+
+from app import app, maybe_capture_upload
+
+INVOICE = ('Item No,Description,Qty,Unit Price USD,CBM\n'
+           'HD001,Aluminium kick scooter,100,12.5,1.2\n')
+
+@pytest.fixture
+def upload(tmp_path, monkeypatch):
+    monkeypatch.setitem(app.config, 'CAPTURE_FOLDER', str(tmp_path / 'captures'))
+    path = tmp_path / 'invoice.csv'
+    path.write_text(INVOICE, encoding='utf-8')
+    return str(path)
+
+def test_nothing_is_captured_when_disabled(upload, monkeypatch):
+    monkeypatch.setitem(app.config, 'CAPTURE_ENABLED', False)
+    assert maybe_capture_upload(upload, '/upload', {'parse': 1.0}, error=ValueError('broken')) is None
+
+def test_scrubbed_capture_masks_descriptions(upload, monkeypatch):
+    monkeypatch.setitem(app.config, 'CAPTURE_ENABLED', True)
+    monkeypatch.setitem(app.config, 'CAPTURE_SCRUB_DESCRIPTIONS', True)
+    products = [{'item': 'HD001', 'description': 'Aluminium kick scooter'}]
+    capture_id = maybe_capture_upload(upload, '/upload', {'parse': 1.0}, products=products,
+                                      error=ValueError('broken'))
+    folder = app.config['CAPTURE_FOLDER']
+    with open(f"{folder}/{capture_id}.json", encoding='utf-8') as f:
+        meta = json.load(f)
+    assert meta['scrubbed'] is True and meta['workbook'] == f"{capture_id}.xlsx"
+    assert meta['products'][0]['description'] == 'xxxxxxxxx xxxx xxxxxxx'
+    workbook = pd.read_excel(f"{folder}/{meta['workbook']}", header=None)
+    assert workbook.iat[1, 0] == 'HD001'
+    assert workbook.iat[1, 1] == 'xxxxxxxxx xxxx xxxxxxx'
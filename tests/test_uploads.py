@@ -0,0 +1,73 @@
+import io
+
+import pandas as pd
+import pytest
+
+import app as app_module
+from app import app, extract_products_from_workbook, upload_filename
+
+INVOICE = ('Item No,Description,Qty,Unit Price USD,CBM\n'
+           'HD001,scooter,100,12.5,1.2\n'
+           'HD002,helmet,200,3.75,0.8\n').encode('utf-8')
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+@pytest.mark.parametrize('filename, expected', [
+    ('invoice.csv', 'invoice.csv'),
+    ('PI 2025.XLSX', 'PI_2025.xlsx'),
+    ('发票 PI.xls', 'PI.xls'),
+])
+def test_upload_filename_keeps_safe_names(filename, expected):
+    assert upload_filename(filename) == expected
+
+def test_upload_filename_keeps_the_extension_of_non_ascii_names():
+    saved = upload_filename('发票.csv')
+    assert saved.endswith('.csv') and len(saved) > len('.csv')
+    assert saved == upload_filename('发票.csv')
+    assert saved != upload_filename('形式发票.csv')
+
+@pytest.mark.parametrize('filename', ['invoice.csv', '发票.csv'])
+def test_robust_upload_of_csv(client, filename):
+    response = client.post('/upload-robust', data={'file': (io.BytesIO(INVOICE), filename)},
+                           content_type='multipart/form-data')
+    body = response.get_json()
+    assert response.status_code == 200, body
+    assert [product['item'] for product in body['products']] == ['HD001', 'HD002']
+
+@pytest.mark.parametrize('filename', ['invoice.csv', '发票.csv'])
+def test_upload_of_csv(client, filename):
+    response = client.post('/upload', data={'file': (io.BytesIO(INVOICE), filename)},
+                           content_type='multipart/form-data')
+    body = response.get_json()
+    assert response.status_code == 200, body
+    assert [product['product_code'] for product in body['products']] == ['HD001', 'HD002']
+
+def test_batch_upload_of_non_ascii_names(client):
+    files = [(io.BytesIO(INVOICE), '发票.csv'), (io.BytesIO(INVOICE), '形式发票.csv')]
+    response = client.post('/upload-batch', data={'files': files}, content_type='multipart/form-data')
+    body = response.get_json()
+    assert response.status_code == 200, body
+    assert [report.get('error') for report in body['files']] == [None, None]
+    assert [report['products'] for report in body['files']] == [2, 2]
+
+def test_workbook_is_opened_once_for_all_sheets(tmp_path, monkeypatch):
+    path = str(tmp_path / 'multi.xlsx')
+    invoice = pd.read_csv(io.BytesIO(INVOICE), header=None)
+    with pd.ExcelWriter(path) as writer:
+        pd.DataFrame([['Terms and conditions'], ['Payment 30% deposit']]).to_excel(
+            writer, sheet_name='Notes', header=False, index=False)
+        for sheet in ('Factory A', 'Factory B'):
+            invoice.to_excel(writer, sheet_name=sheet, header=False, index=False)
+    opened = []
+    open_workbook = app_module.open_workbook
+    monkeypatch.setattr(app_module, 'open_workbook', lambda filepath: opened.append(filepath) or open_workbook(filepath))
+
+    products, reports = extract_products_from_workbook(path, parallel=False)
+    assert opened == [path]
+    assert [(report['sheet'], report['products']) for report in reports] == [
+        ('Notes', 0), ('Factory A', 2), ('Factory B', 2)]
+    assert reports[0]['skipped'] == 'no header row'
+    assert [(product['sheet'], product['item']) for product in products] == [
+        ('Factory A', 'HD001'), ('Factory A', 'HD002'), ('Factory B', 'HD001'), ('Factory B', 'HD002')]
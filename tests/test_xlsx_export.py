@@ -0,0 +1,68 @@
+import io
+import uuid
+
+import pytest
+
+from app import EXPORT_COLUMNS, app
+
+openpyxl = pytest.importorskip('openpyxl')
+
+def calculation(supplier_file_hash=None):
+    return {
+        'container_cost_usd': 5000, 'container_volume': 68, 'import_tax_rate': 0.18,
+        'usd_to_ils_rate': 3.7, 'rmb_to_ils_rate': 0.51, 'local_transportation_ils': 1200,
+        'supplier_file_hash': supplier_file_hash,
+        'products': [
+            {'name': f"XLSX-{uuid.uuid4().hex[:8]}", 'description': 'kick scooter', 'quantity': 100,
+             'total_volume': 1.5, 'price': 12.5, 'currency': 'USD'},
+            {'name': f"XLSX-{uuid.uuid4().hex[:8]}", 'description': 'helmet', 'quantity': 40,
+             'total_volume': 0.5, 'price': 30, 'currency': 'RMB'}
+        ]
+    }
+
+@pytest.fixture
+def client():
+    return app.test_client()
+
+def workbook_rows(response):
+    """The export's product rows as dicts; closes the response, which frees its admission slot."""
+    with response:
+        data = response.get_data()
+    assert response.status_code == 200
+    assert response.mimetype == 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    assert 'attachment' in response.headers['Content-Disposition']
+    workbook = openpyxl.load_workbook(io.BytesIO(data))
+    assert workbook.sheetnames == ['עלויות נחיתה', 'הגדרות']
+    header, *rows = workbook.worksheets[0].iter_rows(values_only=True)
+    assert list(header) == [name for name, _ in EXPORT_COLUMNS]
+    return [dict(zip((field for _, field in EXPORT_COLUMNS), row)) for row in rows]
+
+def test_export_matches_calculate(client):
+    body = calculation()
+    results = client.post('/calculate', json=body).get_json()['results']
+    rows = workbook_rows(client.post('/export/xlsx', json=body))
+
+    # Supplier order, then the totals row
+    assert [row['name'] for row in rows] == [product['name'] for product in body['products']] + ['סה"כ']
+    assert [row['description'] for row in rows[:-1]] == ['kick scooter', 'helmet']
+    assert [row['cost_per_unit'] for row in rows[:-1]] == [12.5, 30]
+    for row, result in zip(rows, results):
+        assert row['total_cost_ils'] == pytest.approx(result['total_cost_ils'])
+        assert row['duty_ils'] == pytest.approx(result['duty_ils'])
+
+def test_saved_calculation_export(client):
+    file_hash = uuid.uuid4().hex
+    body = calculation(file_hash)
+    results = client.post('/calculate', json=body).get_json()['results']
+    calculation_id, = [saved['id'] for saved in
+                       client.get('/history', query_string={'file_hash': file_hash}).get_json()['calculations']]
+
+    response = client.get(f'/history/{calculation_id}/export.xlsx')
+    assert f'landed-costs-{calculation_id}.xlsx' in response.headers['Content-Disposition']
+    rows = workbook_rows(response)
+    assert [row['name'] for row in rows[:-1]] == [product['name'] for product in body['products']]
+    assert rows[-1]['total_cost_ils'] == pytest.approx(results[-1]['total_cost_ils'])
+
+def test_export_errors(client):
+    assert client.post('/export/xlsx', json={'products': []}).status_code == 400
+    assert client.get('/history/999999999/export.xlsx').status_code == 404